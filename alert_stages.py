@@ -0,0 +1,142 @@
+###########################################################
+# Alert Stages Module
+#
+# The reminder the app shows depends on how soon the next
+# meeting starts. Each stage in the alert_stages table (in
+# config.json) covers the time from its lead time (minutes
+# before the meeting) until the next, shorter, stage takes
+# over, and says what to show:
+#
+#   lead_time     - minutes before the meeting the stage
+#                   starts (required)
+#   animation     - flash, random, swirl or none
+#   color         - white, yellow, orange, red, green,
+#                   blue, magenta, or an [r, g, b] list
+#   count, delay  - flash count and delay (seconds)
+#   duration      - swirl length (frames), plus
+#   duration_step - frames added each minute closer to
+#                   the meeting
+#   repeat        - seconds between reminders
+#   show_summary  - scroll the meeting summary after the
+#                   animation (if display_meeting_summary
+#                   is enabled)
+#   urgent        - interrupts anything else on the display
+#
+# The app only asks Google for events as far ahead as the
+# longest lead time.
+###########################################################
+
+import bisect
+
+import display_engine as display
+import unicorn_hat as unicorn
+
+# the app's original reminders: WHITE from 10 minutes, YELLOW from 5, then a swirl that gets longer
+# every minute closer to the start of the meeting
+DEFAULT_ALERT_STAGES = [
+    {'lead_time': 10, 'animation': 'flash', 'color': 'white', 'count': 1},
+    {'lead_time': 5, 'animation': 'flash', 'color': 'yellow', 'count': 2},
+    {'lead_time': 3, 'animation': 'swirl', 'color': 'orange', 'duration': 100, 'duration_step': 50, 'urgent': True}]
+
+ANIMATIONS = ('flash', 'random', 'swirl', 'none')
+COLORS = {
+    'white': unicorn.WHITE,
+    'yellow': unicorn.YELLOW,
+    'orange': unicorn.ORANGE,
+    'red': unicorn.RED,
+    'green': unicorn.GREEN,
+    'blue': unicorn.BLUE,
+    'magenta': unicorn.MAGENTA}
+# default seconds between reminders (the app's refresh interval)
+DEFAULT_REPEAT = 60
+
+
+class AlertStage:
+    __slots__ = ('lead_time', 'animation', 'color', 'count', 'delay', 'duration', 'duration_step', 'repeat',
+                 'show_summary', 'urgent', '_frames')
+
+    def __init__(self, stage):
+        # stage is one entry from the alert_stages table, raises ValueError if it doesn't make sense
+        try:
+            self.lead_time = int(stage['lead_time'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Alert stage needs a lead_time (minutes): {}'.format(stage))
+        if self.lead_time < 1:
+            raise ValueError('Alert stage lead_time must be at least 1 minute: {}'.format(stage))
+        self.animation = stage.get('animation', 'flash')
+        if self.animation not in ANIMATIONS:
+            raise ValueError('Unknown alert stage animation: {}'.format(self.animation))
+        color = stage.get('color', 'white')
+        if isinstance(color, list) and len(color) == 3:
+            self.color = tuple(int(c) for c in color)
+        elif color in COLORS:
+            self.color = COLORS[color]
+        else:
+            raise ValueError('Unknown alert stage color: {}'.format(color))
+        self.count = int(stage.get('count', 1))
+        self.delay = float(stage.get('delay', 0.25))
+        self.duration = int(stage.get('duration', 100))
+        self.duration_step = int(stage.get('duration_step', 0))
+        self.repeat = float(stage.get('repeat', DEFAULT_REPEAT))
+        self.show_summary = bool(stage.get('show_summary', True))
+        self.urgent = bool(stage.get('urgent', False))
+        # precomputed swirl animations, one per minute in the stage (see prepare())
+        self._frames = None
+
+    def get_duration(self, num_minutes):
+        # swirl length (frames) with num_minutes to go, longer every minute closer to the start
+        return self.duration + max(0, self.lead_time - 1 - num_minutes) * self.duration_step
+
+    def prepare(self):
+        # Build the swirl animations ahead of time (once the display is set up), so a reminder
+        # just plays them
+        if self.animation == 'swirl' and self._frames is None:
+            self._frames = [unicorn.swirl_frames(self.get_duration(num_minutes), cache=False)
+                            for num_minutes in range(self.lead_time)]
+
+    def get_priority(self):
+        return display.PRIORITY_URGENT if self.urgent else display.PRIORITY_REMINDER
+
+    def get_steps(self, num_minutes):
+        # the display steps for the stage's animation, with num_minutes to go
+        if self.animation == 'flash':
+            return [(unicorn.flash_all, (self.count, self.delay, self.color))]
+        if self.animation == 'random':
+            return [(unicorn.flash_random, (self.count, self.delay))]
+        if self.animation == 'swirl':
+            if self._frames is not None and 0 <= num_minutes < len(self._frames):
+                return [(unicorn.play_frames, (self._frames[int(num_minutes)], unicorn.SWIRL_DELAY))]
+            return [(unicorn.do_swirl, (self.get_duration(num_minutes),))]
+        return []
+
+
+class AlertStages:
+
+    def __init__(self, table=None):
+        # table is the alert_stages list from the config file (the defaults if it's empty)
+        self.table = table or DEFAULT_ALERT_STAGES
+        stages = sorted((AlertStage(stage) for stage in self.table), key=lambda stage: stage.lead_time)
+        if not stages:
+            raise ValueError('alert_stages is empty')
+        self._lead_times = [stage.lead_time for stage in stages]
+        if len(set(self._lead_times)) != len(self._lead_times):
+            raise ValueError('alert_stages has more than one stage with the same lead_time')
+        self._stages = stages
+
+    @property
+    def search_limit(self):
+        # how far ahead (minutes) the app needs to look for events
+        return self._lead_times[-1]
+
+    @property
+    def lead_times(self):
+        return self._lead_times
+
+    def prepare(self):
+        for stage in self._stages:
+            stage.prepare()
+
+    def get_stage(self, num_minutes):
+        # The stage for a meeting num_minutes (whole minutes) away, or None if it's too far away
+        index = bisect.bisect_right(self._lead_times, num_minutes)
+        return self._stages[index] if index < len(self._stages) else None
@@ -0,0 +1,100 @@
+###########################################################
+# App Logging Module
+#
+# Moves the work of logging off the app's threads. Log
+# calls just drop the record in a bounded in-memory queue,
+# and a listener thread formats it and writes it to the
+# console and the (rotating) log file, so a slow SD card
+# never holds up the main loop or a reminder. If the queue
+# fills up (the card has stopped writing, say), new records
+# are dropped and counted (the log_records_dropped metric)
+# instead of blocking.
+#
+# The log file is plain text by default; set log_format to
+# json in config.json for one JSON object per line, which
+# is easier for log tools to pick apart.
+###########################################################
+
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+import queue
+
+import metrics
+
+# the most records waiting to be written before new ones are dropped
+LOG_QUEUE_SIZE = 1000
+TEXT = 'text'
+JSON = 'json'
+
+_listener = None
+_file_handler = None
+_text_formatter = None
+
+
+class _BoundedQueueHandler(QueueHandler):
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment('log_records_dropped')
+
+    def prepare(self, record):
+        # the listener formats the record, on its own thread; only the exception (if any) has to be
+        # turned into text now, while it's still around
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'msg': record.getMessage()}
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry)
+
+
+def setup(log_file, format_str, date_format, level=logging.INFO, file_format=TEXT):
+    # Send all of the app's logging through the queue, to the console and to log_file (rolled at
+    # midnight, 7 copies kept). The root logger's level decides what gets logged; the file gets
+    # everything that does.
+    global _file_handler, _listener, _text_formatter
+
+    _text_formatter = logging.Formatter(format_str, datefmt=date_format)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(_text_formatter)
+    _file_handler = TimedRotatingFileHandler(log_file, when="midnight", backupCount=6)
+    _file_handler.setLevel(logging.DEBUG)
+    set_file_format(file_format)
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = QueueListener(log_queue, console_handler, _file_handler, respect_handler_level=True)
+    _listener.start()
+    logger = logging.getLogger()
+    logger.addHandler(_BoundedQueueHandler(log_queue))
+    logger.setLevel(level)
+
+
+def set_file_format(file_format):
+    # 'text' or 'json'
+    if _file_handler is None:
+        return
+    if file_format == JSON:
+        _file_handler.setFormatter(JsonFormatter(datefmt=_text_formatter.datefmt))
+    else:
+        _file_handler.setFormatter(_text_formatter)
+
+
+def stop():
+    # write everything still in the queue, then stop the listener thread
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,33 @@
+###########################################################
+# Atomic File module
+#
+# Writes a file by way of a temporary file in the same
+# folder: the data is flushed to disk, then the temporary
+# file is swapped in, so a crash or power cut never leaves
+# a half-written file behind. Every write gets a temporary
+# file of its own, so threads writing the same file at the
+# same time (the server's workers) can't overwrite each
+# other's temporary files.
+###########################################################
+
+import os
+import tempfile
+
+
+def write(path, data, mode=0o644):
+    # data is a string or bytes; mode is the new file's permissions
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                     prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
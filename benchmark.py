@@ -0,0 +1,170 @@
+#!/usr/bin/python
+"""*****************************************************************************************************************
+    Pi Remind HD Notify - Benchmarks
+
+    Measures how long the app's display code takes without the Unicorn HAT HD hardware attached. The in-memory
+    display backend stands in for the real one, so the benchmark runs on any system with numpy (and pillow)
+    installed. Also measures matching event summaries against large ignore lists.
+
+    Usage: python benchmark.py [path to a TTF font file]
+********************************************************************************************************************"""
+
+from __future__ import print_function
+
+import math
+import os
+import random
+import sys
+import time
+
+from display_backends import MemoryBackend
+
+# how many times to run each animation
+ITERATIONS = 5
+# the swirl duration the app uses when a meeting is a minute away
+SWIRL_DURATION = 150
+# how many times flash_all flashes (per iteration)
+FLASH_COUNT = 100
+# a typical meeting summary
+MESSAGE = 'Weekly team sync, Project review'
+# ignore list sizes to try, and the number of events (ticks x events per tick) to check against each one
+IGNORE_LIST_SIZES = (10, 100, 500)
+IGNORE_EVENTS = 20000
+
+
+def legacy_do_swirl(unicorn, hat, duration):
+    # The original pixel at a time swirl implementation, for comparison
+    width, height = unicorn.u_width, unicorn.u_height
+    step = 0
+    for i in range(duration):
+        for y in range(height):
+            for x in range(width):
+                xc = x - (width / 2)
+                yc = y - (height / 2)
+                dist = math.sqrt(pow(xc, 2) + pow(yc, 2)) / 2.0
+                angle = (step / 10.0) + (dist * 1.5)
+                s = math.sin(angle)
+                c = math.cos(angle)
+                r = abs((xc * c - yc * s) + (xc * s + yc * c)) * 12.0 - 20
+                g = r + (s * 130)
+                b = r + (c * 130)
+                hat.set_pixel(x, y, int(max(0, min(255, r))), int(max(0, min(255, g))), int(max(0, min(255, b))))
+        step += 2
+        hat.show()
+    hat.off()
+
+
+def legacy_display_text(unicorn, hat, message, color):
+    # The original text scrolling implementation (font loaded and pixels read one at a time), for comparison
+    from PIL import Image, ImageDraw, ImageFont
+    width, height = unicorn.u_width, unicorn.u_height
+    font_file, font_size = unicorn.FONT
+    font = ImageFont.truetype(font_file, font_size)
+    w, h = font.getbbox(message)[2:]
+    text_width = width + w + width + width + width + 1
+    image = Image.new("RGB", (text_width, max(16, h)), (0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    draw.text((width, 2), message, color, font=font)
+    for scroll in range(text_width - width):
+        for x in range(width):
+            for y in range(height):
+                pixel = image.getpixel((x + scroll, y))
+                r, g, b = [int(n) for n in pixel]
+                hat.set_pixel(width - 1 - x, y, r, g, b)
+        hat.show()
+    hat.off()
+
+
+def report(name, frames, skipped, elapsed):
+    print('{:<32} {:>8} frames {:>9.3f} s {:>10.1f} fps {:>6} unchanged (not sent)'.format(
+        name, frames, elapsed, frames / elapsed, skipped))
+
+
+def time_frames(hat, fn):
+    # run fn ITERATIONS times, returns the number of frames (shown or skipped because nothing
+    # changed), the number skipped, and the elapsed time
+    start_shown = hat.show_count
+    start_skipped = hat.skip_count
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        fn()
+    skipped = hat.skip_count - start_skipped
+    return hat.show_count - start_shown + skipped, skipped, time.perf_counter() - start
+
+
+def benchmark_flash(unicorn, hat):
+    report('flash_all', *time_frames(hat, lambda: unicorn.flash_all(FLASH_COUNT, 0, unicorn.WHITE)))
+    # the activity light ticking along while the app is idle
+    report('activity light', *time_frames(
+        hat, lambda: [unicorn.set_activity_light(unicorn.GREEN, i % 2 == 0) for i in range(FLASH_COUNT)]))
+
+
+def benchmark_swirl(unicorn, hat):
+    report('swirl (legacy, per pixel)', *time_frames(hat, lambda: legacy_do_swirl(unicorn, hat, SWIRL_DURATION)))
+    report('swirl (vectorized, no cache)', *time_frames(hat, lambda: unicorn.do_swirl(SWIRL_DURATION, False)))
+    report('swirl (vectorized, cached)', *time_frames(hat, lambda: unicorn.do_swirl(SWIRL_DURATION)))
+
+
+def benchmark_text(unicorn, hat):
+    if not os.path.exists(unicorn.FONT[0]):
+        print('Skipping text benchmarks, font file not found: {}'.format(unicorn.FONT[0]))
+        return
+    report('text (legacy, per pixel)', *time_frames(
+        hat, lambda: legacy_display_text(unicorn, hat, MESSAGE, unicorn.WHITE)))
+    report('text (cached strip)', *time_frames(hat, lambda: unicorn.display_text(MESSAGE, unicorn.WHITE)))
+
+
+def legacy_ignore_event(ignore_in_summary, event_summary):
+    # The original ignore list check (one substring search per keyword), for comparison
+    for key in ignore_in_summary:
+        if key in event_summary:
+            return True
+    return False
+
+
+def benchmark_ignore():
+    from ignore_matcher import IgnoreMatcher
+    words = ['sync', 'review', 'standup', 'lunch', 'planning', 'demo', '1:1', 'interview', 'retro', 'focus']
+    # the same few events show up tick after tick
+    events = [(str(i), 'updated', ' '.join(random.sample(words, 3))) for i in range(20)]
+    checks = [events[i % len(events)] for i in range(IGNORE_EVENTS)]
+    for size in IGNORE_LIST_SIZES:
+        patterns = ['[person {}]'.format(i) for i in range(size - 2)] + ['[block]', '(via clockwise)']
+        matcher = IgnoreMatcher(patterns)
+        start = time.perf_counter()
+        for event_id, updated, summary in checks:
+            legacy_ignore_event(patterns, summary)
+        legacy = time.perf_counter() - start
+        start = time.perf_counter()
+        for event_id, updated, summary in checks:
+            matcher.matches(summary)
+        compiled = time.perf_counter() - start
+        start = time.perf_counter()
+        for event_id, updated, summary in checks:
+            matcher.matches(summary, (event_id, updated))
+        memoized = time.perf_counter() - start
+        print('ignore list ({:>3} patterns)       legacy {:.4f} s, compiled {:.4f} s, memoized {:.4f} s'.format(
+            size, legacy, compiled, memoized))
+
+
+def main():
+    hat = MemoryBackend()
+    import unicorn_hat as unicorn
+    unicorn.init(hat)
+    # measure the work, not the sleep between frames
+    unicorn.SWIRL_DELAY = 0
+    unicorn.TEXT_DELAY = 0
+    if len(sys.argv) > 1:
+        unicorn.FONT = (sys.argv[1], unicorn.FONT[1])
+
+    print('Display benchmarks ({} iterations each)'.format(ITERATIONS))
+    benchmark_flash(unicorn, hat)
+    benchmark_swirl(unicorn, hat)
+    benchmark_text(unicorn, hat)
+
+    print('Ignore list benchmarks ({} event checks each)'.format(IGNORE_EVENTS))
+    benchmark_ignore()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+###########################################################
+# Calendar Event Module
+#
+# A compact representation of a Google Calendar event, with
+# only the properties the app uses. Start and end times are
+# parsed (to UTC) once, when the event arrives from the API,
+# instead of every time the app looks at the event.
+###########################################################
+
+from dateutil import parser
+import pytz
+
+
+class CalendarEvent(object):
+    __slots__ = ('id', 'summary', 'start', 'end', 'busy', 'has_reminder', 'updated')
+
+    def __init__(self, event_id, summary, start, end, busy=True, has_reminder=False, updated=None):
+        self.id = event_id
+        self.summary = summary
+        self.start = start
+        self.end = end
+        self.busy = busy
+        self.has_reminder = has_reminder
+        # when the event last changed (the string from the API, only used to tell versions apart)
+        self.updated = updated
+
+    def __repr__(self):
+        return 'CalendarEvent({}, {}, {} to {})'.format(self.id, self.summary, self.start, self.end)
+
+    def minutes_to_start(self, current_time):
+        # whole minutes from current_time (timezone aware) until the event starts
+        return (self.start - current_time).total_seconds() // 60
+
+    def to_dict(self):
+        # a JSON friendly version of the event, for saving it to disk
+        return {
+            'id': self.id,
+            'summary': self.summary,
+            'start': self.start.isoformat(),
+            'end': self.end.isoformat(),
+            'busy': self.busy,
+            'has_reminder': self.has_reminder,
+            'updated': self.updated}
+
+    @staticmethod
+    def from_dict(values):
+        # the opposite of to_dict()
+        return CalendarEvent(
+            values['id'],
+            values['summary'],
+            parser.parse(values['start']).astimezone(pytz.utc),
+            parser.parse(values['end']).astimezone(pytz.utc),
+            values.get('busy', True),
+            values.get('has_reminder', False),
+            values.get('updated'))
+
+    @staticmethod
+    def from_api(event):
+        # Builds a CalendarEvent from an event object returned by the Calendar API. Returns None for
+        # deleted events and events that don't have a start time (all day events), the app skips those.
+        if event.get('status') == 'cancelled':
+            return None
+        start = event.get('start', {}).get('dateTime')
+        end = event.get('end', {}).get('dateTime')
+        if not start or not end:
+            return None
+        return CalendarEvent(
+            event.get('id'),
+            CalendarEvent._get_summary(event),
+            parser.parse(start).astimezone(pytz.utc),
+            parser.parse(end).astimezone(pytz.utc),
+            # event is busy if transparency is missing from the event object
+            not event.get('transparency'),
+            CalendarEvent._has_reminder(event),
+            event.get('updated'))
+
+    @staticmethod
+    def _get_summary(event):
+        event_summary = event['summary'] if 'summary' in event else 'No Title'
+        # clockwise events have an icon in the start of the summary
+        # and that was causing an encoding error, so I added this to resolve it
+        return event_summary.encode('ascii', errors='ignore').decode('ascii').strip()
+
+    @staticmethod
+    def _has_reminder(event):
+        # Return true if there's a reminder set for the event
+        reminders = event.get('reminders', {})
+        # First, check to see if there is a default reminder set, then whether
+        # there are overrides set for reminders
+        return bool(reminders.get('useDefault') or reminders.get('overrides'))
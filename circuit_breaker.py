@@ -0,0 +1,94 @@
+###########################################################
+# Circuit Breaker Module
+#
+# Keeps the app from hammering a service (Google Calendar,
+# the Particle Cloud) that isn't answering. After a few
+# failures in a row the breaker opens and the app stops
+# making requests for a while, a little longer (with some
+# randomness, so devices don't all come back at once)
+# every time. When the wait is up the breaker lets one
+# request through (half open): if it works, the breaker
+# closes and things go back to normal, if not, the breaker
+# opens again for longer.
+###########################################################
+
+import logging
+import random
+
+import clock
+import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half open'
+# the states as numbers, for the metrics
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# open the breaker after this many failures in a row
+FAILURE_THRESHOLD = 3
+# how long to wait the first time the breaker opens (seconds), doubling every time it opens again
+# up to the maximum
+BASE_DELAY = 60
+MAX_DELAY = 900
+# the wait is up to this fraction longer or shorter, at random
+JITTER = 0.2
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 jitter=JITTER, metrics_prefix=None):
+        # metrics_prefix: tells this breaker's metrics apart from other breakers with the same name (the
+        # server has a calendar breaker for every user)
+        self.name = name
+        self._metrics_name = name if not metrics_prefix else '{}_{}'.format(metrics_prefix, name)
+        self._failure_threshold = failure_threshold
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._jitter = jitter
+        self.state = CLOSED
+        # failures in a row, and how many times in a row the breaker opened
+        self.failures = 0
+        self._opened = 0
+        # when the breaker lets the next request through (clock.time())
+        self.retry_at = 0
+        metrics.set_gauge(self._metrics_name + '_circuit_state', STATE_VALUES[self.state])
+
+    def allow(self):
+        # Can the app make a request now? When the breaker is open and the wait is up, this lets
+        # one request (the probe) through
+        if self.state == OPEN and clock.time() >= self.retry_at:
+            self._set_state(HALF_OPEN)
+        return self.state != OPEN
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logging.info('Circuit Breaker: {} is working again'.format(self.name))
+        self.failures = 0
+        self._opened = 0
+        self._set_state(CLOSED)
+
+    def record_failure(self):
+        # Returns True if the failure opened the breaker
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self._failure_threshold:
+            self._opened += 1
+            delay = min(self._base_delay * 2 ** (self._opened - 1), self._max_delay)
+            delay *= random.uniform(1 - self._jitter, 1 + self._jitter)
+            self.retry_at = clock.time() + delay
+            self._set_state(OPEN)
+            metrics.increment(self._metrics_name + '_circuit_opened')
+            logging.warning('Circuit Breaker: {} failed {} times, trying again in {:.0f} seconds'.format(
+                self.name, self.failures, delay))
+            return True
+        return False
+
+    def get_retry_delay(self):
+        # seconds until the breaker lets a request through
+        return max(0, self.retry_at - clock.time()) if self.state == OPEN else 0
+
+    def _set_state(self, state):
+        if state != self.state:
+            logging.debug('Circuit Breaker: %s is %s', self.name, state)
+            self.state = state
+            metrics.set_gauge(self._metrics_name + '_circuit_state', STATE_VALUES[state])
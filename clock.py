@@ -0,0 +1,99 @@
+###########################################################
+# Clock Module
+#
+# Everything in the app that needs to know what time it is,
+# or needs to sleep, asks this module instead of calling
+# time.time(), datetime.now() or time.sleep() directly.
+# Normally that's the system clock; the simulator
+# (simulate.py) swaps in a virtual clock that jumps ahead
+# instead of sleeping, so it can run through a week of
+# meetings in a few seconds.
+###########################################################
+
+import datetime
+import time as _time
+
+
+class SystemClock:
+
+    def time(self):
+        return _time.time()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        # wait for a threading.Event, returns True if it was set
+        return event.wait(timeout)
+
+    def sleep_until_set(self, event, seconds):
+        # sleep, unless the threading.Event is set first; returns True if it was set
+        return event.wait(seconds)
+
+
+class VirtualClock:
+    # A clock that only moves when someone sleeps (or calls advance())
+
+    def __init__(self, start):
+        # start is a time.time() value
+        self._now = float(start)
+
+    def time(self):
+        return self._now
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self._now += seconds
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, event, timeout):
+        # Used by the display animations, which run on their own thread in the app and don't hold
+        # up the main loop, so they don't move the clock either
+        return event.is_set()
+
+    def sleep_until_set(self, event, seconds):
+        # The main loop's sleep, which something else can cut short: the clock jumps ahead unless
+        # the event is already set
+        if not event.is_set():
+            self.advance(seconds)
+        return event.is_set()
+
+
+_clock = SystemClock()
+
+
+def set_clock(clock):
+    global _clock
+    _clock = clock
+
+
+def get_clock():
+    return _clock
+
+
+def time():
+    return _clock.time()
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+
+def wait(event, timeout):
+    return _clock.wait(event, timeout)
+
+
+def sleep_until_set(event, seconds):
+    return _clock.sleep_until_set(event, seconds)
+
+
+def now():
+    # local time (naive datetime), like datetime.datetime.now()
+    return datetime.datetime.fromtimestamp(_clock.time())
+
+
+def utcnow():
+    # UTC time (naive datetime), like datetime.datetime.utcnow()
+    return datetime.datetime.utcfromtimestamp(_clock.time())
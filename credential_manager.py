@@ -0,0 +1,142 @@
+###########################################################
+# Credential Manager Module
+#
+# Loads the Google Calendar API credentials (token.pickle),
+# running the OAuth flow the first time, then refreshes the
+# access token in the background a few minutes before it
+# expires. Without this, the token expires in the middle of
+# a calendar check, and that check pays for the trip to
+# Google's token endpoint.
+###########################################################
+
+import datetime
+import logging
+import os
+import pickle
+import threading
+import time
+
+import atomic_file
+
+# If modifying these scopes, delete the file `~/pi-remind-hd-notify/token.pickle`
+SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
+# The file token.pickle stores the user's access and refresh tokens, and is
+# created automatically when the authorization flow completes for the first
+# time.
+TOKEN_FILE = 'token.pickle'
+CLIENT_SECRETS_FILE = 'credentials.json'
+
+# refresh the access token this many seconds before it expires
+REFRESH_MARGIN = 300
+# if a refresh fails, try again after this many seconds
+RETRY_DELAY = 60
+# how long to wait when the credentials don't say when they expire (seconds)
+DEFAULT_WAIT = 1800
+
+
+class CredentialManager(threading.Thread):
+
+    def __init__(self, token_file=TOKEN_FILE, client_secrets_file=CLIENT_SECRETS_FILE, scopes=SCOPES):
+        threading.Thread.__init__(self, name='credentials')
+        self.daemon = True
+        self._token_file = token_file
+        self._client_secrets_file = client_secrets_file
+        self._scopes = scopes
+        self._creds = None
+        self._stop_event = threading.Event()
+        # metrics
+        self._refreshed_at = None
+        self._refresh_latency = None
+        self._refresh_count = 0
+        self._refresh_failures = 0
+
+    @property
+    def credentials(self):
+        return self._creds
+
+    def load(self, interactive=True):
+        # Load the saved credentials, refreshing them or asking the user to log in as needed. When
+        # interactive is False (nobody's there to log in), missing or revoked credentials raise an exception.
+        creds = None
+        if os.path.exists(self._token_file):
+            # logging.debug('Token file exists')
+            with open(self._token_file, 'rb') as token:
+                creds = pickle.load(token)
+        # If there are no (valid) credentials available, let the user log in.
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                self._creds = creds
+                self.refresh()
+            elif not interactive:
+                raise RuntimeError('No valid credentials in {}'.format(self._token_file))
+            else:
+                from google_auth_oauthlib.flow import InstalledAppFlow
+                flow = InstalledAppFlow.from_client_secrets_file(self._client_secrets_file, self._scopes)
+                self._creds = flow.run_local_server(port=0)
+                self._refreshed_at = time.time()
+                # Save the credentials for the next run
+                self._save()
+        else:
+            self._creds = creds
+        return self._creds
+
+    def refresh(self):
+        # Get a new access token (raises an exception if that fails)
+        from google.auth.transport.requests import Request
+        start = time.time()
+        try:
+            self._creds.refresh(Request())
+        except Exception:
+            self._refresh_failures += 1
+            raise
+        self._refresh_latency = time.time() - start
+        self._refreshed_at = time.time()
+        self._refresh_count += 1
+        logging.info('Credentials: Refreshed access token ({:.3f} seconds)'.format(self._refresh_latency))
+        self._save()
+
+    def refresh_if_needed(self):
+        # For when the background thread isn't running: refresh the access token if it's about to expire
+        seconds_to_expiry = self._seconds_to_expiry()
+        if seconds_to_expiry is not None and seconds_to_expiry < REFRESH_MARGIN:
+            self.refresh()
+
+    def get_metrics(self):
+        # token_age is the time since the token was last refreshed, refresh_latency the duration of
+        # the last refresh (both in seconds)
+        return {
+            'token_age': None if self._refreshed_at is None else time.time() - self._refreshed_at,
+            'seconds_to_expiry': self._seconds_to_expiry(),
+            'refresh_latency': self._refresh_latency,
+            'refresh_count': self._refresh_count,
+            'refresh_failures': self._refresh_failures}
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while True:
+            seconds_to_expiry = self._seconds_to_expiry()
+            wait = DEFAULT_WAIT if seconds_to_expiry is None else max(0, seconds_to_expiry - REFRESH_MARGIN)
+            if self._stop_event.wait(wait):
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                # the calendar check will still refresh the token itself if it has to
+                logging.error('Credentials: Unable to refresh the access token: {}'.format(e))
+                if self._stop_event.wait(RETRY_DELAY):
+                    return
+
+    def _seconds_to_expiry(self):
+        # credential expiry times are naive UTC datetimes
+        if self._creds is None or self._creds.expiry is None:
+            return None
+        return (self._creds.expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def _save(self):
+        # (only the user should be able to read the tokens)
+        try:
+            atomic_file.write(self._token_file, pickle.dumps(self._creds), mode=0o600)
+        except Exception as e:
+            logging.error('Credentials: Unable to save {}: {}'.format(self._token_file, e))
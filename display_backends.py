@@ -0,0 +1,216 @@
+###########################################################
+# Display Backends Module
+#
+# The things unicorn_hat.py can draw on. All of them have
+# the same methods as the unicornhathd module (set_pixel,
+# set_all, clear, show, off, etc.) plus a numpy frame
+# buffer (buf, indexed [x][y]) that whole frames are
+# copied into:
+#
+#   unicornhathd - the real Unicorn HAT HD
+#   memory       - an in-memory frame buffer (no hardware,
+#                  for benchmarks and headless systems)
+#   terminal     - draws every frame in the terminal
+#   png          - saves every frame to a PNG file
+#
+# Set display_backend in config.json to pick one.
+#
+# Every backend remembers the last frame it showed, and
+# show() does nothing when the frame buffer hasn't changed
+# since then, so the app only sends the HAT a new frame
+# (a 768 byte SPI transfer) when something is different.
+###########################################################
+
+import logging
+import os
+import sys
+
+import metrics
+import numpy
+
+# the default backend
+UNICORN_HAT_HD = 'unicornhathd'
+MEMORY = 'memory'
+TERMINAL = 'terminal'
+PNG = 'png'
+
+# the Unicorn HAT HD's size, used by the backends that don't have real hardware
+DEFAULT_WIDTH = 16
+DEFAULT_HEIGHT = 16
+# the PNG recorder scales each LED up to this many pixels square
+PNG_SCALE = 8
+
+
+class DisplayBackend:
+    # The common part of the backends: a frame buffer, the last frame shown, and counts of the
+    # frames shown and skipped. Subclasses send frames wherever they go in _write().
+
+    def __init__(self, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+        self.buf = numpy.zeros((width, height, 3), dtype=int)
+        self._brightness = 1.0
+        self._init_frames()
+
+    def _init_frames(self):
+        # a copy of the last frame shown (None until there is one)
+        self._shown = None
+        # how many frames have been shown, and skipped because nothing changed (used by the benchmarks)
+        self.show_count = 0
+        self.skip_count = 0
+
+    def get_shape(self):
+        return self.buf.shape[0], self.buf.shape[1]
+
+    def rotation(self, r):
+        pass
+
+    def brightness(self, b):
+        self._brightness = b
+        # the next frame has to go out, even if it's the same as the last one
+        self._shown = None
+
+    def set_pixel(self, x, y, r, g, b):
+        self.buf[int(x)][int(y)] = r, g, b
+
+    def set_all(self, r, g, b):
+        self.buf[:] = r, g, b
+
+    def clear(self):
+        self.buf.fill(0)
+
+    def show(self):
+        # Show the frame buffer, unless it's the same as the last frame shown
+        if self._shown is None:
+            self._shown = self.buf.copy()
+            dirty_rows = None
+        else:
+            # the rows (y values) that changed since the last frame
+            dirty_rows = (self.buf != self._shown).any(axis=(0, 2))
+            if not dirty_rows.any():
+                self.skip_count += 1
+                metrics.increment('display_frames_skipped')
+                return
+            self._shown[:] = self.buf
+        self._write(dirty_rows)
+        self.show_count += 1
+        metrics.increment('display_frames_shown')
+
+    def _write(self, dirty_rows):
+        # send the frame to the display; dirty_rows is a boolean array with one entry per row
+        # (True if the row changed), or None if the whole frame needs to be written
+        pass
+
+    def off(self):
+        self.clear()
+        self.show()
+
+    def close(self):
+        pass
+
+
+class UnicornHatBackend(DisplayBackend):
+    # The real thing. Writes go straight to the unicornhathd module's own buffer.
+
+    def __init__(self):
+        # only import the hardware module when we're actually using it
+        import unicornhathd
+        self._hat = unicornhathd
+        self._init_frames()
+
+    @property
+    def buf(self):
+        return self._hat._buf
+
+    def get_shape(self):
+        return self._hat.get_shape()
+
+    def rotation(self, r):
+        self._hat.rotation(r)
+        self._shown = None
+
+    def brightness(self, b):
+        self._hat.brightness(b)
+        self._shown = None
+
+    def set_pixel(self, x, y, r, g, b):
+        self._hat.set_pixel(x, y, r, g, b)
+
+    def set_all(self, r, g, b):
+        self._hat.set_all(r, g, b)
+
+    def clear(self):
+        self._hat.clear()
+
+    def _write(self, dirty_rows):
+        # the HAT only takes whole frames
+        self._hat.show()
+
+
+class MemoryBackend(DisplayBackend):
+    # An in-memory frame buffer, frames go nowhere. The last frame shown is kept in last_frame.
+
+    def __init__(self, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+        DisplayBackend.__init__(self, width, height)
+        self.last_frame = self.buf.copy()
+
+    def _write(self, dirty_rows):
+        self.last_frame[:] = self.buf
+
+
+class TerminalBackend(DisplayBackend):
+    # Draws each frame in the terminal using 24 bit color, redrawing in place
+
+    def __init__(self, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, stream=None):
+        DisplayBackend.__init__(self, width, height)
+        self._stream = stream or sys.stdout
+        self._drawn = False
+
+    def _write(self, dirty_rows):
+        # redraw only the rows that changed
+        width, height = self.get_shape()
+        frame = numpy.clip(self.buf * self._brightness, 0, 255).astype(int)
+        lines = []
+        if self._drawn:
+            # move the cursor back up to the top of the last frame
+            lines.append('\x1b[{}A'.format(height))
+        for y in range(height):
+            if self._drawn and dirty_rows is not None and not dirty_rows[y]:
+                # skip the row
+                lines.append('\x1b[1B')
+                continue
+            lines.append(''.join('\x1b[48;2;{};{};{}m  '.format(*frame[x][y]) for x in range(width)) + '\x1b[0m\n')
+        self._stream.write(''.join(lines))
+        self._stream.flush()
+        self._drawn = True
+
+
+class PngBackend(DisplayBackend):
+    # Saves each frame to a numbered PNG file in the record folder
+
+    def __init__(self, path, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+        DisplayBackend.__init__(self, width, height)
+        # pillow is slow to import, so only import it when the recorder is used
+        from PIL import Image
+        self._image = Image
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _write(self, dirty_rows):
+        # images are indexed by row, then column, so swap that around (and make each LED bigger)
+        frame = numpy.clip(self.buf * self._brightness, 0, 255).astype(numpy.uint8).transpose(1, 0, 2)
+        frame = frame.repeat(PNG_SCALE, axis=0).repeat(PNG_SCALE, axis=1)
+        self._image.fromarray(frame, 'RGB').save(
+            os.path.join(self._path, 'frame_{:06d}.png'.format(self.show_count)))
+
+
+def create_backend(name=UNICORN_HAT_HD, record_path='frames'):
+    # Returns the backend for the display_backend setting
+    logging.info('Display: Using the {} display backend'.format(name))
+    if name == UNICORN_HAT_HD:
+        return UnicornHatBackend()
+    if name == MEMORY:
+        return MemoryBackend()
+    if name == TERMINAL:
+        return TerminalBackend()
+    if name == PNG:
+        return PngBackend(record_path)
+    raise ValueError('Unknown display backend: {}'.format(name))
@@ -0,0 +1,122 @@
+###########################################################
+# Display Engine Module
+#
+# Runs all of the Unicorn HAT HD updates on a dedicated
+# thread so the calendar and Particle Cloud work never waits
+# for an animation to finish. Display jobs (a list of
+# unicorn_hat function calls run in sequence) go into a
+# priority queue; a newer, more urgent job drops any stale
+# jobs still in the queue and interrupts the running one.
+###########################################################
+
+import itertools
+import logging
+import queue
+import sys
+import threading
+
+import metrics
+import unicorn_hat as unicorn
+
+# Job priorities (lower numbers run first)
+PRIORITY_URGENT = 0  # the meeting is about to start
+PRIORITY_REMINDER = 1  # regular reminders
+PRIORITY_STATUS = 2  # activity light updates
+
+# how long to wait for the display thread to finish when the app stops (seconds)
+STOP_TIMEOUT = 5
+
+_engine = None
+
+
+class DisplayEngine(threading.Thread):
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='display')
+        self.daemon = True
+        self._queue = queue.PriorityQueue()
+        # orders jobs with the same priority (first in, first out)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        # jobs at each priority level with a sequence number below this value are stale
+        self._stale_before = {}
+        # priority of the job running right now (None when idle)
+        self._running_priority = None
+
+    def submit(self, priority, steps, preempt=False):
+        # steps is a list of (function, args) tuples. When preempt is True, the job replaces
+        # any queued jobs at the same or lower priority and interrupts the running job if it
+        # isn't more urgent than this one.
+        with self._lock:
+            seq = next(self._counter)
+            if preempt:
+                for level in range(priority, PRIORITY_STATUS + 1):
+                    self._stale_before[level] = seq
+                if self._running_priority is not None and self._running_priority >= priority:
+                    unicorn.interrupt()
+            self._queue.put((priority, seq, steps))
+
+    def stop(self):
+        # drop everything, stop the running animation and tell the thread to exit
+        with self._lock:
+            self._stale_before = dict.fromkeys(range(PRIORITY_STATUS + 1), sys.maxsize)
+            unicorn.interrupt()
+            self._queue.put((-1, next(self._counter), None))
+
+    def run(self):
+        while True:
+            priority, seq, steps = self._queue.get()
+            if steps is None:
+                return
+            with self._lock:
+                if seq < self._stale_before.get(priority, 0):
+                    logging.debug('Display: Dropping stale job')
+                    continue
+                self._running_priority = priority
+                unicorn.clear_interrupt()
+            try:
+                for fn, args in steps:
+                    # skip the rest of the job if a newer one interrupted it
+                    if unicorn.interrupted():
+                        break
+                    _run_step(fn, args)
+            except Exception as e:
+                # a display problem shouldn't take down the display thread
+                logging.error('Display: Error running job: {}'.format(e))
+            finally:
+                with self._lock:
+                    self._running_priority = None
+
+
+def start():
+    global _engine
+    if _engine is None:
+        _engine = DisplayEngine()
+        _engine.start()
+
+
+def stop():
+    global _engine
+    if _engine is not None:
+        _engine.stop()
+        _engine.join(STOP_TIMEOUT)
+        _engine = None
+
+
+def submit(priority, steps, preempt=False):
+    # Queue a display job, or run it right away if the display thread isn't running
+    if _engine is None:
+        for fn, args in steps:
+            _run_step(fn, args)
+    else:
+        _engine.submit(priority, steps, preempt)
+
+
+def _run_step(fn, args):
+    # time each animation separately (display_flash_all, display_do_swirl, etc.)
+    with metrics.timer('display_' + fn.__name__):
+        fn(*args)
+
+
+def set_activity_light(color, increment):
+    submit(PRIORITY_STATUS, [(unicorn.set_activity_light, (color, increment))])
@@ -0,0 +1,171 @@
+###########################################################
+# Event Cache Module
+#
+# Keeps a local copy of a calendar's upcoming events. The
+# cache is seeded once with a wide time window, then kept
+# fresh using the Calendar API's incremental sync (sync
+# tokens) so each refresh only downloads what changed since
+# the last one. The calendar service is passed in, so the
+# sync engine works just as well with a recorded or fake
+# service object.
+#
+# The Google API client isn't thread safe, so a cache that
+# syncs on its own thread gets its own http object.
+###########################################################
+
+from calendar_event import CalendarEvent
+import clock
+import datetime
+import logging
+import metrics
+import pytz
+
+# How many days ahead the initial (full) sync loads events for
+SEED_DAYS = 7
+# How often to throw the cache away and re-seed it. The seed window is fixed when
+# the cache is seeded, so this keeps the window moving forward with time.
+RESEED_HOURS = 24
+# The Calendar API returns this status code when a sync token is no longer valid
+SYNC_TOKEN_EXPIRED = 410
+# Only ask for the parts of the event the app uses, the rest (descriptions, attendee lists,
+# attachments, etc.) can be a lot of data
+EVENT_FIELDS = 'nextPageToken,nextSyncToken,items(id,status,updated,summary,start,end,transparency,reminders)'
+
+
+class EventCache:
+
+    def __init__(self, service, calendar_id='primary', seed_days=SEED_DAYS, http=None):
+        self._service = service
+        self._calendar_id = calendar_id
+        self._http = http
+        self._seed_days = seed_days
+        # CalendarEvent objects indexed by event ID
+        self._events = {}
+        self._sync_token = None
+        self._seeded_at = None
+        # whether the cache has any data (from a sync or a saved schedule)
+        self._ready = False
+
+    def sync(self):
+        # Bring the cache up to date with the calendar, returns the number of
+        # event changes received from the API
+        now = clock.utcnow()
+        if self._sync_token is None or now - self._seeded_at > datetime.timedelta(hours=RESEED_HOURS):
+            return self._full_sync(now)
+        try:
+            return self._incremental_sync()
+        except Exception as e:
+            # a stale sync token means we have to start over, anything else is a real error
+            if getattr(getattr(e, 'resp', None), 'status', None) == SYNC_TOKEN_EXPIRED:
+                logging.info('Event Cache: Sync token expired, re-seeding the cache')
+                return self._full_sync(now)
+            raise
+
+    def set_service(self, service, http=None):
+        # use a new calendar service (and http object) from now on
+        self._service = service
+        self._http = http
+
+    @property
+    def calendar_id(self):
+        return self._calendar_id
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def get_state(self):
+        # Everything needed to pick up where the cache left off (after a restart), as a JSON
+        # friendly dictionary. This includes all of the cached events, the sync token only
+        # reports changes, so a partial list of events would never fill back in.
+        return {
+            'sync_token': self._sync_token,
+            'seeded_at': self._seeded_at.isoformat(timespec='microseconds') if self._seeded_at else None,
+            'events': [event.to_dict() for event in self._events.values()]}
+
+    def load_state(self, state):
+        # Load the state saved by get_state(), the app uses these events until the next successful
+        # sync, which only asks for the changes since the state was saved
+        for values in state.get('events', []):
+            event = CalendarEvent.from_dict(values)
+            self._events[event.id] = event
+        if state.get('sync_token') and state.get('seeded_at'):
+            self._sync_token = state['sync_token']
+            self._seeded_at = datetime.datetime.strptime(state['seeded_at'], '%Y-%m-%dT%H:%M:%S.%f')
+        self._prune()
+        self._ready = True
+
+    def get_events(self, time_min, time_max):
+        # Return the cached events (CalendarEvent objects) that overlap the time_min to
+        # time_max window (the same events an events().list call for the window would
+        # return), sorted by start time. Both values must be timezone aware.
+        result = [event for event in self._events.values() if event.end > time_min and event.start < time_max]
+        result.sort(key=lambda event: event.start)
+        return result
+
+    def get_event_times(self, time_min, time_max):
+        # Return (start, end) tuples for the cached events that overlap the window
+        return [(event.start, event.end) for event in self.get_events(time_min, time_max)]
+
+    def _full_sync(self, now):
+        logging.info('Event Cache: Seeding the cache ({} days)'.format(self._seed_days))
+        then = now + datetime.timedelta(days=self._seed_days)
+        events = {}
+        items, sync_token = self._list_events(
+            timeMin=now.isoformat() + 'Z',
+            timeMax=then.isoformat() + 'Z')
+        for event in items:
+            self._update_event(events, event)
+        # only swap the new events in after everything downloaded successfully
+        self._events = events
+        self._sync_token = sync_token
+        self._seeded_at = now
+        self._ready = True
+        logging.info('Event Cache: Seeded with {} events'.format(len(self._events)))
+        return len(items)
+
+    def _incremental_sync(self):
+        logging.debug('Event Cache: Incremental sync')
+        items, sync_token = self._list_events(syncToken=self._sync_token)
+        for event in items:
+            self._update_event(self._events, event)
+        self._sync_token = sync_token
+        self._prune()
+        logging.debug('Event Cache: %s changes, %s events cached', len(items), len(self._events))
+        return len(items)
+
+    def _list_events(self, **kwargs):
+        # Page through an events().list request, returns all of the items along with
+        # the sync token for the next incremental sync
+        items = []
+        page_token = None
+        while True:
+            request = self._service.events().list(
+                calendarId=self._calendar_id,
+                singleEvents=True,
+                pageToken=page_token,
+                fields=EVENT_FIELDS,
+                **kwargs)
+            with metrics.timer('calendar_list'):
+                events_result = request.execute() if self._http is None else request.execute(http=self._http)
+            items.extend(events_result.get('items', []))
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                return items, events_result.get('nextSyncToken')
+
+    @staticmethod
+    def _update_event(events, event):
+        # apply a single event (or event change) to the events dictionary
+        calendar_event = CalendarEvent.from_api(event)
+        # deleted events come back with a status of cancelled; the app also skips
+        # events without a start time (all day events), so no need to keep those
+        if calendar_event is None:
+            events.pop(event.get('id'), None)
+        else:
+            events[calendar_event.id] = calendar_event
+
+    def _prune(self):
+        # drop events that have already ended
+        now = pytz.utc.localize(clock.utcnow())
+        for event_id in [key for key, event in self._events.items() if event.end <= now]:
+            del self._events[event_id]
@@ -0,0 +1,77 @@
+###########################################################
+# Free/Busy Module
+#
+# Asks the Calendar API's freebusy endpoint when the user is
+# busy. The response only contains busy time ranges (no
+# event details), so it's a lot smaller and quicker to
+# parse than the full event list. All of the app's calendars
+# are checked with a single request.
+#
+# Busy times are all the app knows about in this mode, and
+# that costs some reminders: Google merges busy times that
+# overlap or touch, so a meeting that starts as (or before)
+# another one ends doesn't get reminders of its own, and
+# free (transparent) events don't show up at all, so they
+# get no reminders and never make the status tentative.
+###########################################################
+
+from dateutil import parser
+import datetime
+import logging
+import pytz
+
+import clock
+import metrics
+
+# How far ahead to ask for busy times (minutes). This needs to cover the app's search limit; the
+# busy times are tiny, so ask for a whole day so reminders keep working if the network goes down
+FREE_BUSY_WINDOW = 24 * 60
+
+
+class FreeBusy:
+
+    def __init__(self, service, calendar_ids, window=FREE_BUSY_WINDOW):
+        self._service = service
+        self._calendar_ids = calendar_ids
+        self._window = window
+        # (start, end) tuples for the busy time ranges, sorted by start time
+        self._busy = []
+        # whether we've received any busy times yet
+        self._ready = False
+
+    def set_service(self, service):
+        self._service = service
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def query(self):
+        # Refresh the list of busy times, returns the number of busy time ranges that were added or removed
+        now = clock.utcnow()
+        then = now + datetime.timedelta(minutes=self._window)
+        body = {
+            'timeMin': now.isoformat() + 'Z',
+            'timeMax': then.isoformat() + 'Z',
+            'items': [{'id': calendar_id} for calendar_id in self._calendar_ids]}
+        with metrics.timer('calendar_freebusy'):
+            result = self._service.freebusy().query(body=body).execute()
+        busy = []
+        for calendar_id, calendar in result.get('calendars', {}).items():
+            # errors are reported per calendar (a calendar the user can't see, for example)
+            for error in calendar.get('errors', []):
+                logging.error('Free/Busy: {}: {}'.format(calendar_id, error.get('reason')))
+            for busy_time in calendar.get('busy', []):
+                busy.append((parser.parse(busy_time['start']), parser.parse(busy_time['end'])))
+        busy.sort()
+        # busy times that are over don't count as changes
+        now = pytz.utc.localize(now)
+        changes = len(set(busy).symmetric_difference(busy_time for busy_time in self._busy if busy_time[1] > now))
+        self._busy = busy
+        self._ready = True
+        logging.debug('Free/Busy: %s busy time ranges (%s changes)', len(busy), changes)
+        return changes
+
+    def get_busy_times(self, time_min, time_max):
+        # Return (start, end) tuples for the busy times that overlap the time_min to time_max window
+        return [busy for busy in self._busy if busy[1] > time_min and busy[0] < time_max]
@@ -2,17 +2,29 @@
 # Calendar Module
 #
 # Exposes properties and methods for the Google Calendar
-# This isn't a Singleton because the app will never try
-# to load more than one instance of the class.
+# This isn't a Singleton: the app only ever loads one
+# instance of the class, but the server (server.py) loads
+# one for each user.
 ###########################################################
 
 # This project's imports (local modules)
+import atomic_file
+from circuit_breaker import CircuitBreaker
+import clock
+from credential_manager import CredentialManager, TOKEN_FILE
+import display_engine as display
+from event_cache import EventCache
+from free_busy import FreeBusy
+import metrics
 from settings import *
+from state_store import StateStore
 from status import Status
 import unicorn_hat as unicorn
+from watch_channels import WatchChannels
 
 # other modules
-from dateutil import parser
+from concurrent.futures import ThreadPoolExecutor
+import heapq
 import json
 import logging
 import os
@@ -24,16 +36,19 @@ import traceback
 
 # Google Calendar libraries
 import datetime
-import pickle
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-
-reboot_counter = 0
+from googleapiclient.discovery import build, build_from_document
+# The extra http objects used for multiple calendars are only needed some of the time, so
+# the (slow to import) modules behind them are imported when needed
 
 # Initialize the Google Calendar API stuff
-# If modifying these scopes, delete the file `~/pi-remind-hd-notify/token.pickle`
-SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
+# A saved copy of the Calendar API's discovery document (describes the API to the client library).
+# Delete the file to have the app save a fresh copy the next time it starts.
+DISCOVERY_FILE = 'discovery.json'
+
+# The app keeps working from the events it already knows about when it can't reach Google. The
+# events (and sync tokens) are kept in the state store, so that works across restarts too. Update
+# them whenever they change, and at least this often (seconds) so old events drop off.
+STATE_SAVE_INTERVAL = 3600
 
 
 class GoogleCalendar:
@@ -44,113 +59,217 @@ class GoogleCalendar:
     # successful.
     _has_error = False
 
-    def __init__(self):
+    def __init__(self, service=None, settings=None, state=None, token_file=TOKEN_FILE, headless=False, name=None):
+        # service: a calendar service to use instead of connecting to Google (the simulator uses this)
+        # settings: a function that returns the current settings snapshot (the app's settings by default)
+        # state: the state store to use (the app's by default)
+        # headless: used by the server, which runs many calendars on a shared worker pool. The calendar
+        #   doesn't touch the display, never reboots, refreshes the access token when it's about to expire
+        #   (rather than on a thread of its own) and syncs its calendars one after the other.
+        # name: whose calendar this is (the server's user name), added to the names of the calendar's
+        #   circuit breaker metrics so every user gets their own
 
         # Populate the local properties
         logging.info('Calendar Initialization')
-        settings = Settings.get_instance()
-        self._busy_only = settings.get_busy_only()
+        if settings is None:
+            Settings.get_instance()
+            settings = Settings.get_snapshot
+        self._get_settings = settings
+        self._headless = headless
+        # the settings snapshot the calendar is using (see _check_settings())
+        self._settings = None
+        self._apply_settings(settings())
+
+        # Turn off logging of specific warnings
+        logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
+
+        self._credentials = None
+        if service is None:
+            # load the credentials (logging in if needed), then keep them fresh in the background
+            self._credentials = CredentialManager(token_file)
+            creds = self._credentials.load(interactive=not headless)
+            if not headless:
+                self._credentials.start()
+            logging.debug('Initializing calendar service')
+            self._service = self._build_service(creds)
+        else:
+            self._service = service
+        # a local copy of each calendar, kept up to date using incremental sync
+        self._calendars = self._settings.calendars
+        logging.info('Calendar: Calendars: {}'.format(self._calendars))
+        self._executor = None
+        if len(self._calendars) > 1 and self._credentials is not None and not headless:
+            # the calendars sync in parallel, so each cache gets its own http object (see _build_http())
+            self._executor = ThreadPoolExecutor(max_workers=len(self._calendars))
+        self._caches = [EventCache(self._service, calendar_id, http=self._build_http())
+                        for calendar_id in self._calendars]
+        # Free/busy mode: when the app doesn't need meeting summaries, it only asks Google when the user
+        # is busy (a much smaller response) instead of downloading the events themselves
+        self._free_busy = None
+        if self._uses_free_busy(self._settings):
+            logging.info('Calendar: Using free/busy mode')
+            if self._busy_only or self._ignore_in_summary or self._reminder_only:
+                logging.warning('Calendar: Free/busy mode ignores busy_only, ignore_in_summary and reminder_only')
+            logging.info('Calendar: Free/busy mode only reminds about the start of each busy time (back to back '
+                         'meetings count as one), and not about free events')
+            self._free_busy = FreeBusy(self._service, self._calendars)
+        # pick up where the last run left off
+        self._state = state if state is not None else StateStore.get_instance()
+        self._state_saved = 0
+        # consecutive failed calendar checks (see _report_error())
+        self._reboot_counter = 0
+        # stops the app asking Google for changes during an outage, then lets it try again now and then
+        self._breaker = CircuitBreaker('calendar', metrics_prefix=name)
+        # whether the app reconnected to Google (see _reconnect()) since the last successful sync
+        self._reconnected = False
+        # the number of changes the last sync found (None if it failed)
+        self._last_changes = None
+        # the channels Google posts change notifications to (see watch())
+        self._watch_channels = None
+        self._load_state()
+        # Set the timeout for the rest of the Google API calls.
+        # need this at its default (infinity, i think) during the registration process.
+        socket.setdefaulttimeout(5)  # seconds
+
+    def _apply_settings(self, settings):
+        # Use the settings from the settings snapshot; the calendars and free/busy mode can't
+        # change without a restart, everything else takes effect on the next calendar check
+        if self._settings is not None:
+            if settings.calendars != self._settings.calendars or \
+                    self._uses_free_busy(settings) != self._uses_free_busy(self._settings):
+                logging.warning('Calendar: Restart the app to change the calendars or free/busy mode')
+        self._settings = settings
+        self._busy_only = settings.busy_only
         logging.info('Calendar: Busy Only: {}'.format(self._busy_only))
-        self._ignore_in_summary = settings.get_ignore_in_summary()
+        self._ignore_in_summary = settings.ignore_in_summary
         logging.info('Calendar: Ignore in Summary: {}'.format(self._ignore_in_summary))
-        self._reminder_only = settings.get_reminder_only()
+        self._ignore_matcher = settings.ignore_matcher
+        self._reminder_only = settings.reminder_only
         logging.info('Calendar: Reminder Only: {}'.format(self._reminder_only))
-        self._use_reboot_counter = settings.get_use_reboot_counter()
+        self._use_reboot_counter = settings.use_reboot_counter
         logging.info('Calendar: Reboot Counter: {}'.format(self._use_reboot_counter))
         if self._use_reboot_counter:
-            self._reboot_counter_limit = settings.get_reboot_counter_limit()
+            self._reboot_counter_limit = settings.reboot_counter_limit
             logging.info('Calendar: Reboot Counter Limit: {}'.format(self._reboot_counter_limit))
-        self._use_work_hours = settings.get_use_working_hours()
+        self._use_work_hours = settings.use_working_hours
         logging.info('Calendar: Use Work Hours: {}'.format(self._use_work_hours))
         if self._use_work_hours:
-            self._work_start = settings.get_work_start()
-            self._work_end = settings.get_work_end()
+            self._work_start = settings.work_start
+            self._work_end = settings.work_end
             logging.info('Work hours: {} to {}'.format(self._work_start, self._work_end))
 
-        # Turn off logging of specific warnings
-        logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
+    def _check_settings(self):
+        # pick up a new settings snapshot (the app reloads config.json when it changes)
+        settings = self._get_settings()
+        if settings.version != self._settings.version:
+            logging.info('Calendar: Applying new settings')
+            self._apply_settings(settings)
 
-        creds = None
-        # The file token.pickle stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first
-        # time.
-        if os.path.exists('token.pickle'):
-            # logging.debug('Token file exists')
-            with open('token.pickle', 'rb') as token:
-                creds = pickle.load(token)
-        # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-                creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open('token.pickle', 'wb') as token:
-                pickle.dump(creds, token)
-        logging.debug('Initializing calendar service')
-        self._service = build('calendar', 'v3', credentials=creds)
-        # Set the timeout for the rest of the Google API calls.
-        # need this at its default (infinity, i think) during the registration process.
-        socket.setdefaulttimeout(5)  # seconds
+    @staticmethod
+    def _uses_free_busy(settings):
+        return settings.use_free_busy and not settings.display_meeting_summary
 
     @staticmethod
-    def _is_marked_busy(event):
-        logging.debug('_is_marked_busy(event)')
-        # event is busy if transparency is missing from the event object
+    def _build_service(creds):
+        # Build the service from the saved copy of the discovery document, this skips fetching (or
+        # finding and parsing the client library's copy of) the document every time the app starts
+        if os.path.exists(DISCOVERY_FILE):
+            try:
+                with open(DISCOVERY_FILE) as discovery_file:
+                    return build_from_document(discovery_file.read(), credentials=creds)
+            except Exception as e:
+                logging.error('Calendar: Unable to use the saved discovery document: {}'.format(e))
+        service = build('calendar', 'v3', credentials=creds)
         try:
-            if event['transparency']:
-                logging.debug('Not busy')
-                return False
-            else:
-                logging.debug('Busy')
-                return True
-        except KeyError:
-            logging.debug('Busy')
-            return True
+            atomic_file.write(DISCOVERY_FILE, json.dumps(service._rootDesc))
+        except Exception as e:
+            logging.error('Calendar: Unable to save the discovery document: {}'.format(e))
+        return service
 
-    @staticmethod
-    def _has_reminder(event):
-        logging.debug('_has_reminder()')
-        # Return true if there's a reminder set for the event
-        # First, check to see if there is a default reminder set
-        # Yes, I know I could have done this and the next check without using variables
-        # this approach just makes the code easier to understand
-        has_default_reminder = event['reminders'].get('useDefault')
-        if has_default_reminder:
-            # if yes, then we're good
-            return True
-        else:
-            # are there overrides set for reminders?
-            # overrides = event['reminders'].get('overrides')
-            # if overrides:
-            if event['reminders'].get('overrides'):
-                # OK, then we have a reminder to use
-                return True
-        # if we got this far, then there must not be a reminder set
-        return False
+    def _build_http(self):
+        # The http object for a cache: None (use the service's own) unless the caches sync in parallel
+        if self._executor is None:
+            return None
+        from google_auth_httplib2 import AuthorizedHttp
+        import httplib2
+        return AuthorizedHttp(self._credentials.credentials, http=httplib2.Http())
+
+    def _reconnect(self):
+        # Soft recovery, before the app even thinks about rebooting: get a new access token, then
+        # replace the calendar service and http objects (and with them, any broken connections)
+        self._reconnected = True
+        if self._credentials is None:
+            # somebody else's service (the simulator's), nothing to rebuild
+            return
+        logging.warning('Calendar: Reconnecting to Google')
+        metrics.increment('calendar_reconnects')
+        try:
+            self._credentials.refresh()
+            self._service = self._build_service(self._credentials.credentials)
+            for cache in self._caches:
+                cache.set_service(self._service, self._build_http())
+        except Exception as e:
+            logging.error('Calendar: Unable to reconnect to Google: {}'.format(e))
+            return
+        if self._free_busy is not None:
+            self._free_busy.set_service(self._service)
+        if self._watch_channels is not None:
+            self._watch_channels.set_service(self._service)
+
+    def get_credential_metrics(self):
+        return self._credentials.get_metrics() if self._credentials is not None else {}
 
-    def ignore_event(self, event_summary):
+    def watch(self, address):
+        # Have Google post a notification to address whenever one of the calendars changes (see
+        # watch_channels.py and push_receiver.py)
+        self._watch_channels = WatchChannels(self._service, self._calendars, address, self._state)
+        self._watch_channels.renew()
+
+    def is_watching(self):
+        # are change notifications coming in for all of the calendars?
+        return self._watch_channels is not None and self._watch_channels.active
+
+    def get_watched_calendar(self, channel_id, token):
+        # The calendar a change notification is about, or None if it isn't from one of the calendar's
+        # channels (called on the push receiver's thread)
+        if self._watch_channels is None:
+            return None
+        return self._watch_channels.get_calendar_id(channel_id, token)
+
+    def get_last_changes(self):
+        return self._last_changes
+
+    def has_error(self):
+        # did the last calendar check fail?
+        return self._has_error
+
+    def stop(self):
+        # stop the background token refresh
+        if self._credentials is not None:
+            self._credentials.stop()
+
+    def ignore_event(self, event_summary, event_key=None):
         logging.debug('ignore_event()')
-        # Do we have any strings to ignore?
-        if len(self._ignore_in_summary) > 0:
-            # loop through the ignore list
-            for key in self._ignore_in_summary:
-                # see if the ignore keyword is in the lower case summary
-                if key in event_summary:
-                    logging.debug('Ignoring this event')
-                    return True
-            return False
-        else:
-            return False
+        # see if any of the ignore keywords are in the lower case summary (the ignore list
+        # is compiled into a single matcher, which remembers the result for event_key)
+        if self._ignore_matcher.matches(event_summary, event_key):
+            logging.debug('Ignoring this event')
+            return True
+        return False
 
     def _is_working_hours(self, event):
-        logging.debug('_is_working_hours({})'.format(event))
+        logging.debug('_is_working_hours(%s)', event)
         event_time = event.time()
-        logging.debug('Event Time: {}'.format(event_time))
+        logging.debug('Event Time: %s', event_time)
         # is the current time within working hours?
         return self._work_start < event_time < self._work_end
 
+    def is_work_time(self, now):
+        # is now (local time) during working hours on a weekday? Always True if working hours are disabled
+        if not self._use_work_hours:
+            return True
+        return self._is_working_hours(now) and now.weekday() < 5
+
     @staticmethod
     def merge_status(current, new):
         # Return the lowest status > 0 (1 busy, 2 tentative, 3 free)
@@ -160,60 +279,236 @@ class GoogleCalendar:
             return min(current, new)
 
     @staticmethod
-    def get_event_summary(event):
-        event_summary = event['summary'] if 'summary' in event else 'No Title'
-        # clockwise events have an icon in the start of the summary
-        # and that was causing an encoding error, so I added this to resolve it
-        event_summary = event_summary.encode('ascii', errors='ignore').strip()
-        return event_summary
-
-    @staticmethod
-    def _process_upcoming_event(event, start, time_delta):
-        logging.debug('_process_upcoming_event(event, {}, {})'.format(start, time_delta))
-        event_summary = GoogleCalendar.get_event_summary(event)
-        logging.info('Found event: {}'.format(event_summary))
-        logging.info('Event starts: {}'.format(start))
-        new_event = {
-            'summary': event_summary,
-            'minutes_to_start': time_delta.total_seconds() // 60}
-        return new_event
-
-    @staticmethod
-    def _process_upcoming_events(event_list, time_window):
-        logging.debug('_process_upcoming_events(event_list, {})'.format(time_window))
+    def _process_upcoming_events(event_list, time_window, current_time):
+        logging.debug('_process_upcoming_events(event_list, %s)', time_window)
         summary_list = []
         nearest_time = time_window
         for event in event_list:
-            summary_list.append(GoogleCalendar.get_event_summary(event))
-            # summary_list.append(event['summary'] if 'summary' in event else 'No Title')
+            summary_list.append(event.summary)
             # find the nearest (soonest) meeting time
-            nearest_time = min(nearest_time, event['minutes_to_start'])
+            nearest_time = min(nearest_time, event.minutes_to_start(current_time))
         return nearest_time, ', '.join(summary_list)
 
-    def get_status(self, time_window):
-        logging.debug('get_status({})'.format(time_window))
+    def _sync_calendars(self):
+        # bring all of the event caches up to date, at the same time; returns the number of changes.
+        # A calendar that can't be synced (a bad calendar ID, say) doesn't hold up the others, it's
+        # only an error when none of them sync.
+        if self._free_busy is not None:
+            return self._free_busy.query()
+        elif self._executor is None:
+            results = [self._sync_cache(cache) for cache in self._caches]
+        else:
+            results = list(self._executor.map(self._sync_cache, self._caches))
+        errors = [result for result in results if isinstance(result, Exception)]
+        if len(errors) == len(results):
+            raise errors[0]
+        return sum(result for result in results if not isinstance(result, Exception))
+
+    @staticmethod
+    def _sync_cache(cache):
+        # sync one calendar, returns the number of changes (or the exception, if it failed)
+        try:
+            return cache.sync()
+        except Exception as e:
+            metrics.increment('calendar_errors')
+            logging.error('Calendar: Unable to sync {}: {}'.format(cache.calendar_id, e))
+            return e
+
+    def _has_schedule(self):
+        # do we have any calendar data to work with (even if it's out of date)?
+        if self._free_busy is not None:
+            return self._free_busy.ready
+        return any(cache.ready for cache in self._caches)
+
+    def _load_state(self):
+        # Load the events and sync tokens saved by the last run, so the app can remind the user about
+        # meetings right away (even if it can't reach Google right now) and the first sync only asks
+        # for the changes since then
+        self._reboot_counter = self._state.get('reboot_counter', 0)
+        if self._free_busy is not None:
+            return
+        calendars = self._state.get('calendars', {})
+        for cache in self._caches:
+            if cache.calendar_id in calendars:
+                try:
+                    cache.load_state(calendars[cache.calendar_id])
+                    logging.info('Calendar: Loaded saved events for {}'.format(cache.calendar_id))
+                except Exception as e:
+                    logging.error('Calendar: Unable to load saved events for {}: {}'.format(cache.calendar_id, e))
+
+    def _save_state(self, changes):
+        # Update the saved events whenever they change and every once in a while anyway (so old
+        # events drop off); the app writes the state store to disk at the end of each pass
+        if self._free_busy is not None:
+            return
+        if changes < 1 and clock.time() - self._state_saved < STATE_SAVE_INTERVAL:
+            return
+        self._state.set('calendars', {cache.calendar_id: cache.get_state() for cache in self._caches if cache.ready})
+        self._state_saved = clock.time()
+
+    def _refresh(self):
+        # ask Google for any changes to the calendar entries, returns False if that didn't work
+        if not self._breaker.allow():
+            # Google's been failing, leave it alone for a while (the app keeps going with the events it has)
+            logging.info('Calendar: Not asking Google for changes for another {:.0f} seconds'.format(
+                self._breaker.get_retry_delay()))
+            self._last_changes = None
+            return False
+        try:
+            if self._headless and self._credentials is not None:
+                self._credentials.refresh_if_needed()
+            with metrics.timer('calendar_sync'):
+                changes = self._sync_calendars()
+        except Exception as e:
+            self._last_changes = None
+            opened = self._breaker.record_failure()
+            self._report_error(e)
+            if opened:
+                # try again with a fresh connection when the breaker lets the app
+                self._reconnect()
+            return False
+        self._breaker.record_success()
+        self._reconnected = False
+        self._last_changes = changes
+        if self._watch_channels is not None:
+            # keep the change notifications coming
+            self._watch_channels.renew()
+        if not self._headless:
+            # turn on the SUCCESS_COLOR LED so you'll know data was returned from the Google calendar API
+            display.set_activity_light(unicorn.SUCCESS_COLOR, False)
+        # initialize this here, setting it to true later if we encounter an error
+        self._has_error = False
+        if self._reboot_counter > 0:
+            # reset the reboot counter, since everything worked so far
+            self._reboot_counter = 0
+            logging.info('Resetting the reboot counter ({})'.format(self._reboot_counter))
+            self._state.set('reboot_counter', self._reboot_counter)
+        self._save_state(changes)
+        return True
+
+    def _report_error(self, e):
+        # Something went wrong, tell the user (just in case they have a monitor on the Pi)
+        logging.error('Exception type: {}'.format(type(e)))
+        # not much else we can do here except to skip this attempt and try again later
+        logging.error('Error: {}'.format(sys.exc_info()[0]))
+
+        # experimenting with a different way to output exception details
+        logging.info('print_exc()')
+        traceback.print_exc(file=sys.stdout)
+        # Another way to output exception details
+        logging.info('print_exc(1)')
+        traceback.print_exc(limit=1, file=sys.stdout)
+
+        if not self._headless:
+            # set the current_activity_light to indicate an error state with the last reading: STALE_COLOR
+            # if the app can keep going with the schedule it has, FAILURE_COLOR if not
+            steps = [(unicorn.set_activity_light,
+                      (unicorn.STALE_COLOR if self._has_schedule() else unicorn.FAILURE_COLOR, False))]
+            if not self._has_error:
+                # light up the array with FAILURE_COLOR LEDs to indicate a (new) problem
+                steps.insert(0, (unicorn.flash_all, (1, 2, unicorn.FAILURE_COLOR)))
+            display.submit(display.PRIORITY_REMINDER, steps)
+        # we have an error, so make note of it
+        self._has_error = True
+        # check to see if reboot is enabled (rebooting the server would take everyone's calendar with it)
+        if self._use_reboot_counter and not self._headless:
+            # increment the counter
+            self._reboot_counter += 1
+            logging.info('Incrementing the reboot counter ({})'.format(self._reboot_counter))
+            self._state.set('reboot_counter', self._reboot_counter)
+            # did we reach the reboot threshold? Only reboot if reconnecting didn't help
+            if self._reboot_counter >= self._reboot_counter_limit and self._reconnected:
+                # start counting again after the reboot
+                self._state.set('reboot_counter', 0)
+                self._state.save()
+                # Reboot the Pi
+                for i in range(1, 10):
+                    logging.info('Rebooting in {} seconds'.format(i))
+                    clock.sleep(1)
+                os.system("sudo reboot")
+
+    def _get_free_busy_status(self, current_time, time_window, current_status):
+        # Work out the status from the busy times alone (free/busy mode), there aren't any meeting
+        # summaries and all busy times count as busy (free/busy doesn't report tentative events)
+        then = current_time + datetime.timedelta(minutes=time_window)
+        busy_times = self._free_busy.get_busy_times(current_time, then)
+        if not busy_times:
+            logging.info('No busy times returned')
+            return 0, '', current_status
+        num_minutes = -1
+        for start, end in busy_times:
+            if current_time < start:
+                # find the nearest (soonest) meeting time
+                minutes_to_start = (start - current_time).total_seconds() // 60
+                num_minutes = minutes_to_start if num_minutes < 0 else min(num_minutes, minutes_to_start)
+            else:
+                logging.debug('Setting busy (free/busy)')
+                current_status = Status.BUSY.value
+        return num_minutes, '', current_status
+
+    def _get_events(self, time_min, time_max):
+        # Return the events on all of the calendars that overlap the window, sorted by start time.
+        # The same meeting can be on more than one calendar, so only the first copy of an event is used.
+        events = heapq.merge(*[cache.get_events(time_min, time_max) for cache in self._caches if cache.ready],
+                             key=lambda event: event.start)
+        event_ids = set()
+        result = []
+        for event in events:
+            if event.id not in event_ids:
+                event_ids.add(event.id)
+                result.append(event)
+        return result
+
+    def get_event_times(self, time_window):
+        # Return (start, end) tuples for the cached events between now and time_window
+        # minutes from now. The app uses this to work out when to wake up next.
+        now = pytz.utc.localize(clock.utcnow())
+        if self._free_busy is not None:
+            return self._free_busy.get_busy_times(now, now + datetime.timedelta(minutes=time_window))
+        return [(event.start, event.end) for event in self._get_events(
+            now, now + datetime.timedelta(minutes=time_window))]
+
+    def get_work_hours_edges(self, now):
+        # Return the next start and end of working hours after now (local time), the
+        # calendar status changes at these times. Empty if working hours are disabled.
+        if not self._use_work_hours:
+            return []
+        edges = []
+        for day in (now.date(), now.date() + datetime.timedelta(days=1)):
+            for work_time in (self._work_start, self._work_end):
+                edge = datetime.datetime.combine(day, work_time)
+                if edge > now:
+                    edges.append(edge)
+        return edges
+
+    def get_status(self, time_window, sync=True):
+        # sync: when False, work out the status from the local event cache without
+        # asking Google for changes (used between the regular refreshes)
+        logging.debug('get_status(%s, %s)', time_window, sync)
+        self._check_settings()
         # get the status of the user's calendar
-        global reboot_counter
         # get all of the events on the calendar from now through 10 minutes from now
         logging.info('Getting next event')
         # this 'now' is in a different format (UTC)
-        now = datetime.datetime.utcnow()
+        now = clock.utcnow()
         # Calculate a time search_limit from now
         then = now + datetime.timedelta(minutes=time_window)
         # if we don't have an error from the previous attempt, then change the LED color
         # otherwise leave it alone (it should already be red, so it will stay that way).
-        if not self._has_error:
+        if sync and not self._has_error and not self._headless:
             # turn on a sequential CHECKING_COLOR LED to show that you're requesting data from the Google Calendar API
-            unicorn.set_activity_light(unicorn.CHECKING_COLOR, True)
+            display.set_activity_light(unicorn.CHECKING_COLOR, True)
+        # when the app started working through the events (after any sync)
+        processing_start = None
         try:
             # set our base calendar status, assume we're turning the Remote Notify status LED off
             current_status = Status.OFF.value
             # Now check to see whether the LED should be set to Green (free)
             if self._use_work_hours:
                 # is the current time within working hours?
-                if self._is_working_hours(datetime.datetime.now()):
+                if self._is_working_hours(clock.now()):
                     # Is it the weekend?
-                    if datetime.datetime.today().weekday() < 5:
+                    if clock.now().weekday() < 5:
                         # No? Working hours on a weekday, so Free
                         logging.debug('Current time is within working hours')
                         current_status = Status.FREE.value
@@ -228,24 +523,17 @@ class GoogleCalendar:
                 logging.debug('Working hours disabled')
                 current_status = Status.FREE.value
 
-            # ask Google for the calendar entries
-            events_result = self._service.events().list(
-                # get all of them between now and 10 minutes from now
-                calendarId='primary',
-                timeMin=now.isoformat() + 'Z',
-                timeMax=then.isoformat() + 'Z',
-                singleEvents=True,
-                orderBy='startTime').execute()
-            # turn on the SUCCESS_COLOR LED so you'll know data was returned from the Google calendar API
-            unicorn.set_activity_light(unicorn.SUCCESS_COLOR, False)
-            # Get the event list
-            event_list = events_result.get('items', [])
-            # initialize this here, setting it to true later if we encounter an error
-            self._has_error = False
-            if reboot_counter > 0:
-                # reset the reboot counter, since everything worked so far
-                reboot_counter = 0
-                logging.info('Resetting the reboot counter ({})'.format(reboot_counter))
+            if sync and not self._refresh():
+                # couldn't reach Google, keep going with the schedule we already have (if there is one)
+                if not self._has_schedule():
+                    return -1, '', Status.OFF.value
+                logging.info('Using the cached schedule')
+            processing_start = time.perf_counter()
+            if self._free_busy is not None:
+                # Return values: num_minutes, summary_string, calendar_status
+                return self._get_free_busy_status(pytz.utc.localize(now), time_window, current_status)
+            # Get the event list, all of them between now and 10 minutes from now
+            event_list = self._get_events(pytz.utc.localize(now), pytz.utc.localize(then))
 
             # Did we get any events back?
             if not event_list:
@@ -255,70 +543,66 @@ class GoogleCalendar:
                 return 0, '', current_status
             else:
                 # what time is it now?
-                current_time = pytz.utc.localize(datetime.datetime.utcnow())
+                current_time = pytz.utc.localize(clock.utcnow())
                 # an empty list of upcoming events, will populate in the following loop
                 upcoming_events = []
                 logging.info('Events returned: {}'.format(len(event_list)))
-                # loop through the events in the list
+                # the per-event messages only go to the debug log, check for that once rather than for every event
+                debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+                # loop through the events in the list (the cache only holds events that have a
+                # start time, so all day events are already skipped)
                 for event in event_list:
-                    # write the event to the console
-                    logging.debug('Event: {}'.format(event))
-                    # we only care about events that have a start time
-                    start = event['start'].get('dateTime')
-                    # we only want events that have a start time (skips all day events)
-                    # do we have a start time for this event?
-                    if start:
-                        # get our event summary string
-                        event_summary = GoogleCalendar.get_event_summary(event)
-                        # is this one of the events we're support to just ignore?
-                        if not self.ignore_event(event_summary.lower()):
-                            # When does the appointment start?
-                            # Convert the string it into a Python dateTime object so we can do math on it
-                            event_start = parser.parse(start)
-                            # does the event start in the future?
-                            if current_time < event_start:
-                                logging.info('Upcoming event: {}'.format(event_summary))
-                                time_delta = event_start - current_time
-                                new_event = self._process_upcoming_event(event, start, time_delta)
-                                logging.debug('New Event: {}'.format(new_event))
-                                # we have an upcoming event
-                                if self._reminder_only:
-                                    # only use events that have a reminder set
-                                    if self._has_reminder(event):
-                                        upcoming_events.append(new_event)
-                                else:
-                                    # add the event to our upcoming event list
-                                    upcoming_events.append(new_event)
+                    if debug:
+                        # write the event to the console
+                        logging.debug('Event: %s', event)
+                    # is this one of the events we're support to just ignore?
+                    if not self.ignore_event(event.summary.lower(), (event.id, event.updated)):
+                        # does the event start in the future?
+                        if current_time < event.start:
+                            if debug:
+                                logging.debug('Upcoming event: %s', event.summary)
+                                logging.debug('Event starts: %s', event.start)
+                            # we have an upcoming event
+                            if self._reminder_only:
+                                # only use events that have a reminder set
+                                if event.has_reminder:
+                                    upcoming_events.append(event)
                             else:
-                                logging.info('Ongoing event: {}'.format(event_summary))
-                                # we have an ongoing/current event
-                                # Are we processing busy events only?
-                                if self._busy_only:
-                                    # then is the user marked busy for this event?
-                                    if self._is_marked_busy(event):
-                                        logging.debug('Setting busy (1)')
-                                        # add the event to our current event list
-                                        current_status = Status.BUSY.value
-                                    # else use whatever the current status is
-                                else:
-                                    if self._is_marked_busy(event):
-                                        logging.debug('Setting busy (2)')
-                                        # add the event to our current event list
-                                        current_status = Status.BUSY.value
-                                    else:
-                                        logging.debug('Merging tentative')
-                                        # set it equal to the highest status (lowest status value)
-                                        current_status = GoogleCalendar.merge_status(
-                                            current_status, Status.TENTATIVE.value)
+                                # add the event to our upcoming event list
+                                upcoming_events.append(event)
                         else:
-                            # We're ignoring the event because it contains some strings we don't care about
-                            logging.info('Ignoring event: {}'.format(event_summary))
+                            if debug:
+                                logging.debug('Ongoing event: %s', event.summary)
+                            # we have an ongoing/current event
+                            # Are we processing busy events only?
+                            if self._busy_only:
+                                # then is the user marked busy for this event?
+                                if event.busy:
+                                    logging.debug('Setting busy (1)')
+                                    # add the event to our current event list
+                                    current_status = Status.BUSY.value
+                                # else use whatever the current status is
+                            else:
+                                if event.busy:
+                                    logging.debug('Setting busy (2)')
+                                    # add the event to our current event list
+                                    current_status = Status.BUSY.value
+                                else:
+                                    logging.debug('Merging tentative')
+                                    # set it equal to the highest status (lowest status value)
+                                    current_status = GoogleCalendar.merge_status(
+                                        current_status, Status.TENTATIVE.value)
+                    else:
+                        # We're ignoring the event because it contains some strings we don't care about
+                        if debug:
+                            logging.debug('Ignoring event: %s', event.summary)
 
                 # start processing our lists
                 # do we have any upcoming events?
                 if len(upcoming_events) > 0:
                     # then process the list and figure out when the next one is
-                    num_minutes, summary_string = self._process_upcoming_events(upcoming_events, time_window)
+                    num_minutes, summary_string = self._process_upcoming_events(
+                        upcoming_events, time_window, current_time)
                 else:
                     # No? Then return an invalid number of minutes to the next appointment
                     num_minutes = -1
@@ -326,36 +610,9 @@ class GoogleCalendar:
                 # Return values: num_minutes, summary_string, calendar_status
                 return num_minutes, summary_string, current_status
         except Exception as e:
-            # Something went wrong, tell the user (just in case they have a monitor on the Pi)
-            logging.error('Exception type: {}'.format(type(e)))
-            # not much else we can do here except to skip this attempt and try again later
-            logging.error('Error: {}'.format(sys.exc_info()[0]))
-
-            # experimenting with a different way to output exception details
-            logging.info('print_exc()')
-            traceback.print_exc(file=sys.stdout)
-            # Another way to output exception details
-            logging.info('print_exc(1)')
-            traceback.print_exc(limit=1, file=sys.stdout)
-
-            # light up the array with FAILURE_COLOR LEDs to indicate a problem
-            unicorn.flash_all(1, 2, unicorn.FAILURE_COLOR)
-            # now set the current_activity_light to FAILURE_COLOR to indicate an error state
-            # with the last reading
-            unicorn.set_activity_light(unicorn.FAILURE_COLOR, False)
-            # we have an error, so make note of it
-            _has_error = True
-            # check to see if reboot is enabled
-            if self._use_reboot_counter:
-                # increment the counter
-                reboot_counter += 1
-                logging.info('Incrementing the reboot counter ({})'.format(reboot_counter))
-                # did we reach the reboot threshold?
-                if reboot_counter == self._reboot_counter_limit:
-                    # Reboot the Pi
-                    for i in range(1, 10):
-                        logging.info('Rebooting in {} seconds'.format(i))
-                        time.sleep(1)
-                    os.system("sudo reboot")
+            self._report_error(e)
+        finally:
+            if processing_start is not None:
+                metrics.observe('event_processing', time.perf_counter() - processing_start)
         # we have to return something here, so making some guesses
-        return -1, '', Status.OFF
+        return -1, '', Status.OFF.value
@@ -0,0 +1,54 @@
+###########################################################
+# Ignore Matcher Module
+#
+# Compiles the ignore_in_summary list into a single regular
+# expression, so checking an event summary is one search
+# instead of a loop through every keyword. Entries are plain
+# text by default (matched anywhere in the summary, like
+# before); prefix an entry with 're:' to use a regular
+# expression or 'glob:' to use a shell style wildcard
+# pattern (matched against the whole summary).
+#
+# Results are remembered by event, so an event's summary is
+# only checked again when the event changes.
+###########################################################
+
+import fnmatch
+import re
+
+REGEX_PREFIX = 're:'
+GLOB_PREFIX = 'glob:'
+# how many event results to remember before starting over
+MEMO_SIZE = 1024
+
+
+class IgnoreMatcher:
+
+    def __init__(self, patterns):
+        parts = []
+        for pattern in patterns:
+            if pattern.startswith(REGEX_PREFIX):
+                parts.append(pattern[len(REGEX_PREFIX):])
+            elif pattern.startswith(GLOB_PREFIX):
+                parts.append(r'\A' + fnmatch.translate(pattern[len(GLOB_PREFIX):]))
+            else:
+                parts.append(re.escape(pattern))
+        self._regex = re.compile('|'.join('(?:{})'.format(part) for part in parts)) if parts else None
+        # results indexed by event key (event ID and last update time)
+        self._memo = {}
+
+    def matches(self, event_summary, event_key=None):
+        # Returns True if the summary matches any of the patterns. When event_key is provided, the
+        # result is remembered and reused the next time the same key comes along.
+        if self._regex is None:
+            return False
+        if event_key is not None:
+            result = self._memo.get(event_key)
+            if result is not None:
+                return result
+        result = self._regex.search(event_summary) is not None
+        if event_key is not None:
+            if len(self._memo) >= MEMO_SIZE:
+                self._memo.clear()
+            self._memo[event_key] = result
+        return result
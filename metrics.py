@@ -0,0 +1,179 @@
+###########################################################
+# Metrics Module
+#
+# Lightweight timers, counters and gauges for the work the
+# app does every minute (calendar requests, event
+# processing, Particle Cloud updates, display animations)
+# and how late the main loop wakes up (drift). The numbers
+# are available as Prometheus text from a small local HTTP
+# server and/or as a JSON file the app rewrites every time
+# through its loop, so network latency can be told apart
+# from LED rendering time.
+###########################################################
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import re
+import threading
+import time
+
+import atomic_file
+
+# prefix for all of the Prometheus metric names
+PREFIX = 'remind_'
+
+_lock = threading.Lock()
+# name: value
+_counters = {}
+# name: value
+_gauges = {}
+# name: [count, total seconds, max seconds, last seconds]
+_timers = {}
+# (prefix, function) tuples, each function returns a dictionary of values read when the metrics are collected
+_collectors = []
+_server = None
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def set_gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, seconds):
+    # record a duration (seconds) for the named timer
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            _timers[name] = [1, seconds, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+            timer[3] = seconds
+
+
+@contextmanager
+def timer(name):
+    # time the code in a with block; a failure is counted as well as timed
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment(name + '_errors')
+        raise
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def add_collector(prefix, fn):
+    # fn returns a dictionary of values (numbers, or None when there isn't one yet) that
+    # are reported as gauges named prefix_key
+    with _lock:
+        _collectors.append((prefix, fn))
+
+
+def collect():
+    # Returns all of the metrics as a dictionary
+    with _lock:
+        result = {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'timers': {name: {'count': t[0], 'total': t[1], 'max': t[2], 'last': t[3]}
+                       for name, t in _timers.items()}}
+        collectors = list(_collectors)
+    for prefix, fn in collectors:
+        try:
+            values = fn()
+        except Exception as e:
+            logging.error('Metrics: Unable to collect {} metrics: {}'.format(prefix, e))
+            continue
+        for key, value in values.items():
+            # only numbers make sense as gauges (skips statuses that haven't been set, etc.)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                result['gauges']['{}_{}'.format(prefix, key)] = value
+    return result
+
+
+def to_prometheus():
+    # Returns the metrics in the Prometheus text exposition format
+    metrics = collect()
+    lines = []
+    for name, value in sorted(metrics['counters'].items()):
+        name = _metric_name(name) + '_total'
+        lines.append('# TYPE {} counter'.format(name))
+        lines.append('{} {}'.format(name, value))
+    for name, value in sorted(metrics['gauges'].items()):
+        name = _metric_name(name)
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{} {}'.format(name, value))
+    for name, t in sorted(metrics['timers'].items()):
+        name = _metric_name(name) + '_seconds'
+        lines.append('# TYPE {} summary'.format(name))
+        lines.append('{}_count {}'.format(name, t['count']))
+        lines.append('{}_sum {:.6f}'.format(name, t['total']))
+        lines.append('# TYPE {}_max gauge'.format(name))
+        lines.append('{}_max {:.6f}'.format(name, t['max']))
+        lines.append('# TYPE {}_last gauge'.format(name))
+        lines.append('{}_last {:.6f}'.format(name, t['last']))
+    return '\n'.join(lines) + '\n'
+
+
+def dump(path):
+    # Write the metrics to a JSON file
+    try:
+        atomic_file.write(path, json.dumps(collect(), indent=2, sort_keys=True))
+    except Exception as e:
+        logging.error('Metrics: Unable to write {}: {}'.format(path, e))
+
+
+def start_server(port, host='127.0.0.1'):
+    # Serve the metrics at http://host:port/metrics (Prometheus text) and /metrics.json
+    global _server
+    if _server is None:
+        _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+        logging.info('Metrics: Serving metrics on http://{}:{}/metrics'.format(host, port))
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+
+def _metric_name(name):
+    # Prometheus names can only contain letters, digits and underscores
+    return PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = to_prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(collect(), sort_keys=True).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep the scrapes out of the app's log
+        pass
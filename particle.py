@@ -3,27 +3,81 @@
 #
 # Exposes methods to trigger Particle Cloud methods for
 # the Remote Notify device
+#
+# Run this module to drive a ParticleCloud object through
+# the ParticlePublisher against a local stand-in for the
+# Particle Cloud (no device or account needed), failing
+# the first few requests to exercise the retries:
+#
+#   python particle.py [--port 8086] [--failures 2]
 ###########################################################
 
+# This project's imports (local modules)
+from circuit_breaker import CircuitBreaker
+import metrics
+from status import Status
+
 #  Other imports
+import importlib
 import logging
-import requests
+import threading
+import time
+
+# requests is slow to import, and only needed when Remote Notify is enabled, so it's
+# imported when the app creates a ParticleCloud object
+requests = None
 
 PARTICLE_HOST = 'https://api.particle.io/v1/devices/'
 PARTICLE_VERB_1 = '/setStatus'
 PARTICLE_VERB_2 = '/getStatus'
 
+# Publisher retry delays (seconds), doubles (give or take some randomness) after every failed attempt
+# up to the maximum
+BACKOFF_START = 1
+BACKOFF_MAX = 60
+# start over with a new connection to the Particle Cloud after this many failed attempts in a row
+RECONNECT_AFTER = 3
+
+
+def _import_requests():
+    global requests
+    if requests is None:
+        requests = importlib.import_module('requests')
+
+
+def create_session(pool_size):
+    # A session for many ParticleCloud objects to share (server.py), it keeps up to pool_size
+    # connections to the Particle Cloud open so that many threads can use it at once
+    _import_requests()
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    return session
+
 
 class ParticleCloud:
 
-    def __init__(self, access_token, device_id):
+    def __init__(self, access_token, device_id, host=PARTICLE_HOST, session=None):
+        # session: a requests session to share with other ParticleCloud objects (see create_session())
+        _import_requests()
         # populate the Particle config options
         self._access_token = access_token
         self._device_id = device_id
+        # the host is only configurable so the module can talk to a local stand-in for testing
+        self._host = host
         self._status = 0
+        # reuse the connection to the Particle Cloud between requests
+        self._owns_session = session is None
+        self._session = session if session is not None else requests.Session()
+
+    def reconnect(self):
+        # throw away the connection to the Particle Cloud and start a new one (unless the session is shared)
+        if self._owns_session:
+            logging.info('Particle Cloud: Reconnecting')
+            self._session.close()
+            self._session = requests.Session()
 
     def set_status(self, status_val):
-        logging.debug('Particle Cloud: set_status({})'.format(status_val))
+        logging.debug('Particle Cloud: set_status(%s)', status_val)
         return self.invoke_particle_cloud(PARTICLE_VERB_1, status_val)
 
     def get_status(self):
@@ -31,35 +85,190 @@ class ParticleCloud:
         return self.invoke_particle_cloud(PARTICLE_VERB_2, -1)
 
     def invoke_particle_cloud(self, verb_string, status):
-        logging.debug('invoke_particle_cloud("{}", {})'.format(verb_string, status))
-        logging.debug('Access token: {}'.format(self._access_token))
-        logging.debug('Device ID: {}'.format(self._device_id))
-        logging.debug('Status: {}'.format(status))
+        logging.debug('invoke_particle_cloud("%s", %s)', verb_string, status)
+        logging.debug('Access token: %s', self._access_token)
+        logging.debug('Device ID: %s', self._device_id)
+        logging.debug('Status: %s', status)
         # Build the URL we'll use to connect to the Particle Cloud
-        url = PARTICLE_HOST + self._device_id + verb_string
-        logging.debug('URL: {}'.format(url))
+        url = self._host + self._device_id + verb_string
+        logging.debug('URL: %s', url)
         if status > -1:
             # body = "access_token={}&params={}".format(self._access_token, status)
             body = {"access_token": self._access_token, "params": status}
         else:
             # body = "access_token={}".format(self._access_token)
             body = {"access_token": self._access_token}
-        logging.debug('Body: {}'.format(body))
+        logging.debug('Body: %s', body)
         # headers = {"Content-Type": "application/x-www-form-urlencoded",
         #            "Content-Length": len(body)}
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
-        logging.debug('Headers: {}'.format(headers))
+        logging.debug('Headers: %s', headers)
         logging.debug('Executing request')
         try:
-            res = requests.post(url, headers=headers, data=body, timeout=5)
+            res = self._session.post(url, headers=headers, data=body, timeout=5)
             if res.status_code not in (200, 201):
-                logging.debug("Particle Cloud returned {}".format(res.status_code))
+                logging.debug("Particle Cloud returned %s", res.status_code)
                 return -1
             else:
-                logging.debug('Result {}'.format(res))
+                logging.debug('Result %s', res)
                 return res.text
         except requests.exceptions.RequestException as e:
             logging.error("Exception attempting to connect to the Particle Cloud")
             logging.error('Response: {}'.format(e.response))
             # logging.error('Response: {}'.format(e.response.json()))
             return -1
+
+
+class ParticlePublisher(threading.Thread):
+    # Sends status changes to the Particle Cloud in the background. Only the latest status
+    # matters, so a status that's replaced before it's sent is never sent at all. Failed
+    # attempts are retried with an increasing delay (a circuit breaker that opens after every
+    # failure, the next attempt waits until it lets one through), and every few failures with
+    # a new connection.
+
+    def __init__(self, particle, on_error=None, delivered=None, metrics_prefix=None):
+        # delivered: the status the device already shows (from the last run), if known
+        # metrics_prefix: names the thread and the circuit breaker metrics (the user, in server.py)
+        threading.Thread.__init__(self, name='particle' if not metrics_prefix else '{}_particle'.format(metrics_prefix))
+        self.daemon = True
+        self._particle = particle
+        # called (on the publisher thread) with the status whenever an attempt fails
+        self._on_error = on_error
+        self._condition = threading.Condition()
+        self._stopping = False
+        # the status we want the device to show, and the last one the cloud accepted
+        self._desired = delivered
+        self._delivered = delivered
+        self._breaker = CircuitBreaker('particle', failure_threshold=1, base_delay=BACKOFF_START,
+                                       max_delay=BACKOFF_MAX, metrics_prefix=metrics_prefix)
+        # delivery statistics
+        self._attempts = 0
+        self._failures = 0
+        self._latency = None
+        self._last_delivery = None
+
+    def publish(self, status):
+        # status: the Status value (an int) to send, a Status is converted to its value
+        if isinstance(status, Status):
+            status = status.value
+        elif isinstance(status, bool) or not isinstance(status, int):
+            raise TypeError('The status must be an int, not {}'.format(type(status).__name__))
+        with self._condition:
+            self._desired = status
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+    def get_state(self):
+        # delivery state and statistics, latency is the duration of the last successful request (seconds)
+        with self._condition:
+            return {
+                'desired': self._desired,
+                'delivered': self._delivered,
+                'pending': self._desired != self._delivered,
+                'attempts': self._attempts,
+                'failures': self._failures,
+                'latency': self._latency,
+                'last_delivery': self._last_delivery}
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._stopping and self._desired == self._delivered:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                if not self._breaker.allow():
+                    # wait before trying again (a new status doesn't cut the wait short)
+                    self._condition.wait(self._breaker.get_retry_delay())
+                    continue
+                status = self._desired
+                self._attempts += 1
+            start = time.time()
+            try:
+                result = self._particle.set_status(status)
+            except Exception as e:
+                logging.error('Particle Cloud: Exception setting status: {}'.format(e))
+                result = -1
+            latency = time.time() - start
+            metrics.observe('particle_set_status', latency)
+            with self._condition:
+                if result != -1:
+                    logging.debug('Particle Cloud: Delivered status %s (%.3f seconds)', status, latency)
+                    self._delivered = status
+                    self._latency = latency
+                    self._last_delivery = time.time()
+                    self._breaker.record_success()
+                    continue
+                self._failures += 1
+            metrics.increment('particle_set_status_errors')
+            self._breaker.record_failure()
+            if self._breaker.failures % RECONNECT_AFTER == 0:
+                self._particle.reconnect()
+            delay = self._breaker.get_retry_delay()
+            logging.error('Particle Cloud: Unable to set status {}, retrying in {:.1f} seconds'.format(status, delay))
+            if self._on_error is not None:
+                self._on_error(status)
+
+
+def main():
+    # Run a local stand-in for the Particle Cloud and send it a few status changes through the publisher
+    import argparse
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs
+
+    parser = argparse.ArgumentParser(description='Send status changes to a local stand-in for the Particle Cloud')
+    parser.add_argument('--port', type=int, default=8086, help='the port the stand-in listens on')
+    parser.add_argument('--failures', type=int, default=2, help='the number of requests the stand-in fails first')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+    # (path, status) for every request the stand-in accepted
+    received = []
+    failures = [args.failures]
+
+    class StandInHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            body = parse_qs(self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode())
+            if failures[0] > 0:
+                failures[0] -= 1
+                self.send_response(500)
+            else:
+                received.append((self.path, int(body['params'][0])))
+                self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    stand_in = ThreadingHTTPServer(('127.0.0.1', args.port), StandInHandler)
+    threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+    particle = ParticleCloud('token', 'device', host='http://127.0.0.1:{}/v1/devices/'.format(args.port))
+    # the device starts out showing OFF
+    publisher = ParticlePublisher(particle, on_error=lambda status: print('Failed to send {}'.format(status)),
+                                  delivered=Status.OFF.value)
+    publisher.start()
+    # the first status is retried until the stand-in stops failing, the ones in between are replaced
+    # before they're sent
+    for status in (Status.FREE, Status.BUSY, Status.TENTATIVE, Status.BUSY):
+        publisher.publish(status)
+    deadline = time.time() + 30
+    while publisher.get_state()['pending'] and time.time() < deadline:
+        time.sleep(0.1)
+    # and back to OFF
+    publisher.publish(Status.OFF)
+    while publisher.get_state()['pending'] and time.time() < deadline:
+        time.sleep(0.1)
+    publisher.stop()
+    stand_in.shutdown()
+    print('Received: {}'.format(received))
+    print('Publisher: {}'.format(publisher.get_state()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+###########################################################
+# Push Receiver Module
+#
+# A small HTTP server that accepts the calendar change
+# notifications Google posts to the app's watch channels
+# (see watch_channels.py). A notification doesn't say what
+# changed, it just tells the app to do an incremental sync,
+# which it does right away instead of waiting for the next
+# refresh.
+#
+# Google only posts notifications to an HTTPS address with
+# a valid certificate, so the receiver (plain HTTP, on the
+# Pi) has to sit behind something that has one: a reverse
+# proxy or a tunnel. Set push_address in config.json to the
+# public URL and push_port to the port the receiver
+# listens on.
+#
+# Run this module to post a synthetic notification to the
+# receiver, standing in for Google (the channel ID and
+# token come from the app's state.json):
+#
+#   python push_receiver.py [--port 8085] [--state state.json]
+###########################################################
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+
+import metrics
+
+# the resource state Google sends when it sets up a channel, every other notification means a change
+SYNC_STATE = 'sync'
+DEFAULT_PORT = 8085
+
+
+class PushReceiver:
+
+    def __init__(self, port, on_notification, host='127.0.0.1'):
+        # on_notification(channel_id, token, resource_state) is called (on the receiver's thread) for
+        # every notification, and returns False if it isn't from one of the app's channels
+        self._server = ThreadingHTTPServer((host, port), _NotificationHandler)
+        self._server.daemon_threads = True
+        self._server.on_notification = on_notification
+        self._host = host
+        self._port = port
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='push', daemon=True).start()
+        logging.info('Push Receiver: Listening on http://{}:{}'.format(self._host, self._port))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _NotificationHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        # the notification is all in the headers, there's no body worth reading
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        channel_id = self.headers.get('X-Goog-Channel-ID')
+        token = self.headers.get('X-Goog-Channel-Token')
+        resource_state = self.headers.get('X-Goog-Resource-State')
+        try:
+            accepted = channel_id is not None and self.server.on_notification(channel_id, token, resource_state)
+        except Exception as e:
+            logging.error('Push Receiver: Unable to handle a notification: {}'.format(e))
+            accepted = False
+        if accepted:
+            metrics.increment('push_notifications')
+            logging.debug('Push Receiver: %s notification for channel %s', resource_state, channel_id)
+        else:
+            metrics.increment('push_rejected')
+            logging.warning('Push Receiver: Rejected a notification for channel {}'.format(channel_id))
+        # anything but a 2xx tells Google the notification wasn't delivered
+        self.send_response(200 if accepted else 403)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # keep the requests out of the app's log
+        pass
+
+
+def post_notification(url, channel_id, token, resource_state='exists', message_number=1):
+    # Post a notification the way Google does, returns the HTTP status code
+    import urllib.error
+    import urllib.request
+    request = urllib.request.Request(url, data=b'', method='POST', headers={
+        'X-Goog-Channel-ID': channel_id,
+        'X-Goog-Channel-Token': token,
+        'X-Goog-Message-Number': str(message_number),
+        'X-Goog-Resource-ID': 'synthetic',
+        'X-Goog-Resource-State': resource_state})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main():
+    # post a synthetic notification for every channel in the app's state file
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description='Post a synthetic calendar change notification to the app')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='the port the push receiver listens on')
+    parser.add_argument('--state', default='state.json', help='the app\'s state file')
+    parser.add_argument('--resource-state', default='exists', help='the resource state to send')
+    args = parser.parse_args()
+    with open(args.state) as state_file:
+        watch_channels = json.load(state_file).get('watch_channels', {})
+    if not watch_channels.get('channels'):
+        print('There are no watch channels in {}'.format(args.state))
+        return
+    url = 'http://127.0.0.1:{}/'.format(args.port)
+    for calendar_id, channel in watch_channels['channels'].items():
+        status = post_notification(url, channel['id'], watch_channels['token'], args.resource_state)
+        print('{}: {}'.format(calendar_id, status))
+
+
+if __name__ == '__main__':
+    main()
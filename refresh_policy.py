@@ -0,0 +1,84 @@
+###########################################################
+# Refresh Policy Module
+#
+# Decides how long the app waits before asking Google for
+# calendar changes again. Reminders for the events the app
+# already knows about never wait for a refresh (the app
+# wakes up for those on its own, and refreshes then), so
+# the refresh is only there to find new or moved events.
+# The policy:
+#
+#   - starts at the minimum interval, and doubles it every
+#     time a refresh finds no changes
+#   - drops back to the minimum when the calendar changes
+#     (or the refresh fails)
+#   - never waits more than half the time until the next
+#     known event's first reminder, so a moved meeting is
+#     still picked up in time
+#   - caps the interval at max_refresh_interval during
+#     working hours, and off_hours_refresh_interval at
+#     night and on weekends
+#   - never waits so long that a meeting added just
+#     before its first reminder stage is found after its
+#     last stage has started (the longest lead time minus
+#     the shortest), reminders show at any time of day
+#
+# While Google is sending change notifications (see
+# push_receiver.py) the refresh is just a safety net, in
+# case one goes missing, so it happens every
+# push_refresh_interval instead.
+###########################################################
+
+import logging
+
+# the app's original refresh interval (seconds), it never refreshes more often than this
+MIN_INTERVAL = 60
+MAX_INTERVAL = 900
+OFF_HOURS_INTERVAL = 3600
+PUSH_INTERVAL = 3600
+
+
+class RefreshPolicy:
+
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, off_hours_interval=OFF_HOURS_INTERVAL,
+                 push_interval=PUSH_INTERVAL):
+        self.min_interval = min_interval
+        self.set_limits(max_interval, off_hours_interval, push_interval)
+        # the interval to use while the calendar isn't changing
+        self._quiet_interval = min_interval
+        # whether the last refresh failed
+        self._failed = False
+
+    def set_limits(self, max_interval, off_hours_interval, push_interval=PUSH_INTERVAL, new_event_interval=None):
+        # the longest intervals during and outside working hours, and the interval while change
+        # notifications are coming in (seconds). new_event_interval is the longest the app can wait
+        # and still remind the user about a meeting that was just added (None if there aren't any
+        # reminders)
+        self.max_interval = max(max_interval, self.min_interval)
+        self.off_hours_interval = max(off_hours_interval, self.min_interval)
+        self.push_interval = max(push_interval, self.min_interval)
+        self.new_event_interval = new_event_interval
+
+    def update(self, changes):
+        # Called after every refresh with the number of changes it found (None if it failed)
+        self._failed = changes is None
+        if changes is None or changes > 0:
+            self._quiet_interval = self.min_interval
+        else:
+            self._quiet_interval = min(self._quiet_interval * 2, max(self.max_interval, self.off_hours_interval))
+
+    def get_interval(self, now, first_reminder, work_time, watching=False):
+        # Seconds until the next refresh. now is a clock.time() value, first_reminder the time the
+        # next known event's first reminder is due (None if there isn't one), work_time whether
+        # it's working hours right now and watching whether change notifications are coming in.
+        if watching and not self._failed:
+            logging.debug('Refresh Policy: Next refresh in %.0f seconds (watching)', self.push_interval)
+            return self.push_interval
+        interval = min(self._quiet_interval, self.max_interval if work_time else self.off_hours_interval)
+        if self.new_event_interval is not None:
+            interval = min(interval, self.new_event_interval)
+        if first_reminder is not None:
+            interval = min(interval, (first_reminder - now) / 2)
+        interval = max(interval, self.min_interval)
+        logging.debug('Refresh Policy: Next refresh in %.0f seconds', interval)
+        return interval
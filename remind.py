@@ -7,7 +7,8 @@
     This application connects to a Google Calendar and determines whether there are any appointments in the next
     few minutes and flashes some LEDs if there are. The project uses a Raspberry Pi 2 device with a Pimoroni
     Unicorn HAT HD (a 16x16 matrix of bright, multicolored LEDs) to display an obnoxious reminder every minute,
-    changing color at 10 minutes (WHITE), 5 minutes (YELLOW) and 2 minutes (multi-color swirl).
+    changing color at 10 minutes (WHITE), 5 minutes (YELLOW) and 2 minutes (multi-color swirl). The reminder
+    stages can be changed in the config file (alert_stages).
 
     Coupled with the Remote Notify project, the server code sends appointment status to the remote notify device
     to make others aware of the user's status (busy, tentative, free).
@@ -16,22 +17,27 @@
 ********************************************************************************************************************"""
 # TODO: Implement weekend days as a config setting
 # TODO: Add option to ignore declined events (not possible with the Calendar API today)
-# TODO: Make search limit a config setting (meh)
-# TODO: Use threads for all display updates
 
 from __future__ import print_function
 
 # This project's imports (local modules)
+import app_logging
+import clock
+from display_backends import create_backend
+import display_engine as display
 from google_calendar import GoogleCalendar
+import metrics
 from particle import *
+from push_receiver import PushReceiver, SYNC_STATE
+from refresh_policy import RefreshPolicy
+import scheduler
 from settings import *
+from state_store import StateStore
 from status import Status
 import unicorn_hat as unicorn
 
 #  Other imports
-import datetime
 import logging
-from logging.handlers import TimedRotatingFileHandler
 import socket
 import sys
 import time
@@ -41,131 +47,253 @@ HASHES = '#############################################'
 PROJECT_URL = 'https://github.com/johnwargo/pi-remind-hd-notify'
 CONFIG_ERROR_STR = 'Please validate the contents of the config.json file before continuing'
 
-# Event search scope (searches this many minutes in the future for events). Increase this value to get reminders
-# earlier. The app displays WHITE lights from this limit up to FIRST_THRESHOLD
-SEARCH_LIMIT = 10  # minutes
-# Reminder thresholds
-FIRST_THRESHOLD = 5  # minutes, WHITE lights before this
-# RED for anything less than (and including) the second threshold
-SECOND_THRESHOLD = 2  # minutes, YELLOW lights before this
+# How often the app checks the calendar for changes when it's busy (and repeats the reminder), it
+# checks less often when nothing's going on (see refresh_policy.py)
+REFRESH_INTERVAL = 60  # seconds
+# A reminder is repeated when its stage's repeat time is up, give or take this much (seconds)
+REPEAT_TOLERANCE = 1
+# Wake up this long (seconds) after an event crosses into a new stage, so the event is
+# definitely less than the stage's lead time away when the app checks
+STAGE_MARGIN = 0.01
+
+# The reminder stages (see alert_stages.py); the app searches for events as far ahead as the longest stage
+alert_stages = None
+# decides when to check the calendar for changes next
+refresh_policy = None
+# the stage of the last reminder displayed, and when it was displayed
+last_alert_stage = None
+last_alert_time = 0
 
 # initialize the classes we'll use as globals
 cal = None  # Google Calendar
 particle = None  # Particle Cloud
+publisher = None  # Sends status changes to the Particle Cloud in the background
+push_receiver = None  # Accepts calendar change notifications from Google
+wakeups = None  # When the main loop wakes up next
 
 debug_mode = False
 display_meeting_summary = True
+# the last status sent to the remote notify device
+previous_status = -1
 # whether you have a remote notify device connected. Use the config file to override
 use_remote_notify = False
 
 
-def processing_loop():
-    global cal, display_meeting_summary, particle
+def update_remote_notify(calendar_status):
+    global previous_status, publisher
+
+    # Only change the status if it's different from the current status
+    if calendar_status != previous_status:
+        logging.info('Setting Remote Notify status to {}'.format(calendar_status))
+        # Capture the current status for next time
+        previous_status = calendar_status
+        # update the remote device status (in the background, the publisher only sends the latest status)
+        publisher.publish(calendar_status)
+
+
+def remote_notify_error(status):
+    # Called by the publisher when it can't set the remote device status. Not much else we can do
+    # here, the publisher tries again later, so set the current_activity_light to FAILURE_COLOR
+    # to indicate an error state with the last update
+    display.set_activity_light(unicorn.FAILURE_COLOR, False)
+
+
+def push_notification(channel_id, token, resource_state):
+    # Called (on the push receiver's thread) for every change notification, wakes the main loop up
+    # to sync the calendar. Returns False if the notification isn't for one of our watch channels.
+    calendar_id = cal.get_watched_calendar(channel_id, token)
+    if calendar_id is None:
+        return False
+    # Google sends a sync notification when it sets up a channel, it doesn't mean anything changed
+    if resource_state != SYNC_STATE:
+        logging.info('Remind: Change notification for {}'.format(calendar_id))
+        wakeups.wake(scheduler.PUSH)
+    return True
+
+
+def display_reminder(num_minutes, summary_string):
+    global display_meeting_summary, last_alert_stage, last_alert_time
+
+    # Any meetings coming up in the next num_minutes minutes? Which stage is the reminder in?
+    stage = alert_stages.get_stage(num_minutes) if num_minutes > 0 else None
+    if stage is None:
+        logging.debug('No upcoming events found')
+        last_alert_stage = None
+        return
+    now = clock.time()
+    if stage is last_alert_stage and now - last_alert_time < stage.repeat - REPEAT_TOLERANCE:
+        # we've already shown this reminder, and it's not time to show it again
+        logging.debug('Reminder repeats in %.0f seconds', last_alert_time + stage.repeat - now)
+        return
+    if num_minutes != 1:
+        logging.info('Next event starts in {} minutes'.format(num_minutes))
+    else:
+        logging.info('Next event starts in 1 minute')
+    logging.info('Event list: {}'.format(summary_string))
+    steps = stage.get_steps(num_minutes)
+    if display_meeting_summary and stage.show_summary:
+        steps.append((unicorn.display_text, (summary_string, stage.color)))
+    # set the activity light to the reminder color as an indicator, unless the last calendar check
+    # failed: the reminder replaces the error's light update, so it has to show STALE_COLOR itself
+    # (the reminder comes from the cached schedule, see GoogleCalendar._report_error())
+    light_color = unicorn.STALE_COLOR if cal.has_error() else stage.color
+    steps.append((unicorn.set_activity_light, (light_color, False)))
+    # hand the reminder to the display thread, it replaces whatever reminder is still showing
+    display.submit(stage.get_priority(), steps, preempt=True)
+    last_alert_stage = stage
+    last_alert_time = now
+
+
+def schedule_wakeups(wakeups, next_refresh):
+    global cal
+
+    # rebuild the list of deadlines: the next calendar refresh plus every time something
+    # changes for the events we already know about
+    now = clock.time()
+    wakeups.clear()
+    wakeups.schedule(next_refresh, scheduler.REFRESH)
+    # reminders that repeat before the next calendar refresh get their own wake up
+    if last_alert_stage is not None and last_alert_time + last_alert_stage.repeat < next_refresh:
+        wakeups.schedule(last_alert_time + last_alert_stage.repeat, scheduler.REPEAT)
+    # look past the search limit as far as the next refresh, for events that will move into the search window
+    for start, end in cal.get_event_times(alert_stages.search_limit + int((next_refresh - now) // 60) + 1):
+        start = start.timestamp()
+        end = end.timestamp()
+        # the reminder changes when the event moves into the search window (the longest lead
+        # time), and every time it moves into the next stage
+        for lead_time in alert_stages.lead_times:
+            threshold = start - (lead_time * 60) + STAGE_MARGIN
+            if threshold > now:
+                wakeups.schedule(threshold, scheduler.THRESHOLD)
+        # the calendar status changes when the event starts and ends
+        for status_change in (start, end):
+            if status_change > now:
+                wakeups.schedule(status_change, scheduler.STATUS)
+    # as well as when working hours start or end
+    for edge in cal.get_work_hours_edges(clock.now()):
+        wakeups.schedule(edge.timestamp(), scheduler.STATUS)
+
+
+def get_next_refresh(now):
+    # When to check the calendar for changes next, after a refresh at now
+    refresh_policy.update(cal.get_last_changes())
+    # the next known event's first reminder; the interval can't be more than half the time until then,
+    # so there's no need to look further ahead than twice the longest interval
+    first_reminder = None
+    longest = max(refresh_policy.max_interval, refresh_policy.off_hours_interval)
+    for start, end in cal.get_event_times(alert_stages.search_limit + int(2 * longest // 60) + 1):
+        start = start.timestamp()
+        if start > now:
+            first_reminder = start - alert_stages.search_limit * 60
+            break
+    next_refresh = now + refresh_policy.get_interval(
+        now, first_reminder, cal.is_work_time(clock.now()), cal.is_watching())
+    # check for changes as soon as working hours start (or end)
+    for edge in cal.get_work_hours_edges(clock.now()):
+        next_refresh = min(next_refresh, edge.timestamp() + STAGE_MARGIN)
+    return next_refresh
+
+
+def apply_settings(settings):
+    # Use the values from a settings snapshot. Called at startup, then whenever config.json changes
+    # (everything but Remote Notify can change while the app is running)
+    global alert_stages, debug_mode, display_meeting_summary, refresh_policy
+
+    if settings.use_remote_notify != use_remote_notify:
+        logging.warning('Remind: Restart the app to turn Remote Notify on or off')
+    if push_receiver is not None and not settings.push_address:
+        logging.warning('Remind: Restart the app to turn change notifications off')
+    if settings.debug_mode != debug_mode:
+        debug_mode = settings.debug_mode
+        if debug_mode:
+            logging.info('Remind: Enabling debug mode')
+        logging.getLogger().setLevel(logging.DEBUG if debug_mode else logging.INFO)
+    # build the reminder animations now, rather than every time there's a reminder
+    alert_stages = settings.alert_stages
+    alert_stages.prepare()
+    if refresh_policy is None:
+        refresh_policy = RefreshPolicy(REFRESH_INTERVAL)
+    # a meeting added just before its first reminder stage has to be found before the last one starts
+    refresh_policy.set_limits(
+        settings.max_refresh_interval, settings.off_hours_refresh_interval, settings.push_refresh_interval,
+        (alert_stages.search_limit - min(alert_stages.lead_times)) * 60)
+    app_logging.set_file_format(settings.log_format)
+    display_meeting_summary = settings.display_meeting_summary
+    if display_meeting_summary:
+        # load the text support now, rather than the first time there's a meeting
+        unicorn.init_text()
 
-    # initialize the previous remote notify status
-    previous_status = -1
 
-    # initialize the lastMinute variable to the current time to start
-    last_minute = datetime.datetime.now().minute
-    # on startup, just use the previous minute as lastMinute, that way the app
-    # will check for appointments immediately on startup.
-    if last_minute == 0:
-        last_minute = 59
-    else:
-        last_minute -= 1
+def processing_loop():
+    # check for appointments immediately on startup
+    next_refresh = clock.time()
     # infinite loop to continuously check Google Calendar for future entries
     while 1:
-        # get the current minute
-        current_minute = datetime.datetime.now().minute
-        # is it the same minute as the last time we checked?
-        if current_minute != last_minute:
-            logging.info(HASHES)
-            # reset last_minute to the current_minute, of course
-            last_minute = current_minute
-            # we've moved a minute, so we have work to do
-            # get the calendar status from Google Calendar
-            num_minutes, summary_string, calendar_status = cal.get_status(SEARCH_LIMIT)
-            # num_minutes: How many minutes before the next meeting start time
-            # summary_string: Concatenated list of upcoming meeting summaries
-            # calendar_status: Remote Notify Status value (busy, tentative, free, off)
-
-            # should we update a remote notify device?
-            # Do this first since swirling the display takes longer
-            if use_remote_notify:
-                # Only change the status if it's different from the current status
-                if calendar_status != previous_status:
-                    logging.info('Setting Remote Notify status to {}'.format(calendar_status))
-                    # Capture the current status for next time
-                    previous_status = calendar_status
-                    try:
-                        # update the remote device status
-                        particle.set_status(calendar_status)
-                    except Exception as e:
-                        # Something went wrong, tell the user (just in case they have a monitor on the Pi)
-                        logging.error('Exception type: {}'.format(type(e)))
-                        # not much else we can do here except to skip this attempt and try again later
-                        logging.error('Error: {}'.format(sys.exc_info()[0]))
-                        # light up the array with FAILURE_COLOR LEDs to indicate a problem
-                        # unicorn.flash_all(1, 1, unicorn.FAILURE_COLOR)
-                        # now set the current_activity_light to FAILURE_COLOR to indicate an error state
-                        # with the last reading
-                        unicorn.set_activity_light(unicorn.FAILURE_COLOR, False)
-
-            # Any meetings coming up in the next num_minutes minutes?
-            if num_minutes > 0:
-                if num_minutes != 1:
-                    logging.info('Next event starts in {} minutes'.format(num_minutes))
-                else:
-                    logging.info('Next event starts in 1 minute')
-                logging.info('Event list: {}'.format(summary_string))
-                # is the appointment between 10 and 5 minutes from now?
-                if num_minutes >= FIRST_THRESHOLD:
-                    # Flash the lights in WHITE
-                    unicorn.flash_all(1, 0.25, unicorn.WHITE)
-                    if display_meeting_summary:
-                        unicorn.display_text(summary_string, unicorn.WHITE)
-                    # set the activity light to WHITE as an indicator
-                    unicorn.set_activity_light(unicorn.WHITE, False)
-                # is the appointment less than 5 minutes but more than 2 minutes from now?
-                elif num_minutes > SECOND_THRESHOLD:
-                    # Flash the lights YELLOW
-                    unicorn.flash_all(2, 0.25, unicorn.YELLOW)
-                    if display_meeting_summary:
-                        unicorn.display_text(summary_string, unicorn.YELLOW)
-                    # set the activity light to YELLOw as an indicator
-                    unicorn.set_activity_light(unicorn.YELLOW, False)
-                else:
-                    # hmm, less than 2 minutes, almost time to start!
-                    # swirl the lights. Longer every second closer to start time
-                    unicorn.do_swirl(int((4 - num_minutes) * 50))
-                    if display_meeting_summary:
-                        unicorn.display_text(summary_string, unicorn.ORANGE)
-                    # set the activity light to SUCCESS_COLOR (green by default)
-                    unicorn.set_activity_light(unicorn.ORANGE, False)
-            else:
-                logging.debug('No upcoming events found')
-
-        # wait a second then check again
-        # You can always increase the sleep value below to check less often
-        time.sleep(1)
+        next_refresh = process_tick(wakeups, next_refresh)
+
+
+def process_tick(wakeups, next_refresh):
+    # One pass through the main loop: sleep until there's something to do, then do it.
+    # Returns the time of the next calendar refresh.
+    global cal
+
+    # pick up any changes to config.json (the calendar applies them on its next check)
+    if Settings.check_for_changes():
+        apply_settings(Settings.get_snapshot())
+    schedule_wakeups(wakeups, next_refresh)
+    # sleep until there's something to do
+    reasons = wakeups.wait()
+    tick_start = time.perf_counter()
+    logging.info(HASHES)
+    logging.debug('Wake up reasons: %s', reasons)
+    # a reminder threshold crossing (or a change notification) gets the same treatment as the regular
+    # refresh (fresh data and a reminder), and resets the time until the next one
+    refresh = scheduler.REFRESH in reasons or scheduler.THRESHOLD in reasons or scheduler.PUSH in reasons
+    now = clock.time()
+    # get the calendar status from Google Calendar (or the local event cache if we're only
+    # here because the status may have changed)
+    num_minutes, summary_string, calendar_status = cal.get_status(alert_stages.search_limit, refresh)
+    if refresh:
+        next_refresh = get_next_refresh(now)
+    # num_minutes: How many minutes before the next meeting start time
+    # summary_string: Concatenated list of upcoming meeting summaries
+    # calendar_status: Remote Notify Status value (busy, tentative, free, off)
+
+    # should we update a remote notify device?
+    # Do this first since swirling the display takes longer
+    if use_remote_notify:
+        update_remote_notify(calendar_status)
+
+    if refresh or scheduler.REPEAT in reasons:
+        display_reminder(num_minutes, summary_string)
+
+    save_state()
+    metrics.observe('tick', time.perf_counter() - tick_start)
+    if Settings.get_metrics_file():
+        metrics.dump(Settings.get_metrics_file())
+    return next_refresh
+
+
+def save_state():
+    # write anything that changed to the state store, so a restart can pick up where we left off
+    state = StateStore.get_instance()
+    if publisher is not None:
+        delivered = publisher.get_state()['delivered']
+        if delivered is not None:
+            state.set('particle_status', delivered)
+    state.save()
 
 
 def main():
-    global cal, debug_mode, display_meeting_summary, particle, use_remote_notify
+    global cal, debug_mode, display_meeting_summary, particle, previous_status, publisher, push_receiver, \
+        use_remote_notify, wakeups
 
     # Logging
-    # Set up the basic console logger
+    # Log to the console and to a file (rolled at midnight, 7 copies kept), through a queue so writing
+    # the log never holds up the app; the log level is set in the config
     format_str = '%(asctime)s %(levelname)s %(message)s'
     date_format = '%Y-%m-%d %H:%M:%S'
-    logging.basicConfig(format=format_str, level=logging.INFO, datefmt=date_format)
-    logger = logging.getLogger()
-    # Add a file handler as well; roll at midnight and keep 7 copies
-    file_handler = TimedRotatingFileHandler("remind_log", when="midnight", backupCount=6)
-    log_formatter = logging.Formatter(format_str, datefmt=date_format)
-    file_handler.setFormatter(log_formatter)
-    # file log always gets debug; console log level set in the config
-    file_handler.setLevel(logging.DEBUG)
-    logger.addHandler(file_handler)
+    app_logging.setup("remind_log", format_str, date_format)
 
     # tell the user what we're doing...
     print('\n')
@@ -178,14 +306,14 @@ def main():
     settings = Settings.get_instance()
     settings.validate_config_options()
 
-    debug_mode = settings.get_debug_mode()
-    if debug_mode:
-        logging.info('Remind: Enabling debug mode')
-        logger.setLevel(logging.DEBUG)
-
-    display_meeting_summary = settings.get_display_meeting_summary()
+    # set up the display (the Unicorn HAT HD, unless the config says otherwise)
+    unicorn.init(create_backend(settings.get_display_backend(), settings.get_display_record_path()))
+    # all display updates after this happen on the display thread
+    display.start()
 
     use_remote_notify = settings.get_use_remote_notify()
+    apply_settings(settings.get_snapshot())
+
     if use_remote_notify:
         logging.info('Remind: Remote Notify Enabled')
         access_token = settings.get_access_token()
@@ -197,11 +325,19 @@ def main():
             sys.exit(0)
         logging.debug('Remind: Creating Particle object')
         particle = ParticleCloud(access_token, device_id)
-
-        logging.info('Remind: Resetting Remote Notify status')
-        particle.set_status(Status.FREE.value)
-        time.sleep(1)
-        particle.set_status(Status.OFF.value)
+        # the status the device showed when the app last ran (if the app sent one)
+        last_status = StateStore.get_instance().get('particle_status')
+        publisher = ParticlePublisher(particle, remote_notify_error, last_status)
+        metrics.add_collector('particle', publisher.get_state)
+        publisher.start()
+
+        if last_status is None:
+            logging.info('Remind: Resetting Remote Notify status')
+            update_remote_notify(Status.OFF.value)
+        else:
+            # no need to reset the device, we know what it's showing
+            logging.info('Remind: Remote Notify status is {}'.format(last_status))
+            previous_status = last_status
 
     # is the reboot counter in play?
     use_reboot_counter = settings.get_use_reboot_counter()
@@ -214,6 +350,7 @@ def main():
     logging.info('Remind: Initializing Google Calendar interface')
     try:
         cal = GoogleCalendar()
+        metrics.add_collector('credentials', cal.get_credential_metrics)
         # Set the timeout for the rest of the Google API calls.
         # need this at its default during the registration process.
         socket.setdefaulttimeout(5)  # seconds
@@ -221,30 +358,58 @@ def main():
         logging.error('Remind: Unable to initialize Google Calendar API')
         logging.error('Exception type: {}'.format(type(e)))
         logging.error('Error: {}'.format(sys.exc_info()[0]))
-        unicorn.set_all(unicorn.FAILURE_COLOR)
-        time.sleep(5)
-        unicorn.off()
+        display.submit(display.PRIORITY_URGENT, [(unicorn.set_all, (unicorn.FAILURE_COLOR,))], preempt=True)
+        clock.sleep(5)
         sys.exit(0)
 
+    wakeups = scheduler.Scheduler()
+    push_address = settings.get_push_address()
+    if push_address:
+        try:
+            # listen for notifications before asking for them, Google sends one right away
+            push_receiver = PushReceiver(settings.get_push_port(), push_notification)
+            push_receiver.start()
+            cal.watch(push_address)
+        except Exception as e:
+            # the regular refresh still picks up the changes
+            logging.error('Remind: Unable to start the push receiver: {}'.format(e))
+
+    metrics_port = settings.get_metrics_port()
+    if metrics_port:
+        try:
+            metrics.start_server(metrics_port)
+        except Exception as e:
+            # the app works fine without it
+            logging.error('Remind: Unable to start the metrics server: {}'.format(e))
+
     logging.info('Remind: Application initialized')
 
-    # flash some random LEDs just for fun...
-    unicorn.flash_random(5, 0.5)
-    # blink all the LEDs GREEN to let the user know the hardware is working
-    unicorn.flash_all(3, 0.10, unicorn.GREEN)
+    display.submit(display.PRIORITY_REMINDER, [
+        # flash some random LEDs just for fun...
+        (unicorn.flash_random, (5, 0.5)),
+        # blink all the LEDs GREEN to let the user know the hardware is working
+        (unicorn.flash_all, (3, 0.10, unicorn.GREEN))])
     # get to work
     processing_loop()
 
 
 if __name__ == '__main__':
     try:
-        unicorn.init()
         main()
     except KeyboardInterrupt:
         logging.info('\n\nStopped by user, exiting...\n')
     except RuntimeError as err:
         logging.error("\n\nRuntime Error: {0}\n".format(err))
     finally:
+        if publisher is not None:
+            publisher.stop()  # stop sending status updates
+        if cal is not None:
+            cal.stop()  # stop refreshing the Google credentials
+        if push_receiver is not None:
+            push_receiver.stop()  # stop accepting change notifications
+        save_state()  # save where we left off
+        display.stop()  # stop any running animation
         unicorn.off()  # turn off all the LEDs
+        app_logging.stop()  # write the log entries still waiting in the queue
         logging.shutdown()  # close the log, write all entries to disk
         sys.exit(0)  # exit the application
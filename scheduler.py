@@ -0,0 +1,91 @@
+###########################################################
+# Scheduler Module
+#
+# A small deadline scheduler built around a heap. The app
+# adds the times something interesting happens (the next
+# calendar refresh, an event crossing a reminder threshold,
+# an event starting or ending, the edge of working hours)
+# then sleeps until the earliest one instead of waking up
+# every second to check the clock. Other threads can wake
+# the app up early (wake()), when a calendar change
+# notification arrives, for example.
+###########################################################
+
+import heapq
+import itertools
+import logging
+import threading
+
+import clock
+import metrics
+
+# the reasons the app wakes up
+REFRESH = 'refresh'  # time to sync with the calendar
+THRESHOLD = 'threshold'  # an event crossed a reminder threshold
+STATUS = 'status'  # the calendar status (busy, free, etc.) may have changed
+REPEAT = 'repeat'  # time to repeat the reminder
+PUSH = 'push'  # Google says the calendar changed
+
+# Never sleep longer than this (seconds), so the app recovers quickly if the system
+# clock jumps (the Pi sets its clock from the network after boot)
+MAX_SLEEP = 60
+
+
+class Scheduler:
+
+    def __init__(self):
+        self._heap = []
+        # breaks ties between deadlines for the same time
+        self._counter = itertools.count()
+        # the reasons passed to wake() since the last wait(), set from other threads
+        self._wake_lock = threading.Lock()
+        self._wake_reasons = set()
+        self._woken = threading.Event()
+
+    def schedule(self, when, reason):
+        # add a deadline; when is a clock.time() value
+        heapq.heappush(self._heap, (when, next(self._counter), reason))
+
+    def clear(self):
+        del self._heap[:]
+
+    def next_deadline(self):
+        # the time of the earliest deadline, or None if there isn't one
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        # remove and return the set of reasons for all deadlines at or before now
+        reasons = set()
+        while self._heap and self._heap[0][0] <= now:
+            reasons.add(heapq.heappop(self._heap)[2])
+        return reasons
+
+    def wake(self, reason):
+        # wake up wait() now, with reason as one of the reasons (safe to call from any thread)
+        with self._wake_lock:
+            self._wake_reasons.add(reason)
+        self._woken.set()
+
+    def _pop_woken(self):
+        with self._wake_lock:
+            self._woken.clear()
+            reasons = self._wake_reasons
+            self._wake_reasons = set()
+        return reasons
+
+    def wait(self):
+        # sleep until the earliest deadline (or a wake() call), then return the reasons for waking up
+        while True:
+            now = clock.time()
+            deadline = self.next_deadline()
+            reasons = self.pop_due(now)
+            if reasons:
+                # how late the app woke up for the earliest deadline
+                metrics.observe('loop_drift', now - deadline)
+            reasons |= self._pop_woken()
+            if reasons:
+                return reasons
+            deadline = self.next_deadline()
+            delay = MAX_SLEEP if deadline is None else min(deadline - now, MAX_SLEEP)
+            logging.debug('Scheduler: Sleeping %.2f seconds', delay)
+            clock.sleep_until_set(self._woken, delay)
@@ -0,0 +1,379 @@
+#!/usr/bin/python
+"""*****************************************************************************************************************
+    Pi Remind HD Notify - Server
+
+    Checks the calendars of many users in one process and keeps each user's Remote Notify device up to date, so
+    one small box can take the place of a Pi on every desk (there's no Unicorn HAT HD, so no reminders, just the
+    status on the device). Each user has a folder in the profiles folder (profiles/<name>) holding their own
+    config.json (the app's settings, the server uses the calendar and Remote Notify settings), token.pickle
+    (their Google credentials, see --login) and the state.json the server keeps for them.
+
+    The calendars are checked on a shared, fixed size pool of worker threads. How often depends on how busy each
+    user's calendar is (see refresh_policy.py), and every check is also made when the user's status is due to
+    change (a meeting starts or ends, working hours start or end). Each check is scheduled a little earlier or
+    later than the policy says (at random), so the checks spread out instead of all landing at once. Each user's
+    device is updated in the background by their own publisher (see particle.py), which retries on its own
+    schedule when the Particle Cloud fails, and all of the publishers share one pool of Particle Cloud connections.
+    Users don't hold each other up: each user's calendar is only ever checked by one worker at a time, a user
+    whose profile can't be loaded (a revoked token, a bad config file) is retried less and less often, and the
+    Google and Particle requests all time out. Each user's config file is reloaded when it changes, and the
+    profiles folder is checked every minute for users that were added or removed.
+
+    Usage: python server.py [--profiles profiles] [--workers 8] [--interval 60] [--metrics-port 0] [--debug]
+                            [--log-format text|json]
+           python server.py --login <name>   (logs in to Google for a new user and saves their token.pickle)
+********************************************************************************************************************"""
+
+from __future__ import print_function
+
+# This project's imports (local modules)
+import app_logging
+import clock
+from credential_manager import CredentialManager, TOKEN_FILE
+from google_calendar import GoogleCalendar
+import metrics
+from particle import ParticleCloud, ParticlePublisher, create_session
+from refresh_policy import RefreshPolicy
+import scheduler
+from settings import CONFIG_FILE, Settings
+from state_store import StateStore, STATE_FILE
+
+#  Other imports
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import queue
+import random
+import socket
+import sys
+import threading
+
+PROFILES_FOLDER = 'profiles'
+# How often each user's calendar is checked when it's busy (seconds)
+POLL_INTERVAL = 60
+# The number of calendars checked at the same time
+WORKERS = 8
+# Each check is scheduled up to this fraction of the interval early or late
+JITTER = 0.1
+# A user whose profile can't be loaded is tried again after this long (seconds), doubling every time
+# it fails up to the maximum
+RETRY_START = 60
+RETRY_MAX = 3600
+# How often to look for users that were added or removed (seconds)
+PROFILE_SCAN_INTERVAL = 60
+# Check this long (seconds) after a status change is due, so the change has definitely happened
+STATUS_MARGIN = 0.01
+
+
+class UserProfile:
+    # One user: their settings, calendar, state and Remote Notify device. Only one worker at a time
+    # checks a user's calendar, so none of this needs a lock.
+
+    def __init__(self, name, folder, session, interval=POLL_INTERVAL):
+        self.name = name
+        self._folder = folder
+        # the shared Particle Cloud session
+        self._session = session
+        self._config_file = os.path.join(folder, CONFIG_FILE)
+        # modification time and size of the config file when it was last read
+        self._config_stat = None
+        self._settings = None
+        self._state = None
+        self._cal = None
+        # sends the user's status to their device in the background
+        self._publisher = None
+        # the access token and device ID the publisher was created with
+        self._particle_key = None
+        self._refresh_policy = RefreshPolicy(interval)
+        # the number of checks in a row that failed because the profile couldn't be loaded
+        self.failures = 0
+        self.status = None
+
+    def get_settings(self):
+        return self._settings
+
+    def poll(self):
+        # check the user's calendar and update their device (raises an exception if the profile can't
+        # be loaded); returns False if the calendar couldn't be reached
+        self._check_settings()
+        if self._cal is None:
+            self._start()
+        num_minutes, summary_string, calendar_status = self._cal.get_status(self._settings.alert_stages.search_limit)
+        self.status = calendar_status
+        if self._settings.use_remote_notify:
+            self._update_remote_notify(self.status)
+        elif self._publisher is not None:
+            self._stop_publisher()
+        self._save_state()
+        return not self._cal.has_error()
+
+    def stop(self):
+        if self._cal is not None:
+            self._cal.stop()
+        if self._publisher is not None:
+            self._stop_publisher()
+        if self._state is not None:
+            self._save_state()
+
+    def _check_settings(self):
+        # (re)load the user's config file if it changed since the last check
+        config_stat = os.stat(self._config_file)
+        config_stat = config_stat.st_mtime_ns, config_stat.st_size
+        if config_stat == self._config_stat:
+            return
+        try:
+            settings = Settings.load_snapshot(self._config_file, self._settings)
+        except Exception as e:
+            if self._settings is None:
+                # nothing to fall back to
+                raise
+            # keep the settings the user has, and don't try again until the file changes again
+            self._config_stat = config_stat
+            logging.error('Server: Ignoring the new configuration for {}: {}'.format(self.name, e))
+            return
+        self._config_stat = config_stat
+        if self._cal is not None and (settings.calendars != self._settings.calendars or
+                                      settings.use_free_busy != self._settings.use_free_busy or
+                                      settings.display_meeting_summary != self._settings.display_meeting_summary):
+            # the calendar can't switch calendars (or free/busy mode) on the fly, so start a new one
+            logging.info('Server: Calendars changed for {}'.format(self.name))
+            self._cal.stop()
+            self._cal = None
+        self._settings = settings
+        self._refresh_policy.set_limits(settings.max_refresh_interval, settings.off_hours_refresh_interval)
+
+    def get_next_check(self, now):
+        # When to check the calendar next, after a check at now: when the refresh policy says (give or take
+        # the jitter), or when the user's status is due to change if that's sooner. There aren't any
+        # reminders, so there's nothing else to wait for.
+        self._refresh_policy.update(self._cal.get_last_changes())
+        interval = self._refresh_policy.get_interval(now, None, self._cal.is_work_time(clock.now()))
+        next_check = now + interval * random.uniform(1 - JITTER, 1 + JITTER)
+        for start, end in self._cal.get_event_times(int((next_check - now) // 60) + 1):
+            for status_change in (start.timestamp(), end.timestamp()):
+                if status_change > now:
+                    next_check = min(next_check, status_change + STATUS_MARGIN)
+        for edge in self._cal.get_work_hours_edges(clock.now()):
+            next_check = min(next_check, edge.timestamp() + STATUS_MARGIN)
+        return next_check
+
+    def _start(self):
+        if self._state is None:
+            self._state = StateStore(os.path.join(self._folder, STATE_FILE))
+        self._cal = GoogleCalendar(settings=self.get_settings, state=self._state,
+                                   token_file=os.path.join(self._folder, TOKEN_FILE), headless=True, name=self.name)
+
+    def _update_remote_notify(self, status):
+        particle_key = self._settings.access_token, self._settings.device_id
+        if not all(particle_key):
+            logging.error('Server: The access_token or device_id is missing for {}'.format(self.name))
+            return
+        if particle_key != self._particle_key:
+            if self._particle_key is None:
+                # the status the device showed when the server last ran (if it sent one)
+                delivered = self._state.get('particle_status')
+            else:
+                # a different device, it could be showing anything
+                self._stop_publisher()
+                self._state.set('particle_status', None)
+                delivered = None
+            self._publisher = ParticlePublisher(ParticleCloud(*particle_key, session=self._session),
+                                                delivered=delivered, metrics_prefix=self.name)
+            self._publisher.start()
+            self._particle_key = particle_key
+        if status != self._publisher.get_state()['desired']:
+            logging.info('Server: Setting Remote Notify status to {} for {}'.format(status, self.name))
+        # (sent in the background, and retried there if it fails)
+        self._publisher.publish(status)
+
+    def _stop_publisher(self):
+        self._record_delivered()
+        self._publisher.stop()
+        self._publisher = None
+        self._particle_key = None
+
+    def _record_delivered(self):
+        # remember what the device shows, so a restart doesn't send it again
+        if self._publisher is not None:
+            delivered = self._publisher.get_state()['delivered']
+            if delivered is not None:
+                self._state.set('particle_status', delivered)
+
+    def _save_state(self):
+        self._record_delivered()
+        self._state.save()
+
+
+class Server:
+
+    def __init__(self, profiles_folder=PROFILES_FOLDER, workers=WORKERS, interval=POLL_INTERVAL):
+        self._profiles_folder = profiles_folder
+        self._interval = interval
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='worker')
+        # one Particle Cloud connection pool for everybody, with a connection for each worker
+        self._session = create_session(workers)
+        # name: UserProfile
+        self._profiles = {}
+        # when each user's next check is due (the names of the users whose checks aren't running)
+        self._wakeups = scheduler.Scheduler()
+        # (name, next check time) for each check that finished, filled in by the workers
+        self._finished = queue.Queue()
+        # the names of the users whose checks are running
+        self._running = set()
+        # name: UserProfile for the users that were removed while their check was running, they're
+        # stopped when it finishes
+        self._removed = {}
+        self._stopping = False
+
+    def get_metrics(self):
+        return {
+            'users': len(self._profiles),
+            'users_failing': sum(1 for profile in list(self._profiles.values()) if profile.failures > 0),
+            'checks_running': len(self._running)}
+
+    def run(self):
+        next_scan = 0
+        while True:
+            now = clock.time()
+            if now >= next_scan:
+                self._scan_profiles(now)
+                next_scan = now + PROFILE_SCAN_INTERVAL
+            for name in self._wakeups.pop_due(now):
+                self._submit(name)
+            # wait for the next check to come due, rescheduling the users whose checks finish meanwhile
+            deadline = self._wakeups.next_deadline()
+            deadline = next_scan if deadline is None else min(deadline, next_scan)
+            try:
+                finished = [self._finished.get(timeout=max(0, deadline - clock.time()))]
+            except queue.Empty:
+                continue
+            while not self._finished.empty():
+                finished.append(self._finished.get())
+            for name, next_check in finished:
+                self._running.discard(name)
+                if name in self._removed:
+                    self._removed.pop(name).stop()
+                elif name in self._profiles:
+                    self._wakeups.schedule(next_check, name)
+
+    def stop(self):
+        # let the running checks finish (the queued ones return right away), then save everyone's state
+        self._stopping = True
+        self._executor.shutdown(wait=True)
+        for profile in list(self._profiles.values()) + list(self._removed.values()):
+            profile.stop()
+
+    def _scan_profiles(self, now):
+        # add the users that have a config file in the profiles folder, and drop the ones that went away
+        try:
+            names = set(name for name in os.listdir(self._profiles_folder)
+                        if os.path.isfile(os.path.join(self._profiles_folder, name, CONFIG_FILE)))
+        except OSError as e:
+            logging.error('Server: Unable to read the profiles folder: {}'.format(e))
+            return
+        # (a user that's still being removed is added on the next scan, once their last check finishes)
+        for name in sorted(names - set(self._profiles) - set(self._removed)):
+            logging.info('Server: Adding {}'.format(name))
+            self._profiles[name] = UserProfile(name, os.path.join(self._profiles_folder, name), self._session,
+                                               self._interval)
+            # spread the first checks out over the interval
+            self._wakeups.schedule(now + random.uniform(0, self._interval), name)
+        for name in sorted(set(self._profiles) - names):
+            logging.info('Server: Removing {}'.format(name))
+            # any check that's due for the user is dropped when it comes up
+            profile = self._profiles.pop(name)
+            if name in self._running:
+                # a worker is using the profile, stop it when the check finishes (see run())
+                self._removed[name] = profile
+            else:
+                profile.stop()
+
+    def _submit(self, name):
+        profile = self._profiles.get(name)
+        if profile is not None:
+            self._running.add(name)
+            self._executor.submit(self._check, profile)
+
+    def _check(self, profile):
+        # runs on a worker thread
+        if self._stopping:
+            return
+        thread = threading.current_thread()
+        worker_name = thread.name
+        # name the thread after the user while it works, so the log shows whose calendar each message is about
+        thread.name = profile.name
+        try:
+            with metrics.timer('user_check'):
+                profile.poll()
+            profile.failures = 0
+            next_check = profile.get_next_check(clock.time())
+        except Exception as e:
+            # nothing to show for this user until their profile loads, so try again later (and less often)
+            profile.failures += 1
+            delay = min(RETRY_START * 2 ** (profile.failures - 1), RETRY_MAX)
+            logging.error('Server: Unable to check the calendar for {}, trying again in {} seconds: {}'.format(
+                profile.name, delay, e))
+            next_check = clock.time() + delay * random.uniform(1 - JITTER, 1 + JITTER)
+        finally:
+            thread.name = worker_name
+        self._finished.put((profile.name, next_check))
+
+
+def login(profiles_folder, name):
+    # Log in to Google for a user and save their credentials in their profile folder (creating it)
+    folder = os.path.join(profiles_folder, name)
+    os.makedirs(folder, exist_ok=True)
+    CredentialManager(os.path.join(folder, TOKEN_FILE)).load()
+    print('Saved the credentials for {} in {}'.format(name, folder))
+    if not os.path.exists(os.path.join(folder, CONFIG_FILE)):
+        print('Copy config.rename to {} and update it to finish setting up the user'.format(
+            os.path.join(folder, CONFIG_FILE)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check many users\' calendars and update their Remote Notify devices')
+    parser.add_argument('--profiles', default=PROFILES_FOLDER, help='the folder with a folder for each user')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='the number of calendars checked at once')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between checks when calendars are busy')
+    parser.add_argument('--metrics-port', type=int, default=0, help='serve metrics on this port')
+    parser.add_argument('--debug', action='store_true', help='log debug messages to the console')
+    parser.add_argument('--log-format', choices=('text', 'json'), default='text', help='the log file format')
+    parser.add_argument('--login', metavar='NAME', help='log in to Google for a user, then exit')
+    args = parser.parse_args()
+
+    if args.login:
+        login(args.profiles, args.login)
+        return
+
+    # Logging: the thread name is the user whose calendar is being checked
+    format_str = '%(asctime)s %(levelname)s [%(threadName)s] %(message)s'
+    date_format = '%Y-%m-%d %H:%M:%S'
+    # (the file log rolls at midnight, 7 copies kept)
+    app_logging.setup("server_log", format_str, date_format, logging.DEBUG if args.debug else logging.INFO,
+                      args.log_format)
+    logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
+    # so a slow Google or Particle Cloud request can't hold up a worker for long
+    socket.setdefaulttimeout(5)  # seconds
+
+    server = Server(args.profiles, args.workers, args.interval)
+    metrics.add_collector('server', server.get_metrics)
+    if args.metrics_port:
+        metrics.start_server(args.metrics_port)
+    logging.info('Server: Checking calendars with {} workers, at most every {} seconds'.format(
+        args.workers, args.interval))
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        logging.info('Stopped by user, exiting...')
+    finally:
+        server.stop()
+        metrics.stop_server()
+        app_logging.stop()
+        logging.shutdown()
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -5,10 +5,16 @@
 ###########################################################
 # Singleton example https://gist.github.com/pazdera/1098129
 
+from alert_stages import AlertStages, DEFAULT_ALERT_STAGES
+from collections import namedtuple
+from ignore_matcher import IgnoreMatcher
 import datetime
 import logging
 import json
+import os
+import threading
 
+CONFIG_FILE = 'config.json'
 # string displayed by assert statement
 CONFIG_ERROR = 'Configuration data not available'
 # the config object properties, used when validating the config
@@ -16,6 +22,18 @@ CONFIG_PROPERTIES = ["access_token", "busy_only", "debug_mode", "display_meeting
                      "ignore_in_summary", "reboot_counter_limit", "reminder_only", "use_reboot_counter",
                      "use_remote_notify", "use_working_hours", "work_start", "work_end"]
 
+# An immutable copy of all of the settings, including the structures built from them (the compiled
+# ignore list, the parsed working hours). A new one replaces the old one whenever config.json
+# changes, so code that grabs the snapshot always sees a consistent set of values.
+# version increments with every successful (re)load.
+SettingsSnapshot = namedtuple('SettingsSnapshot', [
+    'version', 'access_token', 'alert_stages', 'busy_only', 'calendars', 'debug_mode', 'device_id', 'display_backend',
+    'display_meeting_summary', 'display_record_path',
+    'ignore_in_summary', 'ignore_matcher', 'log_format', 'max_refresh_interval', 'metrics_file', 'metrics_port',
+    'off_hours_refresh_interval', 'push_address', 'push_port', 'push_refresh_interval', 'reboot_counter_limit',
+    'reminder_only',
+    'use_free_busy', 'use_reboot_counter', 'use_remote_notify', 'use_working_hours', 'work_end', 'work_start'])
+
 # a place to hold the object from the config file
 _config = None
 
@@ -25,74 +43,22 @@ class Settings:
     # singleton instance of this class
     __instance = None
 
-    # Class variables
-    _busy_only = None
-    _debug_mode = None
-    _display_meeting_summary = None
-    _ignore_in_summary = None
-    _reminder_only = None
-    _use_remote_notify = None
-    _access_token = None
-    _device_id = None
-    _use_reboot_counter = None
-    _reboot_counter_limit = None
-    _use_working_hours = None
-    _work_end = None
-    _work_start = None
+    # the current settings snapshot
+    _snapshot = None
+    # modification time and size of the config file when it was last read
+    _config_stat = None
+    # only one thread reloads the config at a time
+    _reload_lock = threading.Lock()
 
     def __init__(self):
-        global _config
-
         if Settings.__instance is None:
             # then we've not initialized yet
             logging.info('Settings: Initializing class')
             # we're creating an instance of the class, so set that here
             Settings.__instance = self
-            logging.info('Settings: Opening project configuration file (config.json)')
-            # Read the config file contents
-            # https://martin-thoma.com/configuration-files-in-python/
-            with open("config.json") as json_data_file:
-                _config = json.load(json_data_file)
-            #  did the config read correctly?
-            if _config is not None:
-                logging.info('Config file read')
-                Settings._busy_only = self.get_config_value(_config, 'busy_only', False)
-                Settings._debug_mode = self.get_config_value(_config, 'debug_mode', False)
-                Settings._display_meeting_summary = self.get_config_value(_config, 'display_meeting_summary', True)
-                Settings._ignore_in_summary = self.get_config_value(_config, 'ignore_in_summary', [])
-                Settings._reminder_only = self.get_config_value(_config, 'reminder_only', False)
-                Settings._use_reboot_counter = self.get_config_value(_config, 'use_reboot_counter', False)
-                logging.info('Busy only: {}'.format(Settings._busy_only))
-                logging.info('Debug Mode: {}'.format(Settings._debug_mode))
-                logging.info('Display Meeting Summary: {}'.format(Settings._display_meeting_summary))
-                logging.info('Ignore in Meeting Summary: {}'.format(Settings._ignore_in_summary))
-                logging.info('Reminder Only: {}'.format(Settings._reminder_only))
-
-                logging.info('Use Reboot Counter: {}'.format(Settings._use_reboot_counter))
-                if Settings._use_reboot_counter:
-                    Settings._reboot_counter_limit = self.get_config_value(_config, 'reboot_counter_limit', 10)
-                    logging.info('Reboot Counter Limit: {}'.format(Settings._reboot_counter_limit))
-
-                Settings._use_remote_notify = self.get_config_value(_config, 'use_remote_notify', False)
-                logging.info('Use Remote Notify: {}'.format(Settings._use_remote_notify))
-                # if remote notify is enabled, that's the only time we need...
-                if Settings._use_remote_notify:
-                    Settings._access_token = self.get_config_value(_config, 'access_token', "")
-                    Settings._device_id = self.get_config_value(_config, 'device_id', "")
-                    logging.info('Access Token: {}'.format(Settings._access_token))
-                    logging.info('Device ID: {}'.format(Settings._device_id))
-
-                Settings._use_working_hours = self.get_config_value(_config, 'use_working_hours', False)
-                logging.debug('Use Working Hours: {}'.format(Settings._use_working_hours))
-                if Settings._use_working_hours:
-                    # if working hours are enabled, that's the only time we need...
-                    # convert the time string to a time value
-                    Settings._work_start = datetime.datetime.strptime(
-                        self.get_config_value(_config, 'work_start', "8:00"), '%H:%M').time()
-                    Settings._work_end = datetime.datetime.strptime(
-                        self.get_config_value(_config, 'work_end', "17:30"), '%H:%M').time()
-                    logging.info('Work Start: {}'.format(Settings._work_start))
-                    logging.info('Work End: {}'.format(Settings._work_end))
+            logging.info('Settings: Opening project configuration file ({})'.format(CONFIG_FILE))
+            # a bad config file at startup is fatal (there's nothing to fall back to)
+            Settings._load()
         else:
             logging.info('Using existing Settings class')
 
@@ -102,6 +68,184 @@ class Settings:
             Settings()
         return Settings.__instance
 
+    @staticmethod
+    def get_snapshot():
+        return Settings._snapshot
+
+    @staticmethod
+    def check_for_changes():
+        # Reload the config file if it changed since the last time the app read it. A stat() call is
+        # all this costs when nothing changed, so the app calls it every time through its loop.
+        # Returns True if there's a new settings snapshot. If the new config is bad, the app logs
+        # the problem and keeps the settings it already has.
+        try:
+            config_stat = Settings._stat_config()
+        except OSError as e:
+            logging.error('Settings: Unable to check {}: {}'.format(CONFIG_FILE, e))
+            return False
+        if config_stat == Settings._config_stat:
+            return False
+        logging.info('Settings: {} changed, reloading'.format(CONFIG_FILE))
+        try:
+            Settings._load()
+        except Exception as e:
+            # don't try again until the file changes again
+            Settings._config_stat = config_stat
+            logging.error('Settings: Ignoring the new configuration: {}'.format(e))
+            return False
+        return True
+
+    @staticmethod
+    def _stat_config():
+        config_stat = os.stat(CONFIG_FILE)
+        return config_stat.st_mtime_ns, config_stat.st_size
+
+    @staticmethod
+    def _load():
+        global _config
+
+        with Settings._reload_lock:
+            config_stat = Settings._stat_config()
+            config = Settings._read_config(CONFIG_FILE)
+            snapshot = Settings._build_snapshot(config, Settings._snapshot)
+            # publish the new settings
+            _config = config
+            Settings._config_stat = config_stat
+            Settings._snapshot = snapshot
+
+    @staticmethod
+    def load_snapshot(path, previous=None):
+        # Read a config file and return a settings snapshot for it without touching the app's own
+        # settings (server.py uses this for each user's config file). Raises an exception if the file
+        # isn't valid.
+        return Settings._build_snapshot(Settings._read_config(path), previous)
+
+    @staticmethod
+    def _read_config(path):
+        # Read the config file contents
+        # https://martin-thoma.com/configuration-files-in-python/
+        with open(path) as json_data_file:
+            config = json.load(json_data_file)
+        #  did the config read correctly?
+        if not isinstance(config, dict):
+            raise ValueError('{} must contain a JSON object'.format(path))
+        logging.info('Config file read')
+        return config
+
+    @staticmethod
+    def _build_snapshot(config, previous):
+        # Validate the config and build a new settings snapshot from it (raises an exception if the
+        # config isn't valid). Derived values are reused from the previous snapshot when their
+        # config values didn't change.
+        get_value = Settings.get_config_value
+        # the reminder stages (see alert_stages.py)
+        alert_stages_table = get_value(config, 'alert_stages', DEFAULT_ALERT_STAGES)
+        if not isinstance(alert_stages_table, list):
+            raise ValueError('alert_stages must be a list')
+        if previous is not None and previous.alert_stages.table == alert_stages_table:
+            alert_stages = previous.alert_stages
+        else:
+            alert_stages = AlertStages(alert_stages_table)
+        busy_only = get_value(config, 'busy_only', False)
+        calendars = get_value(config, 'calendars', ['primary'])
+        if not isinstance(calendars, list):
+            raise ValueError('calendars must be a list')
+        debug_mode = get_value(config, 'debug_mode', False)
+        # what the app draws on (see display_backends.py), and where the png backend saves its frames
+        display_backend = get_value(config, 'display_backend', 'unicornhathd')
+        # read directly, get_value() uses the default (true) for false: free/busy mode only works with
+        # the meeting summaries turned off
+        display_meeting_summary = config.get('display_meeting_summary')
+        if display_meeting_summary is None:
+            display_meeting_summary = True
+        display_record_path = get_value(config, 'display_record_path', 'frames')
+        ignore_in_summary = get_value(config, 'ignore_in_summary', [])
+        if not isinstance(ignore_in_summary, list):
+            raise ValueError('ignore_in_summary must be a list')
+        # compile the ignore list once, here, rather than every time the app checks an event
+        if previous is not None and previous.ignore_in_summary == tuple(ignore_in_summary):
+            ignore_matcher = previous.ignore_matcher
+        else:
+            ignore_matcher = IgnoreMatcher(ignore_in_summary)
+        # the longest the app waits between calendar refreshes (seconds), during and outside working
+        # hours (see refresh_policy.py)
+        max_refresh_interval = int(get_value(config, 'max_refresh_interval', 900))
+        off_hours_refresh_interval = int(get_value(config, 'off_hours_refresh_interval', 3600))
+        # calendar change notifications (see push_receiver.py): the public URL Google posts them to (off if
+        # empty), the port the app listens on, and the refresh interval (seconds) while they're coming in
+        push_address = get_value(config, 'push_address', '')
+        push_port = int(get_value(config, 'push_port', 8085))
+        push_refresh_interval = int(get_value(config, 'push_refresh_interval', 3600))
+        # the log file format: text, or json (one JSON object per line, see app_logging.py)
+        log_format = get_value(config, 'log_format', 'text')
+        if log_format not in ('text', 'json'):
+            raise ValueError('log_format must be text or json')
+        # where to publish the app's metrics (both are off by default)
+        metrics_file = get_value(config, 'metrics_file', '')
+        metrics_port = int(get_value(config, 'metrics_port', 0))
+        reminder_only = get_value(config, 'reminder_only', False)
+        use_free_busy = get_value(config, 'use_free_busy', False)
+        use_reboot_counter = get_value(config, 'use_reboot_counter', False)
+        logging.info('Alert Stages: {}'.format(alert_stages.table))
+        logging.info('Busy only: {}'.format(busy_only))
+        logging.info('Calendars: {}'.format(calendars))
+        logging.info('Debug Mode: {}'.format(debug_mode))
+        logging.info('Display Backend: {}'.format(display_backend))
+        logging.info('Display Meeting Summary: {}'.format(display_meeting_summary))
+        logging.info('Ignore in Meeting Summary: {}'.format(ignore_in_summary))
+        logging.info('Log Format: {}'.format(log_format))
+        logging.info('Max Refresh Interval: {}'.format(max_refresh_interval))
+        logging.info('Metrics File: {}'.format(metrics_file))
+        logging.info('Metrics Port: {}'.format(metrics_port))
+        logging.info('Off Hours Refresh Interval: {}'.format(off_hours_refresh_interval))
+        logging.info('Push Address: {}'.format(push_address))
+        logging.info('Push Port: {}'.format(push_port))
+        logging.info('Push Refresh Interval: {}'.format(push_refresh_interval))
+        logging.info('Reminder Only: {}'.format(reminder_only))
+        logging.info('Use Free/Busy: {}'.format(use_free_busy))
+
+        logging.info('Use Reboot Counter: {}'.format(use_reboot_counter))
+        reboot_counter_limit = None
+        if use_reboot_counter:
+            reboot_counter_limit = int(get_value(config, 'reboot_counter_limit', 10))
+            logging.info('Reboot Counter Limit: {}'.format(reboot_counter_limit))
+
+        use_remote_notify = get_value(config, 'use_remote_notify', False)
+        logging.info('Use Remote Notify: {}'.format(use_remote_notify))
+        access_token = None
+        device_id = None
+        # if remote notify is enabled, that's the only time we need...
+        if use_remote_notify:
+            access_token = get_value(config, 'access_token', "")
+            device_id = get_value(config, 'device_id', "")
+            logging.info('Access Token: {}'.format(access_token))
+            logging.info('Device ID: {}'.format(device_id))
+
+        use_working_hours = get_value(config, 'use_working_hours', False)
+        logging.debug('Use Working Hours: %s', use_working_hours)
+        work_start = None
+        work_end = None
+        if use_working_hours:
+            # if working hours are enabled, that's the only time we need...
+            # convert the time string to a time value
+            work_start = datetime.datetime.strptime(get_value(config, 'work_start', "8:00"), '%H:%M').time()
+            work_end = datetime.datetime.strptime(get_value(config, 'work_end', "17:30"), '%H:%M').time()
+            logging.info('Work Start: {}'.format(work_start))
+            logging.info('Work End: {}'.format(work_end))
+
+        return SettingsSnapshot(
+            version=1 if previous is None else previous.version + 1,
+            access_token=access_token, alert_stages=alert_stages, busy_only=busy_only, calendars=tuple(calendars),
+            debug_mode=debug_mode, device_id=device_id, display_backend=display_backend,
+            display_meeting_summary=display_meeting_summary, display_record_path=display_record_path,
+            ignore_in_summary=tuple(ignore_in_summary), ignore_matcher=ignore_matcher, log_format=log_format,
+            max_refresh_interval=max_refresh_interval, metrics_file=metrics_file, metrics_port=metrics_port,
+            off_hours_refresh_interval=off_hours_refresh_interval, push_address=push_address, push_port=push_port,
+            push_refresh_interval=push_refresh_interval, reboot_counter_limit=reboot_counter_limit,
+            reminder_only=reminder_only,
+            use_free_busy=use_free_busy, use_reboot_counter=use_reboot_counter, use_remote_notify=use_remote_notify,
+            use_working_hours=use_working_hours, work_end=work_end, work_start=work_start)
+
     @staticmethod
     def validate_config_options():
         # list config options, especially missing ones
@@ -123,7 +267,7 @@ class Settings:
 
     @staticmethod
     def get_config_value(config_object, key, default_value):
-        logging.info('get_config_value(_config, {}, {})'.format(key, default_value))
+        logging.debug('get_config_value(_config, %s, %s)', key, default_value)
         try:
             value = config_object[key]
             if value:
@@ -135,57 +279,113 @@ class Settings:
 
     @staticmethod
     def get_access_token():
-        assert Settings._use_remote_notify is True, "Remote Notify disabled"
-        return Settings._access_token
+        assert Settings._snapshot.use_remote_notify is True, "Remote Notify disabled"
+        return Settings._snapshot.access_token
+
+    @staticmethod
+    def get_alert_stages():
+        return Settings._snapshot.alert_stages
 
     @staticmethod
     def get_busy_only():
-        return Settings._busy_only
+        return Settings._snapshot.busy_only
+
+    @staticmethod
+    def get_calendars():
+        return Settings._snapshot.calendars
 
     @staticmethod
     def get_debug_mode():
-        return Settings._debug_mode
+        return Settings._snapshot.debug_mode
 
     @staticmethod
     def get_device_id():
-        assert Settings._use_remote_notify is True, "Remote Notify disabled"
-        return Settings._device_id
+        assert Settings._snapshot.use_remote_notify is True, "Remote Notify disabled"
+        return Settings._snapshot.device_id
+
+    @staticmethod
+    def get_display_backend():
+        return Settings._snapshot.display_backend
 
     @staticmethod
     def get_display_meeting_summary():
-        return Settings._display_meeting_summary
+        return Settings._snapshot.display_meeting_summary
+
+    @staticmethod
+    def get_display_record_path():
+        return Settings._snapshot.display_record_path
 
     @staticmethod
     def get_ignore_in_summary():
-        return Settings._ignore_in_summary
+        return Settings._snapshot.ignore_in_summary
+
+    @staticmethod
+    def get_ignore_matcher():
+        return Settings._snapshot.ignore_matcher
+
+    @staticmethod
+    def get_log_format():
+        return Settings._snapshot.log_format
+
+    @staticmethod
+    def get_max_refresh_interval():
+        return Settings._snapshot.max_refresh_interval
+
+    @staticmethod
+    def get_metrics_file():
+        return Settings._snapshot.metrics_file
+
+    @staticmethod
+    def get_metrics_port():
+        return Settings._snapshot.metrics_port
+
+    @staticmethod
+    def get_off_hours_refresh_interval():
+        return Settings._snapshot.off_hours_refresh_interval
+
+    @staticmethod
+    def get_push_address():
+        return Settings._snapshot.push_address
+
+    @staticmethod
+    def get_push_port():
+        return Settings._snapshot.push_port
+
+    @staticmethod
+    def get_push_refresh_interval():
+        return Settings._snapshot.push_refresh_interval
 
     @staticmethod
     def get_reminder_only():
-        return Settings._reminder_only
+        return Settings._snapshot.reminder_only
 
     @staticmethod
     def get_use_reboot_counter():
-        return Settings._use_reboot_counter
+        return Settings._snapshot.use_reboot_counter
 
     @staticmethod
     def get_reboot_counter_limit():
-        assert Settings._use_reboot_counter is True, "Reboot counter disabled"
-        return Settings._reboot_counter_limit
+        assert Settings._snapshot.use_reboot_counter is True, "Reboot counter disabled"
+        return Settings._snapshot.reboot_counter_limit
+
+    @staticmethod
+    def get_use_free_busy():
+        return Settings._snapshot.use_free_busy
 
     @staticmethod
     def get_use_remote_notify():
-        return Settings._use_remote_notify
+        return Settings._snapshot.use_remote_notify
 
     @staticmethod
     def get_use_working_hours():
-        return Settings._use_working_hours
+        return Settings._snapshot.use_working_hours
 
     @staticmethod
     def get_work_start():
-        assert Settings._use_working_hours is True, "Working hours disabled"
-        return Settings._work_start
+        assert Settings._snapshot.use_working_hours is True, "Working hours disabled"
+        return Settings._snapshot.work_start
 
     @staticmethod
     def get_work_end():
-        assert Settings._use_working_hours is True, "Working hours disabled"
-        return Settings._work_end
+        assert Settings._snapshot.use_working_hours is True, "Working hours disabled"
+        return Settings._snapshot.work_end
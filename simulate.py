@@ -0,0 +1,434 @@
+#!/usr/bin/python
+"""*****************************************************************************************************************
+    Pi Remind HD Notify - Simulator
+
+    Runs the app's main loop against a fake calendar on a virtual clock, so a week of meetings goes by in a few
+    seconds. The display is the in-memory display backend and the Remote Notify device is a fake that just records
+    the status it's sent, so no hardware, network or Google account is needed. The calendar is either a random
+    (but repeatable) working week of meetings, or events recorded from the Calendar API (a JSON list of event
+    objects, like the items in an events().list response). A few of the random meetings (and a few extra evening
+    meetings) are only added to the calendar 10 to 20 minutes before they start, to check the app finds them (and
+    reminds the user) before the last reminder stage starts.
+
+    Reports the CPU time (and optionally memory allocated) for every pass through the loop, how many calendar
+    requests and Remote Notify updates the app made, and whether every reminder stage was shown on time.
+
+    Usage: python simulate.py [--days 7] [--seed 1] [--events events.json] [--config config.json] [--font font.ttf]
+                              [--late-additions 10] [--allocations]
+********************************************************************************************************************"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# the app's folder, the simulator runs in a temporary folder so it doesn't touch the app's files
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_FOLDER)
+
+import clock
+import display_backends
+import unicorn_hat as unicorn
+
+# settings for the simulated app (anything not here uses the app's defaults)
+SIMULATION_CONFIG = {
+    'display_backend': 'memory',
+    'display_meeting_summary': True,
+    'use_remote_notify': True,
+    'access_token': 'simulated',
+    'device_id': 'simulated',
+    'use_working_hours': True,
+    'work_start': '8:00',
+    'work_end': '17:30'}
+# a reminder is late if it's shown more than this many seconds after its stage starts
+LATE_THRESHOLD = 1.0
+# the random calendar: meetings start on the half hour during the work day, this often
+MEETING_PROBABILITY = 0.4
+MEETING_LENGTHS = (30, 30, 60)
+FIRST_MEETING_HOUR = 9
+LAST_MEETING_HOUR = 17
+# meetings added at the last minute show up on the calendar this many minutes before they start, half
+# of them are extra meetings in the evening (outside working hours)
+LATE_ADDITION_MINUTES = (10, 20)
+EVENING_HOURS = (19, 22)
+# the (simulator only) event field with the time (clock.time()) the event was added to the calendar
+ADDED = 'simulatedAdded'
+
+
+class FakeRequest:
+
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self, http=None):
+        return self._result
+
+
+class FakeCalendarService:
+    # Just enough of the Calendar API service for the app: events().list and freebusy().query,
+    # answered from a list of events. An event with an ADDED time isn't on the calendar until then.
+
+    def __init__(self, events):
+        self._events = events
+        self.requests = 0
+
+    def events(self):
+        return self
+
+    def freebusy(self):
+        return self
+
+    def list(self, **kwargs):
+        self.requests += 1
+        # the sync token is the time of the sync, the next incremental sync returns the events added since
+        now = clock.time()
+        if kwargs.get('syncToken'):
+            since = float(kwargs['syncToken'])
+            items = [event for event in self._events if since < event.get(ADDED, 0) <= now]
+            return FakeRequest({'items': items, 'nextSyncToken': str(now)})
+        time_min = kwargs.get('timeMin')
+        time_max = kwargs.get('timeMax')
+        items = [event for event in self._get_events(now)
+                 if _overlaps(event['start']['dateTime'], event['end']['dateTime'], time_min, time_max)]
+        return FakeRequest({'items': items, 'nextSyncToken': str(now)})
+
+    def query(self, body):
+        self.requests += 1
+        busy_times = sorted((_parse_time(event['start']['dateTime']), _parse_time(event['end']['dateTime']))
+                            for event in self._get_events(clock.time())
+                            if event.get('status') != 'cancelled' and not event.get('transparency') and
+                            _overlaps(event['start']['dateTime'], event['end']['dateTime'], body['timeMin'],
+                                      body['timeMax']))
+        # like the real thing, busy times that overlap or touch are merged into one
+        merged = []
+        for start, end in busy_times:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        busy = [{'start': start.isoformat(), 'end': end.isoformat()} for start, end in merged]
+        return FakeRequest({'calendars': {item['id']: {'busy': busy} for item in body['items']}})
+
+    def _get_events(self, now):
+        # the events on the calendar at now
+        return [event for event in self._events if event.get(ADDED, 0) <= now]
+
+
+class FakePublisher:
+    # Stands in for the ParticlePublisher, records every status sent (and when)
+
+    def __init__(self):
+        self.sent = []
+
+    def publish(self, status):
+        self.sent.append((clock.time(), status))
+
+    def get_state(self):
+        return {'delivered': self.sent[-1][1] if self.sent else None}
+
+    def stop(self):
+        pass
+
+
+def _parse_time(value):
+    from dateutil import parser
+    return parser.parse(value)
+
+
+def _overlaps(start, end, time_min, time_max):
+    if time_min is not None and _parse_time(end) <= _parse_time(time_min):
+        return False
+    if time_max is not None and _parse_time(start) >= _parse_time(time_max):
+        return False
+    return True
+
+
+def random_calendar(start, days, seed):
+    # A repeatable, random working week of meetings starting at start (a local datetime)
+    rng = random.Random(seed)
+    local_tz = datetime.datetime.now().astimezone().tzinfo
+    events = []
+    for day in range(days):
+        date = (start + datetime.timedelta(days=day)).date()
+        if date.weekday() > 4:
+            continue
+        busy_until = None
+        for slot in range((LAST_MEETING_HOUR - FIRST_MEETING_HOUR) * 2):
+            event_start = datetime.datetime.combine(date, datetime.time(FIRST_MEETING_HOUR)).replace(
+                tzinfo=local_tz) + datetime.timedelta(minutes=slot * 30)
+            if (busy_until is not None and event_start < busy_until) or rng.random() > MEETING_PROBABILITY:
+                continue
+            event_end = event_start + datetime.timedelta(minutes=rng.choice(MEETING_LENGTHS))
+            busy_until = event_end
+            event = {
+                'id': 'event{}'.format(len(events)),
+                'status': 'confirmed',
+                'updated': start.isoformat(),
+                'summary': 'Meeting {}'.format(len(events)),
+                'start': {'dateTime': event_start.isoformat()},
+                'end': {'dateTime': event_end.isoformat()},
+                'reminders': {'useDefault': True}}
+            # now and then, a tentative (free) event
+            if rng.random() < 0.1:
+                event['transparency'] = 'transparent'
+            events.append(event)
+    return events
+
+
+def add_late(events, count, seed, start, days):
+    # Have count meetings show up on the calendar shortly before they start: half of them are random
+    # events from the working day, the other half new evening meetings
+    rng = random.Random(seed)
+    local_tz = datetime.datetime.now().astimezone().tzinfo
+    late = rng.sample(events, min(count - count // 2, len(events)))
+    for index in range(count // 2):
+        date = (start + datetime.timedelta(days=rng.randrange(days))).date()
+        event_start = datetime.datetime.combine(date, datetime.time(rng.randrange(*EVENING_HOURS))).replace(
+            tzinfo=local_tz)
+        event = {
+            'id': 'evening{}'.format(index),
+            'status': 'confirmed',
+            'updated': start.isoformat(),
+            'summary': 'Evening meeting {}'.format(index),
+            'start': {'dateTime': event_start.isoformat()},
+            'end': {'dateTime': (event_start + datetime.timedelta(minutes=30)).isoformat()},
+            'reminders': {'useDefault': True}}
+        if any(other['start'] == event['start'] for other in events):
+            continue
+        events.append(event)
+        late.append(event)
+    for event in late:
+        minutes = rng.uniform(*LATE_ADDITION_MINUTES)
+        event[ADDED] = _parse_time(event['start']['dateTime']).timestamp() - minutes * 60
+    events.sort(key=lambda event: event['start']['dateTime'])
+
+
+def reminded_meetings(events, settings):
+    # The meetings the app should remind the user about, as (CalendarEvent, time added) tuples (the time
+    # added is 0 unless it's a late addition)
+    from calendar_event import CalendarEvent
+    # free/busy mode only knows about busy times (and doesn't use the ignore list or reminder_only)
+    free_busy = settings.use_free_busy and not settings.display_meeting_summary
+    meetings = []
+    for values in events:
+        event = CalendarEvent.from_api(values)
+        if event is None:
+            continue
+        if free_busy:
+            if not event.busy:
+                continue
+        elif settings.ignore_matcher.matches(event.summary.lower()) or (
+                settings.reminder_only and not event.has_reminder):
+            continue
+        meetings.append((event, values.get(ADDED, 0)))
+    if free_busy:
+        # Google merges busy times that overlap or touch, so a meeting that starts before the one
+        # before it ends (or as it ends) doesn't get reminders of its own
+        meetings.sort(key=lambda meeting: meeting[0].start)
+        busy_until = None
+        result = []
+        for event, event_added in meetings:
+            if busy_until is None or event.start > busy_until:
+                result.append((event, event_added))
+            busy_until = event.end if busy_until is None else max(busy_until, event.end)
+        meetings = result
+    return meetings
+
+
+def expected_alerts(events, settings, start, end):
+    # The reminders the app should show: one for every stage of every meeting, as long as the
+    # meeting is the next one when the stage starts. Returns (event, stage, stage start, stage end) tuples.
+    stages = settings.alert_stages
+    lead_times = stages.lead_times
+    meetings = reminded_meetings(events, settings)
+    starts = sorted(event.start.timestamp() for event, event_added in meetings)
+    alerts = []
+    for event, event_added in meetings:
+        if event_added:
+            # the app can't know about the meeting until its next refresh, see late_additions()
+            continue
+        event_start = event.start.timestamp()
+        for index, lead_time in enumerate(lead_times):
+            stage_start = event_start - lead_time * 60
+            # the stage ends when the next one starts (the app stops reminding a minute before the meeting)
+            stage_end = event_start - (lead_times[index - 1] * 60 if index > 0 else 60)
+            if stage_start < start or stage_end > end:
+                continue
+            # skip stages where another meeting starts first
+            if any(stage_start < other < event_start for other in starts):
+                continue
+            alerts.append((event, stages.get_stage(lead_time - 1), stage_start, stage_end))
+    return alerts
+
+
+def late_additions(events, settings, shown):
+    # For each meeting added at the last minute: when the app first reminded the user about it, in seconds
+    # from the start of the last reminder stage (the shortest lead time); the app should always have
+    # found the meeting by then. None if there wasn't a reminder before the reminders stop (a minute
+    # before the meeting). Returns (event, time added, delay) tuples for the meetings the app should
+    # remind the user about (see reminded_meetings()).
+    last_lead_time = settings.alert_stages.lead_times[0]
+    result = []
+    for event, event_added in reminded_meetings(events, settings):
+        if not event_added:
+            continue
+        event_start = event.start.timestamp()
+        times = [t for t, stage in shown if event_added <= t < event_start - 60]
+        result.append((event, event_added, times[0] - (event_start - last_lead_time * 60) if times else None))
+    return result
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+def run(days, seed, events_file, config_file, font_file, late_count, allocations):
+    # local midnight, next Monday
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    start = today + datetime.timedelta(days=(7 - today.weekday()) % 7 or 7)
+    end = start + datetime.timedelta(days=days)
+    if events_file:
+        with open(events_file) as f:
+            events = json.load(f)
+    else:
+        events = random_calendar(start, days, seed)
+        add_late(events, late_count, seed, start, days)
+
+    # run in a temporary folder, with its own config.json and state.json
+    work_folder = tempfile.mkdtemp(prefix='remind-sim-')
+    config = dict(SIMULATION_CONFIG)
+    if config_file:
+        with open(config_file) as f:
+            config.update(json.load(f))
+        config['display_backend'] = 'memory'
+    if font_file:
+        unicorn.FONT = (os.path.abspath(font_file), unicorn.FONT[1])
+    if config.get('display_meeting_summary') and not os.path.exists(unicorn.FONT[0]):
+        print('Font file not found ({}), not displaying meeting summaries'.format(unicorn.FONT[0]))
+        config['display_meeting_summary'] = False
+    with open(os.path.join(work_folder, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    os.chdir(work_folder)
+    logging.basicConfig(level=logging.WARNING)
+
+    virtual_clock = clock.VirtualClock(start.timestamp())
+    clock.set_clock(virtual_clock)
+    import remind
+    import scheduler
+    from google_calendar import GoogleCalendar
+    from settings import Settings
+
+    settings = Settings.get_instance()
+    hat = display_backends.MemoryBackend()
+    unicorn.init(hat)
+    remind.use_remote_notify = True
+    remind.publisher = FakePublisher()
+    remind.apply_settings(settings.get_snapshot())
+    service = FakeCalendarService(events)
+    remind.cal = GoogleCalendar(service=service)
+
+    print('Simulating {} days from {} ({} events)'.format(days, start, len(events)))
+    wakeups = scheduler.Scheduler()
+    next_refresh = clock.time()
+    tick_cpu = []
+    tick_memory = []
+    shown = []
+    last_alert_time = remind.last_alert_time
+    if allocations:
+        tracemalloc.start()
+    wall_start = time.perf_counter()
+    while clock.time() < end.timestamp():
+        if allocations:
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+        cpu_start = time.process_time()
+        next_refresh = remind.process_tick(wakeups, next_refresh)
+        tick_cpu.append(time.process_time() - cpu_start)
+        if allocations:
+            tick_memory.append(tracemalloc.get_traced_memory()[1] - memory_start)
+        if remind.last_alert_time != last_alert_time:
+            last_alert_time = remind.last_alert_time
+            shown.append((last_alert_time, remind.last_alert_stage))
+    wall_time = time.perf_counter() - wall_start
+    if allocations:
+        tracemalloc.stop()
+    remind.cal.stop()
+    os.chdir(APP_FOLDER)
+    shutil.rmtree(work_folder, ignore_errors=True)
+
+    # match the reminders shown with the ones we expected
+    late = []
+    missed = []
+    delays = []
+    for event, stage, stage_start, stage_end in expected_alerts(events, settings.get_snapshot(), start.timestamp(),
+                                                                 end.timestamp()):
+        times = [t for t, s in shown if s is stage and stage_start <= t < stage_end]
+        if not times:
+            missed.append((event, stage))
+            continue
+        delay = times[0] - stage_start
+        delays.append(delay)
+        if delay > LATE_THRESHOLD:
+            late.append((event, stage, delay))
+
+    print('Simulated {:.1f} hours in {:.2f} seconds ({:.0f}x)'.format(
+        (end - start).total_seconds() / 3600, wall_time, (end - start).total_seconds() / wall_time))
+    print('Ticks: {}'.format(len(tick_cpu)))
+    print('CPU per tick: mean {:.3f} ms, median {:.3f} ms, 95th percentile {:.3f} ms, max {:.3f} ms'.format(
+        1000 * sum(tick_cpu) / len(tick_cpu), 1000 * percentile(tick_cpu, 0.5), 1000 * percentile(tick_cpu, 0.95),
+        1000 * max(tick_cpu)))
+    if allocations:
+        print('Memory allocated per tick (peak): mean {:.1f} KB, 95th percentile {:.1f} KB, max {:.1f} KB'.format(
+            sum(tick_memory) / len(tick_memory) / 1024, percentile(tick_memory, 0.95) / 1024,
+            max(tick_memory) / 1024))
+    additions = late_additions(events, settings.get_snapshot(), shown)
+    late_added = [(event, event_added, delay) for event, event_added, delay in additions
+                  if delay is None or delay > LATE_THRESHOLD]
+    if additions:
+        print('Late additions: {} meetings added {} to {} minutes before they start, {} reminded before the last '
+              'stage, {} late'.format(len(additions), LATE_ADDITION_MINUTES[0], LATE_ADDITION_MINUTES[1],
+                                      len(additions) - len(late_added), len(late_added)))
+    print('Calendar requests: {}'.format(service.requests))
+    print('Remote Notify updates: {}'.format(len(remind.publisher.sent)))
+    print('Frames shown: {} ({} unchanged frames skipped)'.format(hat.show_count, hat.skip_count))
+    print('Reminders: {} shown, {} stage starts expected, {} late, {} missed, max delay {:.3f} s'.format(
+        len(shown), len(delays) + len(missed), len(late), len(missed), max(delays) if delays else 0))
+    for event, stage, delay in late:
+        print('  late: {} at {} ({} minute stage) by {:.1f} s'.format(
+            event.summary, event.start.astimezone(), stage.lead_time, delay))
+    for event, stage in missed:
+        print('  missed: {} at {} ({} minute stage)'.format(event.summary, event.start.astimezone(), stage.lead_time))
+    for event, event_added, delay in late_added:
+        print('  late addition: {} at {} (added {:.1f} minutes before) {}'.format(
+            event.summary, event.start.astimezone(), (event.start.timestamp() - event_added) / 60,
+            'not reminded' if delay is None else 'reminded {:.1f} s after the last stage started'.format(delay)))
+    return len(late) + len(missed) + len(late_added)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the app against a simulated calendar on a virtual clock')
+    parser.add_argument('--days', type=int, default=7, help='how many days to simulate')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the generated calendar')
+    parser.add_argument('--events', help='JSON file with a list of Calendar API events to use instead')
+    parser.add_argument('--config', help='JSON file with settings to use (on top of the simulator\'s)')
+    parser.add_argument('--font', help='TTF font file for the meeting summaries (if the app\'s font isn\'t installed)')
+    parser.add_argument('--late-additions', type=int, default=10,
+                        help='how many of the random meetings are added to the calendar shortly before they start')
+    parser.add_argument('--allocations', action='store_true', help='measure memory allocated every tick (slower)')
+    args = parser.parse_args()
+    problems = run(args.days, args.seed, args.events, args.config, args.font, args.late_additions, args.allocations)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""*****************************************************************************************************************
+    Pi Remind HD Notify - Startup Benchmark
+
+    Measures how long the app takes to start, reporting the time spent importing modules separately from the time
+    spent initializing (loading settings and saved state, setting up the display, connecting to Google Calendar,
+    and the first calendar check). Run it from the app's folder, the initialization steps use the app's
+    config.json, token.pickle and discovery.json files just like the app does.
+
+    If the unicornhathd module isn't installed, the benchmark uses the in-memory display backend instead.
+
+    Usage: python startup_benchmark.py
+********************************************************************************************************************"""
+
+from __future__ import print_function
+
+import importlib
+import sys
+import time
+
+# the app's modules, in the order remind.py imports them
+APP_MODULES = ['display_backends', 'display_engine', 'google_calendar', 'particle', 'scheduler', 'settings',
+               'state_store', 'status', 'unicorn_hat', 'remind']
+# third party modules the app only imports when they're needed
+LAZY_MODULES = ['PIL', 'requests', 'google_auth_oauthlib']
+
+
+def timed(name, fn):
+    # run fn, print how long it took, return its result (or None if it failed)
+    start = time.perf_counter()
+    try:
+        result = fn()
+    except BaseException as e:
+        print('  {:<28} failed: {}'.format(name, e))
+        return None
+    print('  {:<28} {:>8.1f} ms'.format(name, (time.perf_counter() - start) * 1000))
+    return result
+
+
+def create_backend(settings):
+    # the configured display backend, or the in-memory one if the Unicorn HAT HD isn't available
+    import display_backends
+    try:
+        return display_backends.create_backend(settings.get_display_backend(), settings.get_display_record_path())
+    except ImportError:
+        print('  unicornhathd module not found, using the memory display backend')
+        return display_backends.MemoryBackend()
+
+
+def main():
+    print('Import phase')
+    start = time.perf_counter()
+    for module in APP_MODULES:
+        timed(module, lambda: importlib.import_module(module))
+    print('  {:<28} {:>8.1f} ms'.format('total', (time.perf_counter() - start) * 1000))
+    print('  not imported yet: {}'.format(', '.join(m for m in LAZY_MODULES if m not in sys.modules) or 'none'))
+
+    remind = sys.modules['remind']
+    print('Init phase')
+    start = time.perf_counter()
+    settings = timed('settings', remind.Settings.get_instance)
+    timed('state store', remind.StateStore.get_instance)
+    if settings is not None:
+        timed('display', lambda: remind.unicorn.init(create_backend(settings)))
+    if settings is not None and settings.get_display_meeting_summary():
+        timed('text support', remind.unicorn.init_text)
+    cal = timed('google calendar', remind.GoogleCalendar) if settings is not None else None
+    if cal is not None:
+        timed('first calendar check', lambda: cal.get_status(settings.get_alert_stages().search_limit))
+    print('  {:<28} {:>8.1f} ms'.format('total', (time.perf_counter() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+###########################################################
+# State Store module
+#
+# Keeps the app's working state (calendar sync tokens and
+# cached events, the last Remote Notify status sent, error
+# counters) in a small JSON file, so a restart picks up
+# where the app left off instead of starting from scratch.
+# The file is written atomically (see atomic_file.py), so
+# a crash or power cut never leaves a half-written file
+# behind.
+###########################################################
+
+import json
+import logging
+import os
+import threading
+
+import atomic_file
+
+STATE_FILE = 'state.json'
+
+
+class StateStore:
+
+    # the app's instance of this class (server.py gives each user their own instead)
+    __instance = None
+
+    def __init__(self, path=STATE_FILE):
+        self._path = path
+        self._lock = threading.Lock()
+        self._state = {}
+        # whether there are changes that haven't been saved yet
+        self._dirty = False
+        self._load()
+
+    @staticmethod
+    def get_instance():
+        if StateStore.__instance is None:
+            StateStore.__instance = StateStore()
+        return StateStore.__instance
+
+    def get(self, key, default_value=None):
+        with self._lock:
+            return self._state.get(key, default_value)
+
+    def set(self, key, value):
+        with self._lock:
+            if self._state.get(key) != value:
+                self._state[key] = value
+                self._dirty = True
+
+    def save(self):
+        # Write the state to disk, if anything changed since the last save
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self._state)
+            self._dirty = False
+        try:
+            atomic_file.write(self._path, data)
+            logging.debug('State Store: Saved %s', self._path)
+        except Exception as e:
+            logging.error('State Store: Unable to save {}: {}'.format(self._path, e))
+            with self._lock:
+                self._dirty = True
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path) as state_file:
+                self._state = json.load(state_file)
+            logging.info('State Store: Loaded {}'.format(self._path))
+        except Exception as e:
+            # start over rather than fail, the state is only there to make restarts quicker
+            logging.error('State Store: Unable to load {}: {}'.format(self._path, e))
+            self._state = {}
@@ -2,21 +2,22 @@
 #  Unicorn HAT module
 #
 # exposes properties and methods for the Unicorn HAT LED
-# array
+# array. Everything is drawn on a display backend (see
+# display_backends.py), the real Unicorn HAT HD unless
+# init() is given a different one.
 ###########################################################
 
-import math
-import time
-import unicornhathd
+from collections import OrderedDict
+import clock
+import display_backends
+import numpy
+import threading
 
-# =======================================================================================
-# Borrowed from: https://github.com/pimoroni/unicorn-hat-hd/blob/master/examples/text.py
-# =======================================================================================
-try:
-    from PIL import Image, ImageDraw, ImageFont
-except ImportError:
-    exit("This script requires the pillow module\nInstall with: sudo pip install pillow")
-# =======================================================================================
+# pillow is only needed to display text (meeting summaries) and is slow to import, so
+# init_text() imports it the first time it's needed
+Image = None
+ImageDraw = None
+ImageFont = None
 
 # COLORS
 RED = (255, 0, 0)
@@ -26,29 +27,56 @@ ORANGE = (255, 153, 0)
 WHITE = (255, 255, 255)
 YELLOW = (255, 255, 0)
 BLACK = (0, 0, 0)
+MAGENTA = (255, 0, 255)
 
 # constants used in the app to display status
 CHECKING_COLOR = BLUE
 SUCCESS_COLOR = GREEN
 FAILURE_COLOR = RED
-
+# the app can't reach Google, but it's still working from the events it already knows about
+STALE_COLOR = MAGENTA
+
+# Use `fc-list` to show a list of installed fonts on your system,
+# or `ls /usr/share/fonts/` and explore.
+FONT = ('/usr/share/fonts/truetype/roboto/Roboto-Bold.ttf', 10)
+
+# delay between scrolling text frames (seconds)
+TEXT_DELAY = 0.01
+# maximum number of rendered messages to keep around
+TEXT_CACHE_SIZE = 8
+# delay between swirl animation frames (seconds)
+SWIRL_DELAY = 0.01
+# maximum number of precomputed swirl animations to keep around
+SWIRL_CACHE_SIZE = 4
+
+# the display backend everything is drawn on
+_hat = None
 current_activity_light = 0
 indicator_row = 0
 u_height = 0
 u_width = 0
+# fonts loaded from disk, keyed by (font file, size)
+_fonts = {}
+# rendered messages, keyed by (message, color, font); least recently used first
+_text_cache = OrderedDict()
+# precomputed swirl animation frames, keyed by duration and display geometry
+_swirl_cache = {}
+# set to stop the running animation early (see interrupt())
+_interrupted = threading.Event()
 
 
-def init():
-    global current_activity_light, indicator_row, u_height, u_width
+def init(backend=None):
+    global _hat, current_activity_light, indicator_row, u_height, u_width
 
+    _hat = backend if backend is not None else display_backends.UnicornHatBackend()
     # Clear the display (just in case)
-    unicornhathd.clear()
+    _hat.clear()
     # Initialize  all LEDs to black
-    unicornhathd.set_all(0, 0, 0)
+    _hat.set_all(0, 0, 0)
     # set the display orientation to zero degrees
-    unicornhathd.rotation(90)
+    _hat.rotation(90)
     # set u_width and u_height with the appropriate parameters for the HAT
-    u_width, u_height = unicornhathd.get_shape()
+    u_width, u_height = _hat.get_shape()
     # calculate where we want to put the indicator light
     indicator_row = u_height - 1
 
@@ -59,88 +87,134 @@ def init():
 
     # Set a specific brightness level for the Pimoroni Unicorn HAT, otherwise it's pretty bright.
     # Comment out the line below to see what the default looks like.
-    unicornhathd.brightness(0.5)
+    _hat.brightness(0.5)
+
+
+def init_text():
+    global Image, ImageDraw, ImageFont
+    if Image is None:
+        # =======================================================================================
+        # Borrowed from: https://github.com/pimoroni/unicorn-hat-hd/blob/master/examples/text.py
+        # =======================================================================================
+        try:
+            from PIL import Image, ImageDraw, ImageFont
+        except ImportError:
+            exit("This script requires the pillow module\nInstall with: sudo pip install pillow")
+        # =======================================================================================
+
+
+def _get_font(font):
+    # Loading the TTF file is slow, so only do it once per font
+    if font not in _fonts:
+        font_file, font_size = font
+        _fonts[font] = ImageFont.truetype(font_file, font_size)
+    return _fonts[font]
+
+
+def render_text(message, color=WHITE, font=None):
+    # Renders the message to a numpy array indexed [x][y] (like the HAT's buffer) with enough blank
+    # space on either side to scroll it on and then off the display. The same meeting summary
+    # scrolls by every minute, so rendered messages are kept in a small LRU cache.
+    global u_height, u_width
 
+    font = font or FONT
+    key = (message, color, font)
+    if key in _text_cache:
+        _text_cache.move_to_end(key)
+        return _text_cache[key]
+
+    init_text()
+    # code borrowed from: https://github.com/pimoroni/unicorn-hat-hd/blob/master/examples/text.py
+    text_x = u_width
+    text_y = 2
+    image_font = _get_font(font)
+    # =====================================================================
+    # I'm really not sure what all this code does...that's what happens when you 'borrow' code
+    # it basically sets up the width of the display string to include the string as well as enough
+    # space to scroll it off the screen
+    # =====================================================================
+    text_width, text_height = u_width, 0
+    if hasattr(image_font, 'getbbox'):
+        # newer versions of pillow dropped getsize()
+        w, h = image_font.getbbox(message)[2:]
+    else:
+        w, h = image_font.getsize(message)
+    text_width += w + u_width
+    text_height = max(text_height, h)
+    text_width += u_width + text_x + 1
+    image = Image.new("RGB", (text_width, max(u_height, text_height)), (0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    draw.text((text_x, text_y), message, color, font=image_font)
+    # images are indexed by row, then column, so swap that around to match the HAT
+    strip = numpy.asarray(image)[:u_height].transpose(1, 0, 2)
+
+    _text_cache[key] = strip
+    if len(_text_cache) > TEXT_CACHE_SIZE:
+        _text_cache.popitem(last=False)
+    return strip
 
-def display_text(message, color=WHITE):
-    # Use `fc-list` to show a list of installed fonts on your system,
-    # or `ls /usr/share/fonts/` and explore.
-    FONT = ('/usr/share/fonts/truetype/roboto/Roboto-Bold.ttf', 10)
 
-    global u_height, u_width
+def display_text(message, color=WHITE):
+    global u_width
 
     # do we have a message?
     if len(message) > 0:
         # then display it
-        # code borrowed from: https://github.com/pimoroni/unicorn-hat-hd/blob/master/examples/text.py
-        text_x = u_width
-        text_y = 2
-
-        font_file, font_size = FONT
-
-        font = ImageFont.truetype(font_file, font_size)
-
-        # =====================================================================
-        # I'm really not sure what all this code does...that's what happens when you 'borrow' code
-        # it basically sets up the width of the display string to include the string as well as enough
-        # space to scroll it off the screen
-        # =====================================================================
-        text_width, text_height = u_width, 0
-        w, h = font.getsize(message)
-        text_width += w + u_width
-        text_height = max(text_height, h)
-        text_width += u_width + text_x + 1
-        image = Image.new("RGB", (text_width, max(16, text_height)), (0, 0, 0))
-        draw = ImageDraw.Draw(image)
-        offset_left = 0
-        draw.text((text_x + offset_left, text_y), message, color, font=font)
-        offset_left += font.getsize(message)[0] + u_width
-        for scroll in range(text_width - u_width):
-            for x in range(u_width):
-                for y in range(u_height):
-                    pixel = image.getpixel((x + scroll, y))
-                    r, g, b = [int(n) for n in pixel]
-                    unicornhathd.set_pixel(u_width - 1 - x, y, r, g, b)
-            unicornhathd.show()
-            time.sleep(0.01)
-        unicornhathd.off()
-        # =====================================================================
-
-
-def swirl(x, y, step):
+        strip = render_text(message, color)
+        for scroll in range(strip.shape[0] - u_width):
+            # each frame is a slice of the rendered message, flipped left to right
+            _hat.buf[:] = strip[scroll:scroll + u_width][::-1]
+            _hat.show()
+            if _wait(TEXT_DELAY):
+                break
+        _hat.off()
+
+
+def swirl_frames(duration, cache=True):
+    # Returns all of the frames for a swirl animation as a single (duration, width, height, 3)
+    # array, computed in one numpy expression instead of pixel by pixel. The frames only depend
+    # on the duration and the display geometry, so they're cached for next time.
     global u_height, u_width
 
+    key = (duration, u_width, u_height)
+    if cache and key in _swirl_cache:
+        return _swirl_cache[key]
     # modified from: https://github.com/pimoroni/unicorn-hat-hd/blob/master/examples/demo.py
-    x -= (u_width / 2)
-    y -= (u_height / 2)
-    dist = math.sqrt(pow(x, 2) + pow(y, 2)) / 2.0
+    # x and y coordinates (relative to the center of the display) for every pixel, the buffer is indexed [x][y]
+    x, y = numpy.meshgrid(numpy.arange(u_width) - (u_width / 2), numpy.arange(u_height) - (u_height / 2),
+                          indexing='ij')
+    dist = numpy.sqrt(x ** 2 + y ** 2) / 2.0
+    # one row per frame; the step increments by 2 every frame
+    step = numpy.arange(duration).reshape(-1, 1, 1) * 2
     angle = (step / 10.0) + (dist * 1.5)
-    s = math.sin(angle)
-    c = math.cos(angle)
+    s = numpy.sin(angle)
+    c = numpy.cos(angle)
     xs = x * c - y * s
     ys = x * s + y * c
-    r = abs(xs + ys)
-    r = r * 12.0
-    r -= 20
-    return r, r + (s * 130), r + (c * 130)
-
-
-def do_swirl(duration):
-    # modified from: https://github.com/pimoroni/unicorn-hat-hd/blob/master/examples/demo.py
-    step = 0
-    for i in range(duration):
-        for y in range(u_height):
-            for x in range(u_width):
-                r, g, b = swirl(x, y, step)
-                r = int(max(0, min(255, r)))
-                g = int(max(0, min(255, g)))
-                b = int(max(0, min(255, b)))
-                unicornhathd.set_pixel(x, y, r, g, b)
-        step += 2
-        unicornhathd.show()
-        time.sleep(0.01)
+    r = numpy.abs(xs + ys) * 12.0 - 20
+    frames = numpy.clip(numpy.stack((r, r + (s * 130), r + (c * 130)), axis=-1), 0, 255).astype(numpy.uint8)
+    if cache:
+        # there are only a couple of swirl durations, but don't let the cache grow forever
+        if len(_swirl_cache) >= SWIRL_CACHE_SIZE:
+            _swirl_cache.clear()
+        _swirl_cache[key] = frames
+    return frames
+
+
+def do_swirl(duration, cache=True):
+    play_frames(swirl_frames(duration, cache), SWIRL_DELAY)
+
+
+def play_frames(frames, delay):
+    # play a precomputed animation (an array of frames, like the ones from swirl_frames())
+    for frame in frames:
+        # write the whole frame straight into the HAT's buffer
+        _hat.buf[:] = frame
+        _hat.show()
+        if _wait(delay):
+            break
     # turn off all lights when you're done
-    unicornhathd.off()
+    _hat.off()
 
 
 def set_activity_light(color, increment):
@@ -148,8 +222,9 @@ def set_activity_light(color, increment):
     # indicator when it connects to Google to check the calendar. Its intended as a subtle reminder that things
     # are still working.
     global current_activity_light
-    # turn off (clear) any lights that are on
-    unicornhathd.off()
+    # turn off (clear) any lights that are on; the cleared frame goes out with the new pixel below,
+    # in one update
+    _hat.clear()
     if increment:
         # OK. Which light will we be illuminating?
         if current_activity_light < 1:
@@ -158,14 +233,14 @@ def set_activity_light(color, increment):
         # increment the current light (to the next one)
         current_activity_light -= 1
     # set the pixel color
-    unicornhathd.set_pixel(current_activity_light, indicator_row, *color)
+    _hat.set_pixel(current_activity_light, indicator_row, *color)
     # show the pixel
-    unicornhathd.show()
+    _hat.show()
 
 
 def set_all(color):
-    unicornhathd.set_all(*color)
-    unicornhathd.show()
+    _hat.set_all(*color)
+    _hat.show()
 
 
 def flash_all(flash_count, delay, color):
@@ -173,33 +248,52 @@ def flash_all(flash_count, delay, color):
     # keep illuminated for 'delay' value
     for index in range(flash_count):
         # fill the light buffer with the specified color
-        unicornhathd.set_all(*color)
+        _hat.set_all(*color)
         # show the color
-        unicornhathd.show()
+        _hat.show()
         # wait a bit
-        time.sleep(delay)
+        interrupted = _wait(delay)
         # turn everything off
-        unicornhathd.off()
+        _hat.off()
         # wait a bit more
-        time.sleep(delay)
+        if interrupted or _wait(delay):
+            break
 
 
 def flash_random(flash_count, delay, between_delay=0):
     # Copied from https://github.com/pimoroni/unicorn-hat-hd/blob/master/examples/test.py
     for index in range(flash_count):
         # fill the light buffer with random colors
-        unicornhathd._buf = unicornhathd.numpy.random.randint(low=0, high=255, size=(16, 16, 3))
+        _hat.buf[:] = numpy.random.randint(low=0, high=255, size=(u_width, u_height, 3))
         # show the colors
-        unicornhathd.show()
+        _hat.show()
         # wait a bit
-        time.sleep(delay)
+        interrupted = _wait(delay)
         # turn everything off
-        unicornhathd.off()
+        _hat.off()
         # do we have a between_delay value??
-        if between_delay > 0:
-            # wait a bit more
-            time.sleep(between_delay)
+        if interrupted or (between_delay > 0 and _wait(between_delay)):
+            break
+
+
+def interrupt():
+    # Stop the running animation (from another thread); the animation turns the display off and returns
+    _interrupted.set()
+
+
+def clear_interrupt():
+    _interrupted.clear()
+
+
+def interrupted():
+    return _interrupted.is_set()
+
+
+def _wait(delay):
+    # sleep between animation frames, returns True if the animation was interrupted
+    return clock.wait(_interrupted, delay)
 
 
 def off():
-    unicornhathd.off()
+    if _hat is not None:
+        _hat.off()
@@ -0,0 +1,118 @@
+###########################################################
+# Watch Channels Module
+#
+# Registers a Calendar API watch channel (events().watch)
+# for each calendar, so Google posts a notification to the
+# app's push receiver (see push_receiver.py) whenever
+# something on the calendar changes. Channels expire, so
+# they're renewed a while before they do. The channels (and
+# the secret token Google sends back with every
+# notification) are kept in the state store, so a restart
+# keeps using them instead of registering new ones.
+###########################################################
+
+import datetime
+import logging
+import secrets
+import uuid
+
+import clock
+import metrics
+
+# how long to ask Google to keep a channel open (seconds); Google may pick a shorter time
+CHANNEL_TTL = 7 * 24 * 3600
+# renew a channel this many seconds before it expires
+RENEW_MARGIN = 3600
+# if registering a channel fails, try again after this many seconds
+RETRY_DELAY = 300
+
+
+class WatchChannels:
+
+    def __init__(self, service, calendar_ids, address, state):
+        # address: the (public, HTTPS) URL Google posts the notifications to
+        self._service = service
+        self._calendar_ids = calendar_ids
+        self._address = address
+        self._state = state
+        saved = state.get('watch_channels', {})
+        if saved.get('address') != address:
+            # the old channels (if any) post somewhere else
+            saved = {}
+        # the secret Google sends with every notification, so the receiver can tell them from anything else
+        self._token = saved.get('token') or secrets.token_urlsafe(24)
+        # calendar ID: {'id': channel ID, 'resource_id': the ID Google gave the calendar, 'expiration': clock time}
+        self._channels = {calendar_id: channel for calendar_id, channel in saved.get('channels', {}).items()
+                          if calendar_id in calendar_ids}
+        # when to try again after a failure
+        self._retry_at = 0
+
+    def set_service(self, service):
+        self._service = service
+
+    @property
+    def active(self):
+        # does every calendar have a channel that hasn't expired?
+        now = clock.time()
+        return all(calendar_id in self._channels and self._channels[calendar_id]['expiration'] > now
+                   for calendar_id in self._calendar_ids)
+
+    def get_calendar_id(self, channel_id, token):
+        # The calendar a notification is about, or None if it isn't from one of our channels
+        if token != self._token:
+            return None
+        for calendar_id, channel in list(self._channels.items()):
+            if channel['id'] == channel_id:
+                return calendar_id
+        return None
+
+    def renew(self):
+        # Register a channel for every calendar that doesn't have one, or whose channel is about to
+        # expire. Cheap when there's nothing to do, so the calendar calls this every time it syncs.
+        now = clock.time()
+        if now < self._retry_at:
+            return
+        for calendar_id in self._calendar_ids:
+            channel = self._channels.get(calendar_id)
+            if channel is not None and channel['expiration'] - RENEW_MARGIN > now:
+                continue
+            try:
+                self._channels[calendar_id] = self._watch(calendar_id)
+            except Exception as e:
+                # the regular refresh keeps things going until the channel is set up
+                metrics.increment('watch_channel_errors')
+                logging.error('Watch Channels: Unable to watch {}: {}'.format(calendar_id, e))
+                self._retry_at = now + RETRY_DELAY
+                break
+            if channel is not None:
+                self._stop(channel)
+        self._save()
+
+    def _watch(self, calendar_id):
+        channel_id = uuid.uuid4().hex
+        body = {
+            'id': channel_id,
+            'type': 'web_hook',
+            'address': self._address,
+            'token': self._token,
+            'params': {'ttl': str(CHANNEL_TTL)}}
+        with metrics.timer('calendar_watch'):
+            result = self._service.events().watch(calendarId=calendar_id, body=body).execute()
+        # the expiration is in milliseconds
+        expiration = int(result.get('expiration', 0)) / 1000 or clock.time() + CHANNEL_TTL
+        logging.info('Watch Channels: Watching {} (channel {}) until {}'.format(
+            calendar_id, channel_id, datetime.datetime.fromtimestamp(expiration)))
+        return {'id': channel_id, 'resource_id': result.get('resourceId'), 'expiration': expiration}
+
+    def _stop(self, channel):
+        # stop an old channel, it expires on its own if this doesn't work
+        try:
+            self._service.channels().stop(body={'id': channel['id'], 'resourceId': channel['resource_id']}).execute()
+        except Exception as e:
+            logging.debug('Watch Channels: Unable to stop channel %s: %s', channel['id'], e)
+
+    def _save(self):
+        self._state.set('watch_channels', {
+            'address': self._address,
+            'token': self._token,
+            'channels': dict(self._channels)})